@@ -11,6 +11,8 @@ from .stream_builder import StreamBuilder
 from .structure import Structure
 from .utils import *
 
+set_numba_threading_layer()
+
 
 def deep_reload(m: ModuleType):
     name = m.__name__  # get the name that is used in sys.modules
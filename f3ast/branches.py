@@ -3,7 +3,7 @@ import numpy as np
 from joblib.parallel import Parallel, delayed
 from scipy.spatial import KDTree
 from trimesh.graph import connected_component_labels
-from trimesh.grouping import group_rows
+from trimesh.grouping import hashable_rows
 
 
 def split_intersection(intersection):
@@ -15,116 +15,129 @@ def split_intersection(intersection):
     Returns:
         (m,) list of (k,2,2) arrays: intersections grouped into components
     """
-    # group the same points in the intersections
-    grouped_rows = group_rows(intersection.reshape(-1, 2))
-    # assign each point an index.
-    grouped_indices = np.array(
-        [[l, i] for i, ls in enumerate(grouped_rows) for l in ls]
+    if len(intersection) == 0:
+        raise ValueError("Cannot split an empty intersection.")
+    # group the same points in the intersections and assign each point the index of its group.
+    # Groups are numbered in the order of their hashes, same as in trimesh.grouping.group_rows
+    _, node_indices = np.unique(
+        hashable_rows(intersection.reshape(-1, 2)), return_inverse=True
     )
-    # get the indices sorted so that i-th element of node_indices corresponds to the i-th point
-    try:
-        arg = np.argsort(grouped_indices[:, 0])
-    except IndexError:
-        print(len(intersection))
-        print(intersection)
-        raise Exception()
-    node_indices = grouped_indices[arg, 1]
     # label the connected components
     edges = node_indices.reshape(-1, 2)
-    conn_labels = connected_component_labels(edges, node_count=len(grouped_rows))
+    conn_labels = connected_component_labels(edges, node_count=edges.max() + 1)
     # conn labels correspond to the nodes. Label each edge by one of its nodes.
     edge_labels = conn_labels[edges[:, 0]]
 
-    unique_lbls = np.unique(conn_labels)
-    split_intersection = []
-    for lbl in unique_lbls:
-        split_intersection.append(intersection[edge_labels == lbl, :, :])
-    return split_intersection
+    # sort the edges by label (keeping the order within a label) and split where the label changes
+    order = np.argsort(edge_labels, kind="stable")
+    boundaries = np.flatnonzero(np.diff(edge_labels[order])) + 1
+    return np.split(intersection[order], boundaries)
 
 
-def get_branch_connections(branch_intersections_slices, connection_distance):
+def get_branch_connections(branch_intersections_slices, connection_distance, n_jobs=1):
     """Gets the connections between branches organized in slices
 
     Args:
         branch_intersections_slices (list of lists of arrays): For each slice, for each branch, array of points in that branch.
         connection_distance (float): Distance for which branches are considered connected.
+        n_jobs (int, optional): Number of threads over which the pairs of slices are processed. Defaults to 1.
 
     Returns:
         list of list of arrays:  For each slice, for each branch, which branches from layer below is it connected to.
     """
-    branch_connections = []
-    # with Parallel(n_jobs=5, backend="threading") as parallel:
-    for i, separated_pts in enumerate(branch_intersections_slices):
-        if i == 0:
-            branch_connections.append([])
-            separated_pts_below = separated_pts
-            continue
-        this_slice_connections = []
-        for br_pts in separated_pts:
-            # get how the branches in this layer connect to the branches from the previous layer. This is done by checking if the branches are neighbours (within a connection_distance away)
-            this_branch_connections = []
-            tree = KDTree(br_pts.reshape(-1, 2))
-            branch_min_distances = []
-            for k, branch_pts_below in enumerate(separated_pts_below):
-                nb, dist = is_branch_nb(tree, branch_pts_below, connection_distance)
-                if nb:
-                    branch_min_distances.append(dist)
-                    this_branch_connections.append(k)
-            this_branch_connections = np.array(this_branch_connections)
-            n_conn = len(this_branch_connections)
-
-            # the previous has an issue. The two branches can be close, but not fully merge until a few layers above.
-            # This is a hack to fix it. It looks if the branches that seem to connect to each other exist (within a connection distance) in the current layer.
-            # If something does not work properly, this is the likely culprit.
-            # There must be a better way of doing this
-            if n_conn > 1:
-                # Ensure that the branches that were merged do not exist in the current layer
-                # to know how many duplicates, need to know how many branches in this layer are within a conn distance away
-                count = 0
-                for br_pts2 in separated_pts:
-                    if is_branch_nb(tree, br_pts2, connection_distance)[0]:
-                        count += 1
-                if count > 1 and count <= n_conn:
-                    # drop the extra connections
-                    n_drop = n_conn - count + 1
-                    keep_indx = np.argsort(branch_min_distances)[:n_drop]
-                    this_branch_connections = this_branch_connections[keep_indx]
-            this_slice_connections.append(this_branch_connections)
-        branch_connections.append(this_slice_connections)
-        separated_pts_below = separated_pts
-    return branch_connections
-
-
-def is_branch_nb(tree, branch_pts, connection_distance):
-    """Gets if the branch is a neighbour of a branch with KDTree tree.
+    if len(branch_intersections_slices) == 0:
+        return []
+    slice_connections = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(get_slice_branch_connections)(
+            separated_pts, separated_pts_below, connection_distance
+        )
+        for separated_pts_below, separated_pts in zip(
+            branch_intersections_slices[:-1], branch_intersections_slices[1:]
+        )
+    )
+    return [[]] + slice_connections
+
+
+def get_slice_branch_connections(
+    separated_pts, separated_pts_below, connection_distance
+):
+    """Gets how the branches in a slice connect to the branches from the slice below.
+    Two branches are connected if they have points within a connection_distance (in the infinity norm).
+    All the points of both slices are put in a single KDTree and all the close pairs are found in one pass.
 
     Args:
-        tree (KDTree): KDTree of the current branch
-        branch_pts ((n, 2) array): Other branch pts
-        connection_distance (float): Distance for which the branches are considered neighours
+        separated_pts (list of arrays): For each branch in the slice, array of points in that branch.
+        separated_pts_below (list of arrays): For each branch in the slice below, array of points in that branch.
+        connection_distance (float): Distance for which branches are considered connected.
 
     Returns:
-        bool: True if branches are close
-        float: Minimal distance between branches. np.inf if not neighbours.
+        list of arrays: For each branch, which branches from the slice below is it connected to.
     """
-    tree1 = KDTree(branch_pts.reshape(-1, 2))
-    distance_matrix = tree.sparse_distance_matrix(tree1, connection_distance, p=np.inf)
-    if distance_matrix.count_nonzero() > 0:
-        min_dist = np.min(list(distance_matrix.values()))
-        return True, min_dist
-    return False, np.inf
-
-
-def get_branch_connections_in_slice(br_pts, separated_pts_below, connection_distance):
-    """Auxiliary function to get the connections in a slice. This is for the purposes of parallelizing, but is not used atm."""
-
-    this_branch_connections = []
-    tree = KDTree(br_pts.reshape(-1, 2))
-    branch_min_distances = []
-    for k, branch_pts_below in enumerate(separated_pts_below):
-        nb, dist = is_branch_nb(tree, branch_pts_below, connection_distance)
-        if nb:
-            branch_min_distances.append(dist)
-            this_branch_connections.append(k)
-    this_branch_connections = np.array(this_branch_connections)
-    return np.array(this_branch_connections), branch_min_distances
+    pts_below, labels_below = _label_branch_points(separated_pts_below)
+    pts, labels = _label_branch_points(separated_pts)
+    n_below = pts_below.shape[0]
+    n_branches, n_branches_below = len(separated_pts), len(separated_pts_below)
+    # labels of all the points: branches below are numbered after the branches in this slice
+    all_labels = np.concatenate((labels_below + n_branches, labels))
+
+    all_pts = np.vstack((pts_below, pts))
+    tree = KDTree(all_pts)
+    pairs = tree.query_pairs(connection_distance, p=np.inf, output_type="ndarray")
+    # query_pairs gives i < j, so a pair between the slices always has the point below first
+    first_below = pairs[:, 0] < n_below
+    second_below = pairs[:, 1] < n_below
+
+    # minimal distance between each pair of connected branches (this slice, below)
+    cross_pairs = pairs[first_below & ~second_below]
+    cross_distances = np.max(
+        np.abs(all_pts[cross_pairs[:, 0]] - all_pts[cross_pairs[:, 1]]), axis=1
+    )
+    cross_keys = (
+        all_labels[cross_pairs[:, 1]] * n_branches_below
+        + all_labels[cross_pairs[:, 0]]
+        - n_branches
+    )
+    order = np.lexsort((cross_distances, cross_keys))
+    cross_keys, first_indx = np.unique(cross_keys[order], return_index=True)
+    branch_min_distances = cross_distances[order][first_indx]
+    connected_branches, connected_below = np.divmod(cross_keys, n_branches_below)
+
+    # number of branches in this slice that each branch is close to (including itself)
+    same_pairs = pairs[~first_below & ~second_below]
+    same_labels = all_labels[same_pairs]
+    same_labels = same_labels[same_labels[:, 0] != same_labels[:, 1]]
+    same_keys = np.unique(
+        np.concatenate(
+            (
+                same_labels[:, 0] * n_branches + same_labels[:, 1],
+                same_labels[:, 1] * n_branches + same_labels[:, 0],
+            )
+        )
+    )
+    nb_count = 1 + np.bincount(same_keys // n_branches, minlength=n_branches)
+
+    bounds = np.searchsorted(connected_branches, np.arange(n_branches + 1))
+    this_slice_connections = []
+    for j in range(n_branches):
+        this_branch_connections = connected_below[bounds[j] : bounds[j + 1]]
+        min_distances = branch_min_distances[bounds[j] : bounds[j + 1]]
+        n_conn = len(this_branch_connections)
+        # The two branches can be close, but not fully merge until a few layers above.
+        # This is a hack to fix it. It looks if the branches that seem to connect to each other exist (within a connection distance) in the current layer.
+        # If something does not work properly, this is the likely culprit.
+        if n_conn > 1 and 1 < nb_count[j] <= n_conn:
+            # drop the extra connections
+            n_drop = n_conn - nb_count[j] + 1
+            keep_indx = np.argsort(min_distances, kind="stable")[:n_drop]
+            this_branch_connections = this_branch_connections[keep_indx]
+        this_slice_connections.append(this_branch_connections)
+    return this_slice_connections
+
+
+def _label_branch_points(separated_pts):
+    """Stacks the points of all the branches and labels each point by its branch index."""
+    branch_pts = [br_pts.reshape(-1, 2) for br_pts in separated_pts]
+    labels = np.repeat(
+        np.arange(len(branch_pts)), [br_pts.shape[0] for br_pts in branch_pts]
+    )
+    return np.vstack(branch_pts), labels
@@ -8,6 +8,7 @@ from trimesh.exchange.export import export_mesh
 from f3ast.stream import Stream
 from f3ast.stream_builder import StreamBuilder
 from f3ast.structure import Structure
+from f3ast.sweep import ParameterSweep
 
 dirname = os.path.dirname(__file__)
 CUBE_PATH = os.path.join(dirname, "cube.stl")
@@ -29,19 +30,18 @@ def get_sigma_structures(model, sigma_list, settings, width=75, length=800, angl
     struct = get_straight_ramp(length, width, 0.1, angle)
     model.set_structure(struct)
 
-    # solve for dwell times
-    sigma_strm_list = []
-    for s in sigma_list:
-        model.sigma = s
-        stream_builder, _ = StreamBuilder.from_model(
-            model, **settings["stream_builder"]
-        )
-        sigma_strm_list.append(stream_builder.get_stream())
+    # solve for dwell times of all the sigma values in one sweep, sharing the neighbour searches
+    sweep = ParameterSweep(
+        model, {"sigma": sigma_list}, solver_settings=settings.get("solver")
+    )
+    sigma_strm_list = sweep.get_streams(**settings["stream_builder"])
 
     # get the single pixel line
     struct_1px = get_straight_ramp(length, 0.1, 0.1, 45)
     model.set_structure(struct_1px)
-    stream_builder, _ = StreamBuilder.from_model(model, **settings["stream_builder"])
+    stream_builder, _ = StreamBuilder.from_model(
+        model, solver_settings=settings.get("solver"), **settings["stream_builder"]
+    )
     strm_1px = stream_builder.get_stream()
 
     # arange on a screen
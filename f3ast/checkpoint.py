@@ -0,0 +1,130 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# name of the manifest file in the checkpoint directory
+MANIFEST_NAME = "manifest.json"
+
+
+def get_run_key(layer_keys):
+    """Gets the key identifying a solve of a whole structure: a hash of the keys of its layers (see DwellSolver.get_layer_key),
+    which hash the points of the structure, the model parameters and the solver options.
+
+    Args:
+        layer_keys (list of str): Key of each layer.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    key = hashlib.sha1()
+    for layer_key in layer_keys:
+        key.update(layer_key.encode())
+    return key.hexdigest()
+
+
+class SolveCheckpoint:
+    """Checkpoint of a DwellSolver run in a directory, so that an interrupted run can be resumed.
+    The directory holds a manifest identifying the run (the model, the structure and the solver options, see get_run_key) and the dwell times
+    of each solved layer in a separate file. The files are written to a temporary path first and then moved, so an interrupted write
+    never leaves a truncated file.
+
+    Attributes:
+        directory (str): Directory of the checkpoint.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def get_path(self, layer):
+        """Path of the file of the solution of the layer."""
+        return os.path.join(self.directory, "layer_{:06d}.npy".format(layer))
+
+    def load_manifest(self):
+        """Gets the manifest of the checkpoint.
+
+        Returns:
+            dict: Manifest with the run key, the model type and the number of layers. None if there is no checkpoint.
+        """
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def start(self, layer_keys, model_name, resume=False):
+        """Starts the checkpoint of the run. Unless the run is resumed, the solutions of any previous run are removed.
+
+        Args:
+            layer_keys (list of str): Key of each layer of the run.
+            model_name (str): Name of the model type, stored in the manifest for reference.
+            resume (bool, optional): If true, the solutions of the previous run are kept. Defaults to False.
+
+        Raises:
+            ValueError: If the run is resumed from a checkpoint of a different run.
+        """
+        run_key = get_run_key(layer_keys)
+        manifest = self.load_manifest()
+        if resume and manifest is not None:
+            if manifest["run_key"] != run_key:
+                raise ValueError(
+                    "The checkpoint in {} is of a different model, structure or solver settings".format(
+                        self.directory
+                    )
+                )
+            return
+        for path in glob.glob(os.path.join(self.directory, "layer_*.npy")):
+            os.remove(path)
+        manifest = {
+            "run_key": run_key,
+            "model": model_name,
+            "n_layers": len(layer_keys),
+        }
+        self._write(
+            self.manifest_path, lambda f: f.write(json.dumps(manifest).encode())
+        )
+
+    def load(self, layer):
+        """Gets the solution of the layer from the checkpoint.
+
+        Args:
+            layer (int): Index of the layer.
+
+        Returns:
+            (n,) array: Dwell times. None if the layer has not been solved.
+        """
+        path = self.get_path(layer)
+        if not os.path.exists(path):
+            return None
+        return np.load(path)
+
+    def save(self, layer, dwell_times):
+        """Saves the solution of the layer.
+
+        Args:
+            layer (int): Index of the layer.
+            dwell_times ((n,) array): Dwell times.
+        """
+        dwell_times = np.asarray(dwell_times, dtype=np.float64)
+        self._write(self.get_path(layer), lambda f: np.save(f, dwell_times))
+
+    def get_solved_layers(self):
+        """Gets the indices of the layers saved in the checkpoint.
+
+        Returns:
+            list of int
+        """
+        paths = glob.glob(os.path.join(self.directory, "layer_*.npy"))
+        return sorted(int(os.path.basename(path)[6:-4]) for path in paths)
+
+    def _write(self, path, write):
+        temporary_path = path + ".{}.tmp".format(os.getpid())
+        with open(temporary_path, "wb") as f:
+            write(f)
+        os.replace(temporary_path, path)
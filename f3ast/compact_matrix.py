@@ -0,0 +1,201 @@
+import time
+
+import numpy as np
+from numba import njit
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import LinearOperator
+from scipy.spatial import KDTree
+
+from .distance_cache import add_search_time
+
+# data types of the compact matrices
+COMPACT_DTYPES = ("float64", "float32")
+
+
+@njit(nogil=True)
+def _symmetric_matvec(indptr, indices, data, x):
+    y = np.zeros(x.shape[0])
+    for i in range(indptr.shape[0] - 1):
+        for k in range(indptr[i], indptr[i + 1]):
+            j = indices[k]
+            y[i] += data[k] * x[j]
+            if j != i:
+                y[j] += data[k] * x[i]
+    return y
+
+
+@njit(nogil=True)
+def _fill_csr(n_points, rows, cols, distances, symmetric, indices, data):
+    # the pairs (i < j) are sorted by rows and columns. Each row gets the pairs below the diagonal,
+    # the diagonal and the pairs above the diagonal, so that its columns are sorted
+    indptr = np.zeros(n_points + 1, dtype=np.int32)
+    for k in range(rows.shape[0]):
+        indptr[rows[k] + 1] += 1
+        if not symmetric:
+            indptr[cols[k] + 1] += 1
+    for i in range(n_points):
+        indptr[i + 1] += indptr[i] + 1
+    position = indptr[:-1].copy()
+    if not symmetric:
+        for k in range(rows.shape[0]):
+            indices[position[cols[k]]] = rows[k]
+            data[position[cols[k]]] = distances[k]
+            position[cols[k]] += 1
+    for i in range(n_points):
+        indices[position[i]] = i
+        data[position[i]] = 0
+        position[i] += 1
+    for k in range(rows.shape[0]):
+        indices[position[rows[k]]] = cols[k]
+        data[position[rows[k]]] = distances[k]
+        position[rows[k]] += 1
+    return indptr
+
+
+class SymmetricMatrix:
+    """Sparse symmetric matrix stored as its upper triangle (including the diagonal) in CSR format.
+    Supports the operations that the layer solvers need: products with vectors, the diagonal, submatrices and scaling.
+
+    Attributes:
+        upper (csr_matrix): Upper triangle of the matrix.
+    """
+
+    def __init__(self, upper):
+        self.upper = upper
+
+    @property
+    def shape(self):
+        return self.upper.shape
+
+    @property
+    def dtype(self):
+        return self.upper.dtype
+
+    @property
+    def nnz(self):
+        """Number of the stored entries."""
+        return self.upper.nnz
+
+    @property
+    def full_nnz(self):
+        """Number of the non-zero entries of the full matrix: the off-diagonal entries are stored once, but count twice."""
+        n_diagonal = np.count_nonzero(self.upper.indices == get_matrix_rows(self.upper))
+        return 2 * self.upper.nnz - n_diagonal
+
+    @property
+    def data(self):
+        return self.upper.data
+
+    @data.setter
+    def data(self, data):
+        self.upper.data = data
+
+    @property
+    def T(self):
+        return self
+
+    def copy(self):
+        return SymmetricMatrix(self.upper.copy())
+
+    def diagonal(self):
+        return self.upper.diagonal()
+
+    def __matmul__(self, x):
+        return _symmetric_matvec(
+            self.upper.indptr,
+            self.upper.indices,
+            self.upper.data,
+            np.asarray(x, dtype=np.float64),
+        )
+
+    def dot(self, x):
+        return self @ x
+
+    def __imul__(self, factor):
+        self.upper.data *= factor
+        return self
+
+    def __itruediv__(self, factor):
+        self.upper.data /= factor
+        return self
+
+    def submatrix(self, index):
+        """Gets the submatrix of the rows and columns of the index, which must be sorted."""
+        return SymmetricMatrix(self.upper[index][:, index])
+
+    def tocsr(self):
+        """Gets the full matrix in CSR format."""
+        upper = self.upper.tocsr()
+        lower = upper.T.tocsr()
+        lower.setdiag(0)
+        lower.eliminate_zeros()
+        return (upper + lower).tocsr()
+
+    def aslinearoperator(self):
+        """Gets the matrix as a linear operator, e.g. for lsq_linear."""
+        return LinearOperator(
+            self.shape, matvec=self.__matmul__, rmatvec=self.__matmul__, dtype=float
+        )
+
+
+def get_compact_distance_matrix(
+    points, threshold, symmetric=False, dtype="float64", chunk_size=2**18
+):
+    """Gets the matrix of distances between the points that are within the threshold, built directly in CSR format with int32 indices.
+    Unlike get_points_distance_matrix, the pairs are searched only once and no intermediate COO matrix is made.
+
+    Args:
+        points ((n,2) array): Points in the slice.
+        threshold (float): Maximal distance which to consider.
+        symmetric (bool, optional): If true, only the upper triangle is stored (SymmetricMatrix). Defaults to False.
+        dtype (str, optional): Data type of the distances (see COMPACT_DTYPES). Defaults to "float64".
+        chunk_size (int, optional): Number of pairs whose distances are calculated at once. Defaults to 2**18.
+
+    Returns:
+        csr_matrix or SymmetricMatrix: Sparse distance matrix with the diagonal stored explicitly.
+    """
+    n_points = points.shape[0]
+    start = time.perf_counter()
+    pairs = KDTree(points).query_pairs(threshold, output_type="ndarray")
+    add_search_time(time.perf_counter() - start)
+    order = np.lexsort((pairs[:, 1], pairs[:, 0]))
+    rows = pairs[order, 0].astype(np.int32)
+    cols = pairs[order, 1].astype(np.int32)
+    del pairs, order
+    # the distances are calculated in chunks to avoid large temporary arrays
+    distances = np.empty(rows.size, dtype=dtype)
+    for i in range(0, rows.size, chunk_size):
+        chunk = slice(i, i + chunk_size)
+        distances[chunk] = np.linalg.norm(
+            points[rows[chunk]] - points[cols[chunk]], axis=1
+        )
+    # query_pairs gives i < j, so the pairs are the upper triangle
+    nnz = n_points + (1 if symmetric else 2) * rows.size
+    indices = np.empty(nnz, dtype=np.int32)
+    data = np.empty(nnz, dtype=dtype)
+    indptr = _fill_csr(n_points, rows, cols, distances, symmetric, indices, data)
+    matrix = csr_matrix((data, indices, indptr), shape=(n_points, n_points))
+    return SymmetricMatrix(matrix) if symmetric else matrix
+
+
+def get_matrix_rows(matrix):
+    """Gets the row of each stored entry of a COO or CSR matrix."""
+    if hasattr(matrix, "row"):
+        return matrix.row
+    return np.repeat(
+        np.arange(matrix.shape[0], dtype=matrix.indices.dtype), np.diff(matrix.indptr)
+    )
+
+
+def get_matrix_nnz(matrix):
+    """Gets the number of the non-zero entries of the full matrix, also for a SymmetricMatrix that stores only its upper triangle."""
+    if isinstance(matrix, SymmetricMatrix):
+        return matrix.full_nnz
+    return matrix.nnz
+
+
+def get_submatrix(matrix, index):
+    """Gets the submatrix of the rows and columns of the sorted index."""
+    if isinstance(matrix, SymmetricMatrix):
+        return matrix.submatrix(index)
+    return matrix[index][:, index]
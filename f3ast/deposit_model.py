@@ -1,14 +1,32 @@
+import copy
+from collections import deque
+from numbers import Number
+
 import numpy as np
 from scipy.optimize import curve_fit
-from scipy.spatial import KDTree
 
-from .resistance import get_resistance
+from .compact_matrix import get_compact_distance_matrix, get_matrix_rows
+from .distance_cache import get_points_distance_matrix
+from .resistance import get_resistance, iter_resistance
 from .structure import Structure
 
 
 class Model:
     """Template class for the model classes. Defines how we model the deposit."""
 
+    # parameters by which the proximity matrices are multiplied, so the dwell times scale as their inverse
+    LINEAR_PARAMETERS = ()
+    # parameters that the per-layer parameters (see get_layer_parameters) depend on, so they are recalculated when these change
+    LAYER_PARAMETERS = ()
+    # whether the proximity matrices are symmetric, so that only their upper triangle needs to be stored
+    SYMMETRIC = False
+    # optional cache of the slice distance matrices (see get_slice_distance_matrix)
+    distance_cache = None
+    # data type of the compact proximity matrices ("float64" or "float32"). None uses the COO matrices (see get_points_distance_matrix)
+    compact_matrices = None
+    # whether the compact matrices of the symmetric models store only their upper triangle
+    symmetric_matrices = True
+
     def __init__(self, struct, get_parameters=True):
         self._struct = struct
         if get_parameters:
@@ -47,9 +65,79 @@ class Model:
         Returns:
             coo_matrix: distance_matrix: Sparse matrix (SciPy coo_matrix) of distances within the points that are withing the nb_threshold as defined by the class
         """
-        tree = KDTree(self.struct.slices[layer])
+        return self.load_distance_matrix(
+            self.struct.distance_cache, layer, self.struct.slices[layer]
+        )
+
+    def load_distance_matrix(self, distance_cache, layer, points):
+        """Gets the distance matrix of the layer from the cache, or calculates it and saves it to the cache if it is not there.
+        The matrices of each format (see get_matrix_format) are cached separately.
+
+        Args:
+            distance_cache (DistanceMatrixCache): Cache of the distance matrices.
+            layer (int): Index of the layer.
+            points ((n,2) array): Points in the slice.
+
+        Returns:
+            coo_matrix: distance_matrix (see get_points_distance_matrix)
+        """
         threshold = self.get_nb_threshold()
-        return tree.sparse_distance_matrix(tree, threshold, output_type="coo_matrix")
+        matrix_format = self.get_matrix_format()
+        distance_matrix = distance_cache.load(layer, threshold, matrix_format)
+        if distance_matrix is None:
+            distance_matrix = self.get_points_distance_matrix(points)
+            distance_cache.save(layer, threshold, distance_matrix, matrix_format)
+        return distance_matrix
+
+    def get_matrix_format(self):
+        """Gets the format of the distance matrices of the model: None for the COO matrices, otherwise the data type of the compact matrices
+        and whether they store only their upper triangle.
+
+        Returns:
+            tuple
+        """
+        if self.compact_matrices is None:
+            return None
+        return self.compact_matrices, self.symmetric_matrices and self.is_symmetric()
+
+    def get_points_distance_matrix(self, points):
+        """Gets the distance matrix for the given slice points.
+
+        Args:
+            points ((n,2) array): Points in the slice.
+
+        Returns:
+            coo_matrix: distance_matrix: Sparse matrix (SciPy coo_matrix) of distances within the points that are withing the nb_threshold as defined by the class.
+                With compact_matrices, a CSR matrix with int32 indices, or a SymmetricMatrix for the symmetric models if symmetric_matrices is set
+                (see get_compact_distance_matrix).
+        """
+        matrix_format = self.get_matrix_format()
+        if matrix_format is not None:
+            dtype, symmetric = matrix_format
+            return get_compact_distance_matrix(
+                points, self.get_nb_threshold(), symmetric=symmetric, dtype=dtype
+            )
+        return get_points_distance_matrix(points, self.get_nb_threshold())
+
+    def is_symmetric(self):
+        """Whether the proximity matrices of the model are symmetric."""
+        return self.SYMMETRIC
+
+    def get_slice_distance_matrix(self, slice_layer):
+        """Gets the distance matrix for a slice record. If the model has a distance cache, the matrix is taken from it,
+        so that models with different parameters share the neighbour searches. The records without an index (e.g. the tiles of a layer) are not cached.
+
+        Args:
+            slice_layer (SliceLayer): Record of the slice.
+
+        Returns:
+            coo_matrix: distance_matrix
+        """
+        if self.distance_cache is None or slice_layer.index is None:
+            return self.get_points_distance_matrix(slice_layer.points)
+        return self.load_distance_matrix(
+            self.distance_cache, slice_layer.index, slice_layer.points
+        )
 
     def proximity_fun(self, distances, *args):
         """Defines the proximity function to get the proximity matrix from distances.
@@ -62,6 +150,22 @@ class Model:
         """
         return distances + 1
 
+    def get_distance_proximity_matrix(self, distance_matrix, *args):
+        """Turns the distance matrix into the proximity matrix in place, keeping its data type.
+
+        Args:
+            distance_matrix (sparse matrix): Distance matrix, which is not used elsewhere (e.g. a copy from the cache).
+            *args: Arguments of the proximity function.
+
+        Returns:
+            sparse matrix: proximity_matrix
+        """
+        distance_matrix.data = np.asarray(
+            self.proximity_fun(distance_matrix.data, *args),
+            dtype=distance_matrix.data.dtype,
+        )
+        return distance_matrix
+
     def get_proximity_matrix(self, layer: int, *args):
         """Gets the proximity matrix for the layer required by the solver.
 
@@ -72,15 +176,109 @@ class Model:
             coo_matrix: proximity_matrix: Sparse matrix (SciPy coo_matrix) defining the parameters for the proximity calculation.
         """
         distance_matrix = self.get_distance_matrix(layer)
-        # need to copy the matrix so that we can apply the proximity function to the data
-        proximity_matrix = distance_matrix.copy()
-        proximity_matrix.data = self.proximity_fun(distance_matrix.data, *args)
-        return proximity_matrix
+        return self.get_distance_proximity_matrix(distance_matrix, *args)
+
+    def get_slice_proximity_matrix(self, slice_layer, *args):
+        """Gets the proximity matrix for a slice record without accessing the slices stored in the structure.
+
+        Args:
+            slice_layer (SliceLayer): Record of the slice.
+
+        Returns:
+            coo_matrix: proximity_matrix: Sparse matrix (SciPy coo_matrix) defining the parameters for the proximity calculation.
+        """
+        distance_matrix = self.get_slice_distance_matrix(slice_layer)
+        return self.get_distance_proximity_matrix(distance_matrix, *args)
+
+    def iter_layer_arguments(self, slice_layers):
+        """Gets the extra arguments of get_slice_proximity_matrix one layer at a time from the iterable of slices (e.g. Structure.iter_slices).
+        Any layer parameters are calculated on the fly so the model can be created with get_parameters=False.
+
+        Args:
+            slice_layers (iterable of SliceLayer): Slices of the structure in order.
+
+        Yields:
+            tuple: slice_layer (SliceLayer), arguments (tuple)
+        """
+        for slice_layer in slice_layers:
+            yield slice_layer, ()
+
+    def iter_proximity_matrices(self, slice_layers):
+        """Gets the proximity matrices one layer at a time from the iterable of slices (see iter_layer_arguments).
+
+        Args:
+            slice_layers (iterable of SliceLayer): Slices of the structure in order.
+
+        Yields:
+            tuple: slice_layer (SliceLayer), proximity_matrix (coo_matrix)
+        """
+        for slice_layer, arguments in self.iter_layer_arguments(slice_layers):
+            yield slice_layer, self.get_slice_proximity_matrix(slice_layer, *arguments)
 
     def get_layer_parameters(self):
         """Gets any necessary layer parameters from the structure for the model to be able to calculate the proximity matrix. E.g. resistance for temperature, layer height for focus correction etc."""
         pass
 
+    def get_layer_arguments(self, layer: int):
+        """Gets the extra arguments of get_slice_proximity_matrix for the layer of the structure,
+        so that get_slice_proximity_matrix(struct.sliced_structure.layer(layer), *arguments) equals get_proximity_matrix(layer).
+
+        Args:
+            layer (int): Index of the layer
+
+        Returns:
+            tuple: Arguments for get_slice_proximity_matrix.
+        """
+        return ()
+
+    def get_layer_factors(self, layer: int):
+        """Gets the per-layer factors that the proximity matrix of the layer depends on, besides its points and the model parameters.
+
+        Args:
+            layer (int): Index of the layer
+
+        Returns:
+            tuple: Scalars or per-point arrays.
+        """
+        return self.get_layer_arguments(layer)
+
+    def get_slice_layer_factors(self, slice_layer, arguments):
+        """Gets the per-layer factors (see get_layer_factors) for a slice record given its arguments of get_slice_proximity_matrix.
+
+        Args:
+            slice_layer (SliceLayer): Record of the slice.
+            arguments (tuple): Arguments for get_slice_proximity_matrix (see iter_layer_arguments).
+
+        Returns:
+            tuple: Scalars or per-point arrays.
+        """
+        return tuple(arguments)
+
+    def get_model_parameters(self):
+        """Gets the scalar parameters of the model (e.g. gr and sigma), which together with the layer factors determine the proximity matrices.
+
+        Returns:
+            dict: Parameters, including the name of the model.
+        """
+        parameters = {
+            name: value
+            for name, value in vars(self).items()
+            if isinstance(value, (Number, str))
+        }
+        parameters["model"] = type(self).__name__
+        return parameters
+
+    def without_structure(self):
+        """Gets a shallow copy of the model without the structure and the per-layer parameters (see get_layer_arguments).
+        The copy can still calculate the proximity matrices from the slice records, so it is cheap to send to the parallel workers.
+
+        Returns:
+            Model
+        """
+        model = copy.copy(self)
+        model._struct = None
+        return model
+
 
 class RRLModel(Model):
     """Reaction rate limited model. Basic model only taking into account growth rate and sigma parameters.
@@ -90,6 +288,9 @@ class RRLModel(Model):
         sigma (float): deposit width
     """
 
+    LINEAR_PARAMETERS = ("gr",)
+    SYMMETRIC = True
+
     def __init__(self, struct: Structure, gr: float, sigma: float, **kwargs):
         super().__init__(struct, **kwargs)
         self.gr = gr
@@ -134,6 +335,9 @@ class DDModel(Model):
         sigma (float): deposit width
     """
 
+    LINEAR_PARAMETERS = ("gr",)
+    LAYER_PARAMETERS = ("single_pixel_width",)
+
     def __init__(
         self,
         struct,
@@ -176,11 +380,31 @@ class DDModel(Model):
         """Returns the proximity matrix using the distance matrix for the given layer."""
         distance_matrix = self.get_distance_matrix(layer)
         # each row of distance matrix has the resistance of the corresponding point
-        res = self.resistance[layer][distance_matrix.row]
+        res = self.resistance[layer][get_matrix_rows(distance_matrix)]
         # get the proximity matrix
-        proximity_matrix = distance_matrix.copy()
-        proximity_matrix.data = self.proximity_fun(distance_matrix.data, res)
-        return proximity_matrix
+        return self.get_distance_proximity_matrix(distance_matrix, res)
+
+    def get_slice_proximity_matrix(self, slice_layer, resistance):
+        """Returns the proximity matrix for the slice record given the resistance of its points."""
+        distance_matrix = self.get_slice_distance_matrix(slice_layer)
+        res = resistance[get_matrix_rows(distance_matrix)]
+        return self.get_distance_proximity_matrix(distance_matrix, res)
+
+    def get_layer_arguments(self, layer: int):
+        """The resistance of the points in the layer."""
+        return (self.resistance[layer],)
+
+    def without_structure(self):
+        model = super().without_structure()
+        model._resistance = None
+        return model
+
+    def iter_layer_arguments(self, slice_layers):
+        """Gets the resistance one layer at a time, calculating it along the way."""
+        for slice_layer, resistance in iter_resistance(
+            slice_layers, single_pixel_width=self.single_pixel_width
+        ):
+            yield slice_layer, (resistance,)
 
     def get_nb_threshold(self):
         """How far are the points considered neighbours."""
@@ -243,12 +467,31 @@ class HeightCorrectionModel(RRLModel):
         super().__init__(struct, gr, sigma, **kwargs)
         self.doubling_length = doubling_length
 
+    def get_height_correction(self, layer_height):
+        """Factor by which the proximity is reduced at the given height."""
+        return np.power(2.0, layer_height / self.doubling_length)
+
     def get_proximity_matrix(self, layer, *args):
         proximity_matrix = super().get_proximity_matrix(layer, *args)
         layer_height = self.struct.z_levels[layer]
-        proximity_matrix /= np.power(2.0, layer_height / self.doubling_length)
+        proximity_matrix /= self.get_height_correction(layer_height)
         return proximity_matrix
 
+    def get_slice_proximity_matrix(self, slice_layer, *args):
+        proximity_matrix = super().get_slice_proximity_matrix(slice_layer, *args)
+        proximity_matrix /= self.get_height_correction(slice_layer.z)
+        return proximity_matrix
+
+    def get_layer_factors(self, layer: int):
+        """The height of the layer."""
+        return super().get_layer_factors(layer) + (self.struct.z_levels[layer],)
+
+    def get_slice_layer_factors(self, slice_layer, arguments):
+        """The height of the slice."""
+        return super().get_slice_layer_factors(slice_layer, arguments) + (
+            slice_layer.z,
+        )
+
 
 class InheritModel(Model):
     """Abstract class that allows inheriting a model to build upon it"""
@@ -264,10 +507,27 @@ class InheritModel(Model):
     def proximity_fun(self, distances, *args):
         return self.base_model.proximity_fun(distances, *args)
 
+    def is_symmetric(self):
+        return self.base_model.is_symmetric()
+
+    def get_model_parameters(self):
+        parameters = super().get_model_parameters()
+        parameters["base_model"] = tuple(
+            sorted(self.base_model.get_model_parameters().items())
+        )
+        return parameters
+
+    def without_structure(self):
+        model = super().without_structure()
+        model.base_model = self.base_model.without_structure()
+        return model
+
 
 class PhiAngleCorrectionModel(InheritModel):
     """ """
 
+    LAYER_PARAMETERS = ("num_layers_smoothing",)
+
     def __init__(
         self,
         base_model: Model,
@@ -275,11 +535,14 @@ class PhiAngleCorrectionModel(InheritModel):
         correction_factor: float,
         num_layers_smoothing: int = 10,
     ):
-        super().__init__(base_model)
         # for smoothing, we need to take a difference a number of layers apart
         self.num_layers_smoothing = num_layers_smoothing
         self.phi0 = phi0
         self.correction_factor = correction_factor
+        super().__init__(base_model)
+
+    def get_layer_parameters(self):
+        """Gets the angles of the layers and stores them as an internal parameter."""
         self.layer_angles = self.get_layer_angles()
 
     def get_layer_angles(self) -> np.ndarray:
@@ -301,3 +564,26 @@ class PhiAngleCorrectionModel(InheritModel):
         proximity_matrix = super().get_proximity_matrix(layer, *args)
         proximity_matrix *= self.angle_correction_function(self.layer_angles[layer])
         return proximity_matrix
+
+    def get_slice_proximity_matrix(self, slice_layer, angle=0.0):
+        """Returns the proximity matrix for the slice record corrected for the angle of the layer."""
+        proximity_matrix = super().get_slice_proximity_matrix(slice_layer)
+        proximity_matrix *= self.angle_correction_function(angle)
+        return proximity_matrix
+
+    def get_layer_arguments(self, layer: int):
+        """The angle of the layer."""
+        return (self.layer_angles[layer],)
+
+    def iter_layer_arguments(self, slice_layers):
+        """Gets the angle one layer at a time, keeping only the layer centres needed for the smoothing."""
+        num_smoothing = self.num_layers_smoothing
+        centres_below = deque(maxlen=num_smoothing)
+        for slice_layer in slice_layers:
+            centre = slice_layer.points.mean(axis=0)
+            angle = 0.0
+            if len(centres_below) == num_smoothing:
+                layer_vector = centre - centres_below[0]
+                angle = np.arctan2(layer_vector[1], layer_vector[0])
+            centres_below.append(centre)
+            yield slice_layer, (angle,)
@@ -0,0 +1,195 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.spatial import KDTree
+
+# time spent in the neighbour searches by each thread
+_search_timer = threading.local()
+
+
+def get_search_time():
+    """Gets the total time the current thread has spent in the neighbour searches (get_points_distance_matrix).
+
+    Returns:
+        float: Time in seconds.
+    """
+    return getattr(_search_timer, "total", 0.0)
+
+
+def add_search_time(search_time):
+    """Adds the time of a neighbour search to the total of the current thread (see get_search_time).
+
+    Args:
+        search_time (float): Time in seconds.
+    """
+    _search_timer.total = get_search_time() + search_time
+
+
+def get_points_distance_matrix(points, threshold):
+    """Gets the sparse matrix of distances between the points that are within the threshold.
+    The entries are sorted by row and column so that the matrix does not depend on how it was obtained.
+
+    Args:
+        points ((n,2) array): Points in the slice.
+        threshold (float): Maximal distance which to consider.
+
+    Returns:
+        coo_matrix: Sparse distance matrix.
+    """
+    start = time.perf_counter()
+    tree = KDTree(points)
+    distance_matrix = tree.sparse_distance_matrix(
+        tree, threshold, output_type="coo_matrix"
+    )
+    order = np.lexsort((distance_matrix.col, distance_matrix.row))
+    distance_matrix = coo_matrix(
+        (
+            distance_matrix.data[order],
+            (distance_matrix.row[order], distance_matrix.col[order]),
+        ),
+        shape=distance_matrix.shape,
+    )
+    add_search_time(time.perf_counter() - start)
+    return distance_matrix
+
+
+def filter_distance_matrix(distance_matrix, threshold):
+    """Keeps only the entries of the distance matrix that are within the threshold.
+
+    Args:
+        distance_matrix (coo_matrix, csr_matrix or SymmetricMatrix): Sparse distance matrix.
+        threshold (float): Maximal distance which to keep.
+
+    Returns:
+        New sparse distance matrix of the same type.
+    """
+    if hasattr(distance_matrix, "upper"):
+        # SymmetricMatrix, filter its upper triangle
+        return type(distance_matrix)(
+            filter_distance_matrix(distance_matrix.upper, threshold)
+        )
+    keep = distance_matrix.data <= threshold
+    if hasattr(distance_matrix, "row"):
+        return coo_matrix(
+            (
+                distance_matrix.data[keep],
+                (distance_matrix.row[keep], distance_matrix.col[keep]),
+            ),
+            shape=distance_matrix.shape,
+        )
+    # count the entries that are kept in each row of the csr matrix
+    n_rows = distance_matrix.shape[0]
+    rows = np.repeat(np.arange(n_rows), np.diff(distance_matrix.indptr))
+    indptr = np.zeros(n_rows + 1, dtype=distance_matrix.indptr.dtype)
+    np.cumsum(np.bincount(rows[keep], minlength=n_rows), out=indptr[1:])
+    return csr_matrix(
+        (distance_matrix.data[keep], distance_matrix.indices[keep], indptr),
+        shape=distance_matrix.shape,
+    )
+
+
+class DistanceMatrixCache:
+    """In-memory cache of the distance matrices of the slices. For each layer only the matrix with the largest threshold is kept
+    and the matrices for smaller thresholds are obtained by filtering it. The matrices of different formats (e.g. the COO matrices and the
+    compact matrices, see Model.get_matrix_format) are kept separately. When the total size of the matrices exceeds max_size,
+    the least recently used layers are removed. The cache can be shared between threads.
+
+    Attributes:
+        max_size (int): Maximum size of the cached matrices in bytes. 0 disables the cache.
+    """
+
+    def __init__(self, max_size=2**28):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    @property
+    def size(self):
+        """Total size of the cached matrices in bytes."""
+        return self._size
+
+    def load(self, layer, threshold, matrix_format=None):
+        """Gets the distance matrix of the layer from the cache.
+
+        Args:
+            layer (int): Index of the layer.
+            threshold (float): Maximal distance in the matrix.
+            matrix_format (tuple, optional): Format of the matrix. Defaults to None, the COO matrices.
+
+        Returns:
+            Distance matrix (a copy, so it can be modified). None if no matrix with at least this threshold is cached.
+        """
+        key = (layer, matrix_format)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < threshold:
+                return None
+            self._entries.move_to_end(key)
+        cached_threshold, distance_matrix = entry
+        if cached_threshold == threshold:
+            return distance_matrix.copy()
+        return filter_distance_matrix(distance_matrix, threshold)
+
+    def save(self, layer, threshold, distance_matrix, matrix_format=None):
+        """Saves the distance matrix of the layer, replacing any matrix of the format with a smaller threshold, and evicts the old entries if the cache is too large.
+
+        Args:
+            layer (int): Index of the layer.
+            threshold (float): Maximal distance in the matrix.
+            distance_matrix (coo_matrix, csr_matrix or SymmetricMatrix): Distance matrix.
+            matrix_format (tuple, optional): Format of the matrix. Defaults to None, the COO matrices.
+        """
+        key = (layer, matrix_format)
+        size = matrix_size(distance_matrix)
+        distance_matrix = distance_matrix.copy()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= threshold:
+                    return
+                self._size -= matrix_size(entry[1])
+                del self._entries[key]
+            if size > self.max_size:
+                return
+            self._entries[key] = (threshold, distance_matrix)
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= matrix_size(evicted)
+
+    def clear(self):
+        """Removes all the entries from the cache."""
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # the cached matrices can be recalculated, so they are not pickled
+        return {"max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.max_size = state["max_size"]
+        self._lock = threading.Lock()
+        self.clear()
+
+
+def matrix_size(distance_matrix):
+    """Size of the arrays of a coo, csr or symmetric matrix in bytes."""
+    if hasattr(distance_matrix, "upper"):
+        return matrix_size(distance_matrix.upper)
+    if hasattr(distance_matrix, "row"):
+        return (
+            distance_matrix.data.nbytes
+            + distance_matrix.row.nbytes
+            + distance_matrix.col.nbytes
+        )
+    return (
+        distance_matrix.data.nbytes
+        + distance_matrix.indices.nbytes
+        + distance_matrix.indptr.nbytes
+    )
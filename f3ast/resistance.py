@@ -12,27 +12,44 @@ def get_resistance(struct, single_pixel_width=50.0):
     Returns:
         list of (n,) arrays: Resistance per point in the slice.
     """
+    # the slicing is stored in the structure, so that the solver does not slice it again
+    if not struct.is_sliced or not struct.sliced_structure.has_connections:
+        struct.generate_slices(branch_connectivity=True)
+    return [
+        resistance
+        for _, resistance in iter_resistance(
+            struct.sliced_structure.iter_layers(),
+            single_pixel_width=single_pixel_width,
+        )
+    ]
 
-    slices = struct.slices
-    branches = struct.branches
-    branch_lengths = struct.branch_lengths
-    branch_connections = struct.branch_connections
-    dz_levels = struct.z_levels[1:] - struct.z_levels[:-1]
-    resistance_slices = []
-    for i, (pts, branch, brlens, conn) in enumerate(
-        zip(slices, branches, branch_lengths, branch_connections)
-    ):
+
+def iter_resistance(slice_layers, single_pixel_width=50.0):
+    """Gets the resistance layer by layer from the iterable of slices (e.g. Structure.iter_slices). Only the previous layer is kept in memory.
+
+    Args:
+        slice_layers (iterable of SliceLayer): Slices of the structure in order. Need to include the branch connections.
+        single_pixel_width (float, optional): Width of a single pixel line. Defaults to 50.
+
+    Yields:
+        tuple: slice_layer (SliceLayer), resistance ((n,) array) per point in the slice.
+    """
+    z_below = None
+    for i, slice_layer in enumerate(slice_layers):
+        pts, branch = slice_layer.points, slice_layer.branches
+        brlens, conn = slice_layer.branch_lengths, slice_layer.branch_connections
         resistance = np.zeros(pts.shape[0])
         unique_br = np.unique(branch)
-        dz = dz_levels[i - 1]
         # separate the points into branches
         separated_pts = [pts[branch == lbl, :] for lbl in unique_br]
         # if on the substrate, set the resistance to 0 and continue
         if i == 0:
             separated_pts_below = separated_pts
             resistances_below = resistance
-            resistance_slices.append(resistance)
+            z_below = slice_layer.z
+            yield slice_layer, resistance
             continue
+        dz = slice_layer.z - z_below
 
         # find out how the branches connect: for each of the branches find the
         # ones from the layer below it connects to by finding if there are any
@@ -57,7 +74,7 @@ def get_resistance(struct, single_pixel_width=50.0):
                 r_inv += 1 / connection_resistance
             r = 1 / r_inv if r_inv != 0 else 0
             resistance[branch == j] = r
-        resistance_slices.append(resistance)
+        yield slice_layer, resistance
         separated_pts_below = separated_pts
         resistances_below = resistance
-    return resistance_slices
+        z_below = slice_layer.z
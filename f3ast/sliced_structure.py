@@ -0,0 +1,428 @@
+import os
+import shutil
+import uuid
+import weakref
+from pathlib import Path
+
+import numpy as np
+
+from .slicing import SliceLayer
+
+
+class SlicedStructure:
+    """Compact container of the slicing of a structure. All the slices are stored in contiguous arrays with offsets
+    (CSR-style) instead of lists of per-layer arrays. The per-layer lists (get_slices etc.) are views into these arrays.
+
+    Attributes:
+        z_levels ((L,) array): z levels of the slices.
+        points ((N,2) array): Points of all the slices.
+        layer_offsets ((L+1,) array): Points of the slice i are points[layer_offsets[i]:layer_offsets[i+1]].
+        branch_ids ((N,) int32 array): Index of the branch (within its slice) of each point.
+        branch_offsets ((L+1,) array): Branches of the slice i are branches branch_offsets[i] to branch_offsets[i+1] in the branch arrays.
+        branch_lengths ((B,) array): Length of each branch.
+        branch_centroids ((B,2) array): Centroid of each branch.
+        connections ((C,) int32 array): Indices of the branches in the slice below to which the branches connect. None if not calculated.
+        connection_offsets ((B+1,) array): Connections of branch b are connections[connection_offsets[b]:connection_offsets[b+1]].
+        store_dir (Path): Directory of the on-disk store if the per-point arrays (points, branch_ids) are memory-mapped. None if in memory.
+    """
+
+    array_names = (
+        "z_levels",
+        "points",
+        "layer_offsets",
+        "branch_ids",
+        "branch_offsets",
+        "branch_lengths",
+        "branch_centroids",
+        "connections",
+        "connection_offsets",
+    )
+    # arrays with an entry per point, these are memory-mapped in the on-disk store
+    point_array_dtypes = {"points": np.float64, "branch_ids": np.int32}
+
+    def __init__(
+        self,
+        z_levels,
+        points,
+        layer_offsets,
+        branch_ids,
+        branch_offsets,
+        branch_lengths,
+        branch_centroids=None,
+        connections=None,
+        connection_offsets=None,
+    ):
+        self.z_levels = z_levels
+        self.points = points
+        self.layer_offsets = layer_offsets
+        self.branch_ids = branch_ids
+        self.branch_offsets = branch_offsets
+        self.branch_lengths = branch_lengths
+        if branch_centroids is None:
+            branch_centroids = self._get_branch_centroids()
+        self.branch_centroids = branch_centroids
+        self.connections = connections
+        self.connection_offsets = connection_offsets
+        self.store_dir = None
+        self._views = {}
+        # owner of the store written by apply_layer_transform, shared with the copies of this container
+        self._store_owner = None
+
+    @classmethod
+    def from_layers(cls, slice_layers, store_dir=None):
+        """Builds the container from slice records.
+
+        Args:
+            slice_layers (iterable of SliceLayer): Slices in order (e.g. Structure.iter_slices()).
+            store_dir (str, optional): If given, the points are written to an on-disk store in this directory as the slices are consumed
+                and the container memory-maps them (see open). Defaults to None.
+
+        Returns:
+            SlicedStructure
+        """
+        if store_dir is not None:
+            return cls._from_layers_to_store(slice_layers, store_dir)
+        layers = list(slice_layers)
+        layer_sizes = [lyr.points.shape[0] for lyr in layers]
+        branch_counts = [len(lyr.branch_lengths) for lyr in layers]
+        arrays = {
+            "z_levels": np.array([lyr.z for lyr in layers], dtype=float),
+            "points": _concatenate(
+                [lyr.points for lyr in layers], np.zeros((0, 2), dtype=float)
+            ),
+            "layer_offsets": _offsets(layer_sizes),
+            "branch_ids": _concatenate(
+                [lyr.branches for lyr in layers], np.zeros(0, dtype=np.int32)
+            ).astype(np.int32),
+            "branch_offsets": _offsets(branch_counts),
+            "branch_lengths": _concatenate(
+                [np.asarray(lyr.branch_lengths, dtype=float) for lyr in layers],
+                np.zeros(0, dtype=float),
+            ),
+        }
+        if all(lyr.branch_connections is not None for lyr in layers):
+            # the first slice has no connections, keep an empty entry for each of its branches
+            connections = [np.zeros(0, dtype=np.int32)] * sum(branch_counts[:1]) + [
+                np.asarray(conn, dtype=np.int32)
+                for lyr in layers[1:]
+                for conn in lyr.branch_connections
+            ]
+            arrays["connections"] = _concatenate(
+                connections, np.zeros(0, dtype=np.int32)
+            )
+            arrays["connection_offsets"] = _offsets([len(conn) for conn in connections])
+        return cls(**arrays)
+
+    @classmethod
+    def _from_layers_to_store(cls, slice_layers, store_dir):
+        """Streams the slice records into the on-disk store. Only the per-layer and per-branch data are kept in memory."""
+        store_dir = Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        z_levels, layer_sizes, branch_counts = [], [], []
+        branch_lengths, branch_centroids, connections = [], [], []
+        has_connections = True
+        # write to temporary files, so that the files of a store that is still mapped are not truncated
+        point_files = {
+            name: open(store_dir / (name + ".bin.tmp"), "wb")
+            for name in cls.point_array_dtypes
+        }
+        try:
+            for lyr in slice_layers:
+                points = np.ascontiguousarray(lyr.points, dtype=np.float64)
+                branches = np.asarray(lyr.branches, dtype=np.int32)
+                points.tofile(point_files["points"])
+                branches.tofile(point_files["branch_ids"])
+                z_levels.append(lyr.z)
+                layer_sizes.append(points.shape[0])
+                branch_counts.append(len(lyr.branch_lengths))
+                branch_lengths.append(np.asarray(lyr.branch_lengths, dtype=float))
+                branch_centroids.append(
+                    _branch_centroids(points, branches, branch_counts[-1])
+                )
+                if lyr.branch_connections is None:
+                    has_connections = False
+                elif has_connections:
+                    layer_connections = lyr.branch_connections
+                    if len(z_levels) == 1:
+                        layer_connections = [[]] * branch_counts[0]
+                    connections += [
+                        np.asarray(conn, dtype=np.int32) for conn in layer_connections
+                    ]
+        finally:
+            for f in point_files.values():
+                f.close()
+
+        arrays = {
+            "z_levels": np.array(z_levels, dtype=float),
+            "layer_offsets": _offsets(layer_sizes),
+            "branch_offsets": _offsets(branch_counts),
+            "branch_lengths": _concatenate(branch_lengths, np.zeros(0, dtype=float)),
+            "branch_centroids": _concatenate(
+                branch_centroids, np.zeros((0, 2), dtype=float)
+            ),
+        }
+        if has_connections:
+            arrays["connections"] = _concatenate(
+                connections, np.zeros(0, dtype=np.int32)
+            )
+            arrays["connection_offsets"] = _offsets([len(conn) for conn in connections])
+        for name in cls.point_array_dtypes:
+            os.replace(store_dir / (name + ".bin.tmp"), store_dir / (name + ".bin"))
+        # the layer data is written last and marks the store as complete
+        np.savez(store_dir / "layers.npz", **arrays)
+        return cls.open(store_dir)
+
+    @classmethod
+    def open(cls, store_dir):
+        """Opens the on-disk store created by from_layers. The per-point arrays are memory-mapped, so the slices are paged in when accessed.
+
+        Args:
+            store_dir (str): Directory of the store.
+
+        Returns:
+            SlicedStructure
+        """
+        store_dir = Path(store_dir)
+        with np.load(store_dir / "layers.npz") as data:
+            arrays = {name: data[name] for name in data.files}
+        n_points = arrays["layer_offsets"][-1]
+        arrays["points"] = _open_memmap(
+            store_dir / "points.bin", np.float64, (n_points, 2)
+        )
+        arrays["branch_ids"] = _open_memmap(
+            store_dir / "branch_ids.bin", np.int32, (n_points,)
+        )
+        sliced_structure = cls(**arrays)
+        sliced_structure.store_dir = store_dir
+        return sliced_structure
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Builds the container from a mapping of arrays (e.g. loaded .npz file). Inverse of to_arrays."""
+        return cls(**{name: arrays[name] for name in cls.array_names if name in arrays})
+
+    def to_arrays(self):
+        """Gets the dictionary of all the arrays defining the slicing (connections are only included if calculated)."""
+        return {
+            name: getattr(self, name)
+            for name in self.array_names
+            if getattr(self, name) is not None
+        }
+
+    @property
+    def n_layers(self) -> int:
+        """Number of slices."""
+        return self.z_levels.size
+
+    @property
+    def has_connections(self) -> bool:
+        """Whether the branch connections are calculated."""
+        return self.connections is not None
+
+    def layer_points(self, layer: int):
+        """Points of the slice (a view)."""
+        return self.points[self.layer_offsets[layer] : self.layer_offsets[layer + 1]]
+
+    def layer_branches(self, layer: int):
+        """Branch index of each point of the slice (a view)."""
+        return self.branch_ids[
+            self.layer_offsets[layer] : self.layer_offsets[layer + 1]
+        ]
+
+    def layer_branch_lengths(self, layer: int):
+        """Lengths of the branches of the slice (a view)."""
+        return self.branch_lengths[
+            self.branch_offsets[layer] : self.branch_offsets[layer + 1]
+        ]
+
+    def layer_branch_centroids(self, layer: int):
+        """Centroids of the branches of the slice (a view)."""
+        return self.branch_centroids[
+            self.branch_offsets[layer] : self.branch_offsets[layer + 1]
+        ]
+
+    def layer_connections(self, layer: int):
+        """For each branch in the slice, the branches in the slice below it connects to. Empty list for the first slice."""
+        if layer == 0:
+            return []
+        start, end = self.branch_offsets[layer], self.branch_offsets[layer + 1]
+        offsets = self.connection_offsets[start : end + 1]
+        return [
+            self.connections[offsets[j] : offsets[j + 1]]
+            for j in range(offsets.size - 1)
+        ]
+
+    def layer(self, layer: int):
+        """Gets the slice record of the slice."""
+        return SliceLayer(
+            layer,
+            self.z_levels[layer],
+            self.layer_points(layer),
+            self.layer_branches(layer),
+            self.layer_branch_lengths(layer),
+            self.layer_connections(layer) if self.has_connections else None,
+        )
+
+    def iter_layers(self):
+        """Iterates over the slice records."""
+        for i in range(self.n_layers):
+            yield self.layer(i)
+
+    def get_slices(self):
+        """List of views of the (n,2) points in each slice."""
+        return self._get_views("slices", self.layer_points)
+
+    def get_branches(self):
+        """List of views of the branch indices of the points in each slice."""
+        return self._get_views("branches", self.layer_branches)
+
+    def get_branch_lengths(self):
+        """List of views of the branch lengths in each slice."""
+        return self._get_views("branch_lengths", self.layer_branch_lengths)
+
+    def get_branch_connections(self):
+        """List of lists of views of the branch connections in each slice. None if not calculated."""
+        if not self.has_connections:
+            return None
+        return self._get_views("branch_connections", self.layer_connections)
+
+    def get_points3d(self):
+        """Gets all the points with the z level of their slice as a (N,3) array."""
+        z = np.repeat(self.z_levels, np.diff(self.layer_offsets))
+        return np.column_stack((self.points, z))
+
+    def apply_layer_transform(self, matrix):
+        """Applies a transform that keeps the layers (see structure.preserves_layers) to the slicing.
+        The on-disk stores are keyed by the mesh they were sliced from and can be shared by several structures, so they are never modified:
+        the transformed slicing of a stored structure is written to a new store (see transformed_store_dir). That store is shared by this container
+        and its copies in this process, and it is removed once all of them have been garbage collected or superseded by the next transform.
+        Pickled copies (e.g. sent to the parallel jobs) do not keep the store, so they must not outlive the containers of this process.
+
+        Args:
+            matrix ((4,4) array): Homogeneous transformation matrix.
+        """
+        xy_transform = matrix[:2, :2].T
+        xy_translation = matrix[:2, 3]
+        self.branch_centroids = self.branch_centroids @ xy_transform + xy_translation
+        self.z_levels = self.z_levels + matrix[2, 3]
+        self._views = {}
+        if self.store_dir is None:
+            self.points = self.points @ xy_transform + xy_translation
+            return
+        store_dir = self.transformed_store_dir()
+        store_dir.mkdir(parents=True)
+        # transform the mapped points a chunk at a time
+        chunk_size = 2**20
+        with open(store_dir / "points.bin.tmp", "wb") as f:
+            for start in range(0, self.points.shape[0], chunk_size):
+                chunk = self.points[start : start + chunk_size]
+                (chunk @ xy_transform + xy_translation).tofile(f)
+        np.asarray(self.branch_ids).tofile(store_dir / "branch_ids.bin.tmp")
+        for name in self.point_array_dtypes:
+            os.replace(store_dir / (name + ".bin.tmp"), store_dir / (name + ".bin"))
+        arrays = {
+            name: array
+            for name, array in self.to_arrays().items()
+            if name not in self.point_array_dtypes
+        }
+        # the layer data is written last and marks the store as complete
+        np.savez(store_dir / "layers.npz", **arrays)
+        stored = SlicedStructure.open(store_dir)
+        for name in self.point_array_dtypes:
+            setattr(self, name, getattr(stored, name))
+        self.store_dir = store_dir
+        # the store of the previous transform is removed with its owner, unless a copy still holds it
+        self._store_owner = _StoreOwner(store_dir)
+
+    def transformed_store_dir(self):
+        """Gets the directory of a new store of the transformed slicing: a sibling of the store with a unique name, so that it is not shared.
+
+        Returns:
+            Path
+        """
+        return self.store_dir.parent / "transformed-{}".format(uuid.uuid4().hex)
+
+    def _get_views(self, name, layer_view):
+        """Gets the list of views for each layer. The list is built once and kept."""
+        if name not in self._views:
+            self._views[name] = [layer_view(i) for i in range(self.n_layers)]
+        return self._views[name]
+
+    def _get_branch_centroids(self):
+        """Calculates the centroids of the branches from the points."""
+        layer_sizes = np.diff(self.layer_offsets)
+        point_branches = (
+            np.repeat(self.branch_offsets[:-1], layer_sizes) + self.branch_ids
+        )
+        return _branch_centroids(self.points, point_branches, self.branch_lengths.size)
+
+    def __getstate__(self):
+        # the views are rebuilt when needed
+        state = self.__dict__.copy()
+        state["_views"] = {}
+        # the mapped arrays are reopened from the store instead of being copied
+        if self.store_dir is not None:
+            for name in self.point_array_dtypes:
+                state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.store_dir is not None:
+            stored = SlicedStructure.open(self.store_dir)
+            for name in self.point_array_dtypes:
+                setattr(self, name, getattr(stored, name))
+
+
+class _StoreOwner:
+    """Removes a store written by apply_layer_transform when it is garbage collected. The owner is shared by the copies (copy.copy,
+    copy.deepcopy) of the container, so the store is removed after the last of them. Other processes cannot take part in the reference counting:
+    a pickled owner does not remove the store.
+    """
+
+    def __init__(self, store_dir=None):
+        # the files of the mapped arrays cannot be removed on some platforms, these are left behind
+        self._finalizer = (
+            None
+            if store_dir is None
+            else weakref.finalize(self, shutil.rmtree, store_dir, ignore_errors=True)
+        )
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (_StoreOwner, ())
+
+
+def _branch_centroids(points, point_branches, n_branches):
+    """Centroids of the branches given the branch index of each point."""
+    counts = np.bincount(point_branches, minlength=n_branches)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.column_stack(
+            [
+                np.bincount(point_branches, weights=points[:, k], minlength=n_branches)
+                / counts
+                for k in range(2)
+            ]
+        )
+
+
+def _open_memmap(path, dtype, shape):
+    """Memory-maps the raw array file read-only, since the stores are shared. Empty arrays cannot be mapped, so they are created in memory."""
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _concatenate(arrays, empty):
+    """Concatenates the arrays along the first axis, or gets the empty array if there are none (e.g. a structure with no slices)."""
+    return np.concatenate(arrays) if arrays else empty
+
+
+def _offsets(sizes):
+    """Offsets of consecutive blocks with the given sizes."""
+    return np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
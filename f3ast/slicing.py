@@ -1,28 +1,84 @@
+from collections import namedtuple
+
 import numpy as np
 import numpy.linalg as la
-from numba import config, njit, prange
+from numba import njit, prange
+from trimesh.constants import tol
+
+SliceLayer = namedtuple(
+    "SliceLayer",
+    ["index", "z", "points", "branches", "branch_lengths", "branch_connections"],
+)
+SliceLayer.__doc__ = """Record of a single slice of the structure.
 
-# set the threading layer before any parallel target compilation
-config.THREADING_LAYER = "threadsafe"
+Attributes:
+    index (int): Index of the slice.
+    z (float): z level of the slice.
+    points ((n,2) array): Points in the slice.
+    branches ((n,) array): Branch index of each point in the slice.
+    branch_lengths (list): Length of each of the branches.
+    branch_connections (list of arrays): For each branch, the branches of the previous slice it is connected to. None if the connectivity is not calculated.
+"""
 
 
-# @njit(parallel=True, fastmath=True)
+@njit(parallel=True)
 def _numba_eqd_pts(start_nodes, conn_vecs, n_steps):
-    pts = np.zeros((np.sum(n_steps), 2))
     end_indices = np.cumsum(n_steps)
-    start_indices = np.zeros(end_indices.shape[0]).astype(np.uint32)
-    start_indices[1:] = end_indices[:-1]
+    pts = np.zeros((np.sum(n_steps), 2))
     for i in prange(n_steps.shape[0]):
-        end_indx = end_indices[i]
-        start_indx = start_indices[i]
         n = n_steps[i]
-        pts[start_indx:end_indx, :] = (
-            start_nodes[i, :].reshape(1, -1)
-            + conn_vecs[i, :].reshape(1, -1) * np.arange(n).reshape(-1, 1) / n
-        )
+        start_indx = end_indices[i] - n
+        for j in range(n):
+            pts[start_indx + j, 0] = start_nodes[i, 0] + conn_vecs[i, 0] * j / n
+            pts[start_indx + j, 1] = start_nodes[i, 1] + conn_vecs[i, 1] * j / n
     return pts
 
 
+def _get_lines_eqd_pts(lines, pitch):
+    """Gets the equally spaced points along each of the lines and the number of points for each line."""
+    start_nodes = np.ascontiguousarray(lines[:, 0, :], dtype=float)
+    end_nodes = np.ascontiguousarray(lines[:, 1, :], dtype=float)
+
+    conn_vecs = end_nodes - start_nodes
+    conn_norms = la.norm(conn_vecs, axis=1)
+    n_steps = np.ceil(conn_norms / pitch).astype(np.int64)
+
+    return _numba_eqd_pts(start_nodes, conn_vecs, n_steps), n_steps
+
+
+def _unique_lattice_pts(pts, pitch, labels=None):
+    """Snaps the points onto the lattice with spacing pitch and removes the duplicates.
+    Instead of sorting float rows, each lattice point is encoded as a single integer key.
+    The output is sorted by label and then lexicographically by (x, y).
+
+    Args:
+        pts ((n,2) array): Points to snap.
+        pitch (float): Lattice spacing.
+        labels ((n,) int array, optional): Label of each point. Points with different labels are never merged.
+
+    Returns:
+        tuple: (m,2) array of unique lattice points, (m,) array of their labels
+    """
+    if labels is None:
+        labels = np.zeros(pts.shape[0], dtype=np.int64)
+    if pts.shape[0] == 0:
+        return np.zeros((0, 2)), labels.astype(np.int64)
+    keys = np.round(pts / pitch).astype(np.int64)
+    kmin = keys.min(axis=0)
+    span = keys.max(axis=0) - kmin + 1
+    flat_keys = (labels.astype(np.int64) * span[0] + (keys[:, 0] - kmin[0])) * span[
+        1
+    ] + (keys[:, 1] - kmin[1])
+    flat_keys = np.unique(flat_keys)
+
+    unique_keys = np.empty((flat_keys.shape[0], 2), dtype=np.int64)
+    unique_keys[:, 1] = flat_keys % span[1] + kmin[1]
+    flat_keys //= span[1]
+    unique_keys[:, 0] = flat_keys % span[0] + kmin[0]
+    unique_labels = flat_keys // span[0]
+    return unique_keys * pitch, unique_labels
+
+
 def get_line_eqd_pts(lines, pitch):
     """Gets the line points that are on a grid with spacing pitch.
 
@@ -33,19 +89,221 @@ def get_line_eqd_pts(lines, pitch):
     Returns:
         (n,2) array: Points out on the grid.
     """
+    pts, _ = _get_lines_eqd_pts(lines, pitch)
+    pts_unique, _ = _unique_lattice_pts(pts, pitch)
+    return pts_unique
 
-    start_nodes = np.ascontiguousarray(lines[:, 0, :])
-    end_nodes = np.ascontiguousarray(lines[:, 1, :])
 
-    conn_vecs = end_nodes - start_nodes
-    conn_norms = la.norm(conn_vecs, axis=1)
-    n_steps = np.ceil(conn_norms / pitch).astype(np.int32)
+def get_slice_eqd_pts(branch_intersections, pitch):
+    """Gets the points on a grid with spacing pitch for all the branches of a slice at once.
+    Gives the same points as calling get_line_eqd_pts on each branch separately.
+
+    Args:
+        branch_intersections (list of (k,2,2) arrays): For each branch, array of lines in that branch.
+        pitch (float): Distance on the grid.
 
-    pts = _numba_eqd_pts(start_nodes, conn_vecs, n_steps)
+    Returns:
+        tuple: (n,2) array of points, (n,) array of branch indices, (m,) array of branch lengths
+    """
+    n_branches = len(branch_intersections)
+    lines = np.concatenate(branch_intersections, axis=0)
+    line_branches = np.repeat(
+        np.arange(n_branches), [len(br) for br in branch_intersections]
+    )
 
-    pts_unique = np.unique(np.round(pts / pitch) * pitch, axis=0)
+    pts, n_steps = _get_lines_eqd_pts(lines, pitch)
+    pts, branches = _unique_lattice_pts(pts, pitch, np.repeat(line_branches, n_steps))
 
-    return pts_unique
+    # the branch length is the path length through the (sorted) points of the branch
+    steps = la.norm(pts[1:, :] - pts[:-1, :], axis=1)
+    same_branch = branches[1:] == branches[:-1]
+    branch_lengths = np.bincount(
+        branches[1:][same_branch], weights=steps[same_branch], minlength=n_branches
+    )
+    return pts, branches, branch_lengths
+
+
+def get_adaptive_z_levels(
+    triangles, face_normals, min_dz, max_dz, max_shift, minz=None, maxz=None
+):
+    """Gets non-uniformly spaced z levels. The layer thickness is chosen so that the cross-section of the mesh
+    moves by at most max_shift in the xy plane between the layers, but is kept within [min_dz, max_dz].
+    This gives thick layers on (near) vertical walls and thin layers on overhangs.
+
+    Args:
+        triangles ((n,3,3) array): Triangles of the mesh.
+        face_normals ((n,3) array): Unit normals of the triangles.
+        min_dz (float): Minimal layer thickness.
+        max_dz (float): Maximal layer thickness.
+        max_shift (float): Maximal shift of the cross-section in the xy plane between two layers.
+        minz (float, optional): Lowest z level. Defaults to the bottom of the mesh.
+        maxz (float, optional): Upper bound of the z levels. Defaults to the top of the mesh.
+
+    Returns:
+        array: Array of z levels.
+    """
+    faces_minz = triangles[:, :, 2].min(axis=1)
+    faces_maxz = triangles[:, :, 2].max(axis=1)
+    minz = faces_minz.min() if minz is None else minz
+    maxz = faces_maxz.max() if maxz is None else maxz
+    # horizontal faces are steps in the cross-section that thinner layers would not resolve anyway
+    sloped = faces_maxz > faces_minz
+    faces_minz, faces_maxz = faces_minz[sloped], faces_maxz[sloped]
+    face_normals = face_normals[sloped]
+
+    # thickest layer allowed by each face: the cross-section moves by dz * tan(angle to vertical)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        faces_tan = np.abs(face_normals[:, 2]) / la.norm(face_normals[:, :2], axis=1)
+        faces_dz = np.clip(np.nan_to_num(max_shift / faces_tan, nan=max_dz), 0, max_dz)
+
+    # thickest layer allowed in each cell of a grid finer than min_dz
+    cell_dz = min_dz / 4
+    n_cells = int(np.ceil((maxz - minz) / cell_dz)) + 1
+    first_cells = np.clip((faces_minz - minz) // cell_dz, 0, n_cells - 1).astype(int)
+    last_cells = np.clip((faces_maxz - minz) // cell_dz, 0, n_cells - 1).astype(int)
+    cell_counts = last_cells - first_cells + 1
+    face_cells = np.repeat(
+        first_cells - np.cumsum(cell_counts) + cell_counts, cell_counts
+    )
+    face_cells += np.arange(face_cells.size)
+    cells_dz = np.full(n_cells, float(max_dz))
+    np.minimum.at(cells_dz, face_cells, np.repeat(faces_dz, cell_counts))
+
+    # walk up and take the thickest layer that none of the cells it covers objects to
+    min_cells = 4
+    max_cells = int(np.floor(max_dz / cell_dz + 1e-9))
+    z_levels = []
+    cell = 0
+    while minz + cell * cell_dz < maxz:
+        z_levels.append(minz + cell * cell_dz)
+        allowed_dz = np.minimum.accumulate(cells_dz[cell : cell + max_cells])
+        n = np.count_nonzero(
+            allowed_dz * (1 + 1e-9) >= cell_dz * np.arange(1, allowed_dz.size + 1)
+        )
+        cell += max(n, min_cells)
+    return np.array(z_levels)
+
+
+def get_multiplane_intersections(vertices, faces, z_levels):
+    """Intersects the triangles with horizontal planes at the given z levels.
+    Instead of testing every plane against every face, the range of planes crossed by each face is found from its z-extent
+    with a binary search over the sorted levels, so the cost scales with the number of faces plus the number of segments.
+    Gives the same segments in the same order as trimesh.intersections.mesh_multiplane.
+
+    Args:
+        vertices ((n,3) array): Mesh vertices.
+        faces ((m,3) int array): Mesh faces.
+        z_levels (array): z levels of the planes.
+
+    Returns:
+        list of arrays: For each z level, a (k,2,2) array of the intersection lines as start_node-end_node.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    z_levels = np.asarray(z_levels, dtype=np.float64).reshape(-1)
+    n_levels = z_levels.size
+    if n_levels == 0:
+        return []
+
+    # range of the sorted levels crossed by each face, with a margin for the on-plane tolerance
+    level_order = np.argsort(z_levels, kind="stable")
+    sorted_levels = z_levels[level_order]
+    faces_z = vertices[:, 2][faces]
+    first_levels = np.searchsorted(sorted_levels, faces_z.min(axis=1) - 2 * tol.merge)
+    last_levels = np.searchsorted(
+        sorted_levels, faces_z.max(axis=1) + 2 * tol.merge, side="right"
+    )
+    level_counts = np.maximum(last_levels - first_levels, 0)
+
+    # (face, level) pairs of the faces active at each level
+    pair_faces = np.repeat(np.arange(faces.shape[0]), level_counts)
+    pair_levels = np.repeat(
+        first_levels - np.cumsum(level_counts) + level_counts, level_counts
+    )
+    pair_levels += np.arange(pair_levels.size)
+    pair_levels = level_order[pair_levels]
+
+    # sign of each vertex with respect to the plane, classified as in mesh_plane
+    dots = faces_z[pair_faces] - z_levels[pair_levels, None]
+    signs = np.zeros(dots.shape, dtype=np.int8)
+    signs[dots < -tol.merge] = -1
+    signs[dots > tol.merge] = 1
+    coded = 14 + (np.sort(signs, axis=1).astype(np.int64) << np.array([3, 2, 1])).sum(
+        axis=1
+    )
+    # 0: one vertex on one side and two on the other, 1: one vertex on the plane, 2: one edge on the plane
+    case_key = np.full(29, -1)
+    case_key[[4, 12]] = 0
+    case_key[8] = 1
+    case_key[16] = 2
+    cases = case_key[coded]
+    keep = cases >= 0
+    pair_faces, pair_levels = pair_faces[keep], pair_levels[keep]
+    signs, dots, cases = signs[keep], dots[keep], cases[keep]
+
+    # mesh_plane orders the segments by case and then by face
+    order = np.lexsort((pair_faces, cases, pair_levels))
+    pair_faces, pair_levels = pair_faces[order], pair_levels[order]
+    signs, dots, cases = signs[order], dots[order], cases[order]
+    face_vertices = faces[pair_faces]
+
+    lines = np.empty((pair_faces.size, 2, 2))
+    rows = np.arange(pair_faces.size)
+
+    def interpolate(mask, start, end):
+        # intersection of the edge start -> end with the plane
+        start_vertices = face_vertices[mask, start]
+        end_vertices = face_vertices[mask, end]
+        start_dots = dots[mask, start]
+        t = start_dots / (start_dots - dots[mask, end])
+        start_xy = vertices[start_vertices, :2]
+        return start_xy + t[:, None] * (vertices[end_vertices, :2] - start_xy)
+
+    # one vertex on one side and two on the other: segment between the two edges of the lone vertex
+    basic = cases == 0
+    lone = np.argmax(signs[basic] != np.median(signs[basic], axis=1)[:, None], axis=1)
+    lines[basic, 0] = interpolate(basic, lone, (lone + 1) % 3)
+    lines[basic, 1] = interpolate(basic, lone, (lone + 2) % 3)
+
+    # one vertex on the plane: segment from it to the opposite edge
+    on_vertex = cases == 1
+    on_plane = np.argmax(signs[on_vertex] == 0, axis=1)
+    lines[on_vertex, 0] = vertices[face_vertices[on_vertex, on_plane], :2]
+    off_plane = np.sort(
+        np.stack(((on_plane + 1) % 3, (on_plane + 2) % 3), axis=1), axis=1
+    )
+    lines[on_vertex, 1] = interpolate(on_vertex, off_plane[:, 0], off_plane[:, 1])
+
+    # one edge on the plane: the edge itself
+    on_edge = cases == 2
+    edge = np.sort(
+        np.argsort(signs[on_edge] != 0, axis=1, kind="stable")[:, :2], axis=1
+    )
+    lines[on_edge] = vertices[face_vertices[rows[on_edge, None], edge], :2]
+
+    level_offsets = np.cumsum(np.bincount(pair_levels, minlength=n_levels))
+    return np.split(lines, level_offsets[:-1])
+
+
+def get_mesh_intersection_lines(mesh, z_levels):
+    """Intersects the mesh with horizontal planes at the given z levels.
+
+    Args:
+        mesh (trimesh.Trimesh): Mesh to intersect.
+        z_levels (array): z levels of the planes.
+
+    Returns:
+        intersection_lines (list of arrays): A list of (n,2,2) arrays representing the intersection lines as start_node-end_node
+        z_levels (array): Array of z levels corresponding to the intersections. Levels with empty intersections are dropped.
+    """
+    intersection_lines = get_multiplane_intersections(
+        mesh.vertices, mesh.faces, z_levels
+    )
+    # drop the empty intersections
+    nonempty = np.array([len(inter) != 0 for inter in intersection_lines]).astype(bool)
+    z_levels = np.asarray(z_levels)[nonempty].flatten()
+    intersection_lines = [inter for inter in intersection_lines if len(inter) != 0]
+    return intersection_lines, z_levels
 
 
 # def get_lines_length(lines):
@@ -79,16 +337,9 @@ def split_eqd(branch_intersections_slices, pitch):
     branches = []
     branch_lengths = []
     for branch_intersections in branch_intersections_slices:
-        branches_pts = [
-            get_line_eqd_pts(lines, pitch) for lines in branch_intersections
-        ]
-
-        slices.append(np.vstack(branches_pts))
-        branches.append(
-            np.concatenate(
-                [i * np.ones(brpts.shape[0]) for i, brpts in enumerate(branches_pts)]
-            )
-        )
-        # defining the branch length can be a bit tricky. Here I use the total distance along a path in branches_pts, but this might not be absolutely correct for all structures
-        branch_lengths.append([get_path_length(pts) for pts in branches_pts])
+        # defining the branch length can be a bit tricky. Here I use the total distance along a path in branch points, but this might not be absolutely correct for all structures
+        pts, branch, brlens = get_slice_eqd_pts(branch_intersections, pitch)
+        slices.append(pts)
+        branches.append(branch.astype(np.int32))
+        branch_lengths.append(brlens)
     return slices, branches, branch_lengths
@@ -0,0 +1,101 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .sliced_structure import SlicedStructure
+from .version import __version__
+
+
+def get_slicing_key(vertices, faces, pitch, **slicing_parameters):
+    """Gets the key identifying the slicing of a mesh.
+
+    Args:
+        vertices ((n,3) array): Mesh vertices.
+        faces ((m,3) array): Mesh faces.
+        pitch (float): Pitch for the slicing.
+        **slicing_parameters: Any other parameters that change the slicing.
+
+    Returns:
+        str: Hex digest of the hash of the mesh content, pitch and f3ast version.
+    """
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(vertices, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(faces, dtype=np.int64).tobytes())
+    h.update(repr(float(pitch)).encode())
+    for name in sorted(slicing_parameters):
+        h.update("{}={!r}".format(name, slicing_parameters[name]).encode())
+    h.update(__version__.encode())
+    return h.hexdigest()
+
+
+class SlicingCache:
+    """On-disk cache of the slicing results. Each entry is a single uncompressed .npz file with the arrays of a SlicedStructure.
+    When the total size of the cache exceeds max_size, the least recently used entries are removed.
+
+    Attributes:
+        directory (Path): Directory of the cache.
+        max_size (int): Maximum size of the cache in bytes.
+    """
+
+    def __init__(self, directory, max_size=2**31):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def get_path(self, key):
+        """Path of the cache entry with the given key."""
+        return self.directory / (key + ".npz")
+
+    def load(self, key):
+        """Loads the slicing from the cache.
+
+        Args:
+            key (str): Key of the entry (see get_slicing_key).
+
+        Returns:
+            SlicedStructure: The cached slicing. None if the entry does not exist.
+        """
+        path = self.get_path(key)
+        try:
+            with np.load(path) as data:
+                sliced_structure = SlicedStructure.from_arrays(data)
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return None
+        # mark as recently used
+        os.utime(path)
+        return sliced_structure
+
+    def save(self, key, sliced_structure):
+        """Saves the slicing to the cache and evicts the old entries if the cache is too large.
+
+        Args:
+            key (str): Key of the entry (see get_slicing_key).
+            sliced_structure (SlicedStructure): The slicing to save.
+        """
+        path = self.get_path(key)
+        # write to a temporary file first so that a partially written entry is never loaded
+        tmp_path = path.with_suffix(".tmp.npz")
+        np.savez(tmp_path, **sliced_structure.to_arrays())
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is within max_size. The most recently used entry is always kept."""
+        entries = sorted(
+            (p.stat().st_mtime, p.stat().st_size, p)
+            for p in self.directory.glob("*.npz")
+            if not p.name.endswith(".tmp.npz")
+        )
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries[:-1]:
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+    def clear(self):
+        """Removes all the entries from the cache."""
+        for path in self.directory.glob("*.npz"):
+            path.unlink(missing_ok=True)
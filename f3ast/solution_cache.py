@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def get_solution_key(points, layer_factors, parameters, options):
+    """Gets the key identifying the solution of a layer: a hash of everything that the solution depends on.
+
+    Args:
+        points ((n,2) array): Points of the layer.
+        layer_factors (tuple): Per-layer factors of the model, scalars or per-point arrays (see Model.get_layer_factors).
+        parameters (dict): Parameters of the model (see Model.get_parameters).
+        options (dict): Options of the solver, including the layer height and the tolerance.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    key = hashlib.sha1()
+    key.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+    for factor in layer_factors:
+        factor = np.asarray(factor, dtype=np.float64)
+        key.update(repr(factor.shape).encode())
+        key.update(np.ascontiguousarray(factor).tobytes())
+    key.update(repr(sorted(parameters.items())).encode())
+    key.update(repr(sorted(options.items())).encode())
+    return key.hexdigest()
+
+
+class SolutionCache:
+    """Cache of the solved dwell times of the layers, keyed by get_solution_key. The solutions are kept in memory, and the least recently used
+    are removed when their total size exceeds max_size. If a directory is given, the solutions are also saved there, so they persist between runs.
+    The cache can be shared between threads.
+
+    Attributes:
+        max_size (int): Maximum size of the solutions kept in memory in bytes. 0 disables the in-memory tier.
+        directory (str): Directory of the on-disk tier. None disables it.
+    """
+
+    def __init__(self, max_size=2**28, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self.clear()
+
+    @property
+    def size(self):
+        """Total size of the solutions in memory in bytes."""
+        return self._size
+
+    def get_path(self, key):
+        """Path of the file of the solution in the on-disk tier."""
+        return os.path.join(self.directory, key + ".npy")
+
+    def load(self, key):
+        """Gets the solution from the cache, looking in memory first and then on the disk.
+
+        Args:
+            key (str): Key of the solution.
+
+        Returns:
+            (n,) array: Dwell times (a copy, so it can be modified). None if the solution is not cached.
+        """
+        with self._lock:
+            dwell_times = self._entries.get(key)
+            if dwell_times is not None:
+                self._entries.move_to_end(key)
+                return dwell_times.copy()
+        if self.directory is None or not os.path.exists(self.get_path(key)):
+            return None
+        dwell_times = np.load(self.get_path(key))
+        self._save_memory(key, dwell_times)
+        return dwell_times.copy()
+
+    def save(self, key, dwell_times):
+        """Saves the solution in memory and on the disk, evicting the old entries from memory if the cache is too large.
+
+        Args:
+            key (str): Key of the solution.
+            dwell_times ((n,) array): Dwell times.
+        """
+        dwell_times = np.array(dwell_times, dtype=np.float64)
+        self._save_memory(key, dwell_times)
+        if self.directory is not None:
+            # write to a temporary file first, so that an interrupted run does not leave a truncated solution
+            temporary_path = self.get_path(key) + ".{}.tmp".format(os.getpid())
+            with open(temporary_path, "wb") as f:
+                np.save(f, dwell_times)
+            os.replace(temporary_path, self.get_path(key))
+
+    def _save_memory(self, key, dwell_times):
+        if dwell_times.nbytes > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = dwell_times
+            self._size += dwell_times.nbytes
+            while self._size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes
+
+    def clear(self):
+        """Removes all the solutions from memory. The on-disk tier is kept."""
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # the solutions in memory are not pickled
+        return {"max_size": self.max_size, "directory": self.directory}
+
+    def __setstate__(self, state):
+        self.max_size = state["max_size"]
+        self.directory = state["directory"]
+        self._lock = threading.Lock()
+        self.clear()
@@ -1,12 +1,75 @@
+import copy
 import time
+from collections import deque, namedtuple
 from datetime import timedelta
 
 import numpy as np
-from joblib import Parallel, delayed
-from scipy.optimize import lsq_linear
+from joblib import Parallel, cpu_count, delayed
+from scipy.optimize import lsq_linear, minimize
+from scipy.sparse.csgraph import connected_components
 from scipy.spatial import KDTree
 
+from .bounded_lsq import bounded_lsq_cd
+from .checkpoint import SolveCheckpoint
+from .compact_matrix import (
+    COMPACT_DTYPES,
+    SymmetricMatrix,
+    get_matrix_nnz,
+    get_submatrix,
+)
+from .distance_cache import get_search_time
 from .plotting import plot_dwells
+from .solution_cache import SolutionCache, get_solution_key
+
+# methods for solving the layers. The compiled coordinate descent releases the GIL, so it runs in threads.
+# It also has a small overhead per call, so splitting the layers into their components pays off.
+SOLVER_METHODS = ("lsq_linear", "lbfgsb", "coordinate_descent")
+NOGIL_METHODS = ("coordinate_descent",)
+SPLIT_METHODS = ("coordinate_descent",)
+# methods that need the full rows of the proximity matrices, so storing only the upper triangle of the symmetric ones saves no memory
+FULL_ROW_METHODS = ("coordinate_descent",)
+# components with fewer points are solved together
+MIN_COMPONENT_POINTS = 32
+# record of the solution of a layer (see DwellSolver.layer_stats)
+LAYER_STATS_DTYPE = np.dtype(
+    [
+        ("layer", np.int64),
+        ("n_points", np.int64),
+        ("nnz", np.int64),
+        ("search_time", np.float64),
+        ("proximity_time", np.float64),
+        ("solve_time", np.float64),
+        ("n_iter", np.int64),
+        ("converged", np.bool_),
+        ("residual", np.float64),
+        ("at_lower", np.float64),
+        ("at_upper", np.float64),
+        ("cached", np.bool_),
+    ]
+)
+SolveInfo = namedtuple("SolveInfo", ["n_iter", "converged"])
+SolveInfo.__doc__ = """Information about the solution of a layer.
+
+Attributes:
+    n_iter (int): Number of iterations of the solver. For the layers split into components or tiles, the largest number of any of the parts.
+    converged (bool): Whether the solver reached its tolerance (in all the parts).
+"""
+# joblib backends of the parallel execution
+PARALLEL_BACKENDS = {
+    "serial": "sequential",
+    "threads": "threading",
+    "processes": "multiprocessing",
+    "loky": "loky",
+}
+
+
+def get_return_as(backend, ordered=True):
+    """Gets how joblib should return the results: as a generator, so they are processed as they arrive,
+    except for the multiprocessing backend, which only returns lists. If not ordered, the results are returned as soon as they are completed.
+    """
+    if backend == "multiprocessing":
+        return "list"
+    return "generator" if ordered else "generator_unordered"
 
 
 def get_distance_matrix(sl, threshold):
@@ -23,60 +86,1178 @@ def get_distance_matrix(sl, threshold):
     return tree.sparse_distance_matrix(tree, threshold, output_type="coo_matrix")
 
 
+def map_solution(points_below, dwell_times_below, points):
+    """Maps the solution of the layer below onto the points of the layer by taking the dwell time of the nearest point.
+
+    Args:
+        points_below ((m,2) array): Points of the layer below.
+        dwell_times_below ((m,) array): Dwell times of the layer below.
+        points ((n,2) array): Points of the layer.
+
+    Returns:
+        (n,) array: Dwell times at the points of the layer.
+    """
+    _, nearest = KDTree(points_below).query(points)
+    return dwell_times_below[nearest]
+
+
+def get_layer_chunks(layer_sizes, chunk_points):
+    """Batches consecutive layers into chunks with at least chunk_points points, so that small layers do not each pay the overhead of a parallel task.
+    Layers with more points than chunk_points are in chunks of their own.
+
+    Args:
+        layer_sizes (array): Number of points in each layer.
+        chunk_points (int): Minimal number of points in a chunk (apart from the last one).
+
+    Returns:
+        list of ranges: Layers in each chunk.
+    """
+    chunks = []
+    start = 0
+    n_points = 0
+    for layer, size in enumerate(layer_sizes):
+        n_points += size
+        if n_points >= chunk_points:
+            chunks.append(range(start, layer + 1))
+            start = layer + 1
+            n_points = 0
+    if start < len(layer_sizes):
+        chunks.append(range(start, len(layer_sizes)))
+    return chunks
+
+
+def get_upper_bound(proximity_matrix, dz):
+    """Gets the upper bound of the dwell times of a layer. We can never have larger dwell times than if there was no proximity (proximity matrix was diagonal).
+
+    Args:
+        proximity_matrix (sparse matrix): Proximity matrix of the layer.
+        dz (float): Layer height.
+
+    Returns:
+        (n,) array: Upper bound of the dwell times (in float64 also for the float32 matrices).
+    """
+    return dz / proximity_matrix.diagonal().astype(np.float64)
+
+
+def get_solution_quality(proximity_matrix, dz, dwell_times, with_residual=True):
+    """Gets how well the dwell times solve the proximity problem of the layer.
+
+    Args:
+        proximity_matrix (sparse matrix): Proximity matrix of the layer.
+        dz (float): Layer height.
+        dwell_times ((n,) array): Solution of the layer.
+        with_residual (bool, optional): If false, the residual, which needs the product with the proximity matrix, is nan. Defaults to True.
+
+    Returns:
+        tuple: root mean square of the height error relative to dz, fraction of the points at the lower bound (zero)
+            and fraction of the points at the upper bound
+    """
+    n_points = dwell_times.size
+    if n_points == 0:
+        return 0.0, 0.0, 0.0
+    upper_bound = get_upper_bound(proximity_matrix, dz)
+    residual = np.nan
+    if with_residual:
+        residual = np.linalg.norm(proximity_matrix @ dwell_times - dz) / (
+            dz * np.sqrt(n_points)
+        )
+    at_lower = np.count_nonzero(dwell_times <= 0) / n_points
+    at_upper = np.count_nonzero(dwell_times >= upper_bound * (1 - 1e-9)) / n_points
+    return residual, at_lower, at_upper
+
+
+def get_cached_layer_stats(layers, layer_sizes):
+    """Gets the statistics records (see DwellSolver.layer_stats) of layers that were taken from the solution cache or the checkpoint,
+    which have no solve statistics: their nnz and n_iter are -1 and the times and the solution quality are nan.
+
+    Args:
+        layers (array): Indices of the layers.
+        layer_sizes (array): Number of points in each layer.
+
+    Returns:
+        structured array: Records with LAYER_STATS_DTYPE.
+    """
+    layer_stats = np.zeros(len(layers), dtype=LAYER_STATS_DTYPE)
+    layer_stats["layer"] = layers
+    layer_stats["n_points"] = layer_sizes
+    layer_stats["cached"] = True
+    layer_stats["converged"] = True
+    for field in ("nnz", "n_iter"):
+        layer_stats[field] = -1
+    for field in (
+        "search_time",
+        "proximity_time",
+        "solve_time",
+        "residual",
+        "at_lower",
+        "at_upper",
+    ):
+        layer_stats[field] = np.nan
+    return layer_stats
+
+
+def get_layer_runs(mask):
+    """Gets the runs of consecutive layers where the mask is true.
+
+    Args:
+        mask ((n,) bool array): Mask of the layers.
+
+    Returns:
+        list of ranges: Layers in each run.
+    """
+    edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+    return [
+        range(start, stop)
+        for start, stop in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+    ]
+
+
+def get_layer_components(proximity_matrix, min_points=1):
+    """Splits the points of a layer into the connected components of the proximity matrix.
+    Points in different components do not interact (e.g. separate branches), so each component can be solved on its own.
+
+    Args:
+        proximity_matrix (sparse matrix): Proximity matrix of the layer.
+        min_points (int, optional): Components with fewer points are joined together, since solving many tiny systems costs more than
+            solving them as one (block diagonal) system. Defaults to 1.
+
+    Returns:
+        list of arrays: Indices of the points in each component.
+    """
+    if isinstance(proximity_matrix, SymmetricMatrix):
+        proximity_matrix = proximity_matrix.upper
+    n_components, labels = connected_components(proximity_matrix, directed=False)
+    if n_components == 1:
+        return [np.arange(proximity_matrix.shape[0])]
+    component_sizes = np.bincount(labels)
+    # join the small components into the component with the label n_components
+    small = component_sizes < min_points
+    if small.sum() > 1:
+        labels = np.where(small[labels], n_components, labels)
+        component_sizes = np.bincount(labels)
+    points_order = np.argsort(labels, kind="stable")
+    components = np.split(points_order, np.cumsum(component_sizes)[:-1])
+    return [component for component in components if component.size > 0]
+
+
+def get_layer_tiles(points, tile_size, halo):
+    """Partitions the points of a layer into square tiles. Each tile is extended by a halo, so that its interior points
+    see all their neighbours when the tile is solved on its own. The points are binned once into a grid of the tiles,
+    so the halo points of a tile are only searched for in the neighbouring cells.
+
+    Args:
+        points ((n,2) array): Points of the layer.
+        tile_size (float): Side of the tiles.
+        halo (float): Width of the halo around each tile. It should be at least the range of the proximity function.
+
+    Returns:
+        list of tuples: For each nonempty tile, the indices of its interior points and of its points including the halo
+    """
+    origin = points.min(axis=0)
+    cells = np.floor((points - origin) / tile_size).astype(np.int64)
+    n_cells = cells.max(axis=0) + 1
+    cell_labels = cells[:, 0] * n_cells[1] + cells[:, 1]
+    points_order = np.argsort(cell_labels, kind="stable")
+    unique_labels, starts = np.unique(cell_labels[points_order], return_index=True)
+    stops = np.append(starts[1:], points.shape[0])
+    tiles = []
+    for start, stop in zip(starts, stops):
+        interior = points_order[start:stop]
+        lower = points[interior].min(axis=0) - halo
+        upper = points[interior].max(axis=0) + halo
+        # the cells overlapping the tile with its halo
+        lower_cell = np.maximum(np.floor((lower - origin) / tile_size), 0).astype(
+            np.int64
+        )
+        upper_cell = np.minimum(
+            np.floor((upper - origin) / tile_size), n_cells - 1
+        ).astype(np.int64)
+        near_labels = (
+            np.arange(lower_cell[0], upper_cell[0] + 1)[:, np.newaxis] * n_cells[1]
+            + np.arange(lower_cell[1], upper_cell[1] + 1)
+        ).ravel()
+        near_cells = np.minimum(
+            np.searchsorted(unique_labels, near_labels), unique_labels.size - 1
+        )
+        near_cells = near_cells[unique_labels[near_cells] == near_labels]
+        candidates = np.concatenate(
+            [points_order[starts[cell] : stops[cell]] for cell in near_cells]
+        )
+        inside = np.all(
+            (points[candidates] >= lower) & (points[candidates] <= upper), axis=1
+        )
+        tiles.append((interior, np.sort(candidates[inside])))
+    return tiles
+
+
+class TiledProximityMatrix:
+    """Proximity matrix of a layer which is never built as a whole. The matrix of each tile (its points with the halo) is built from the points
+    when it is needed, so only the matrices of the tiles being processed are in memory, at the cost of building them again for each use.
+    With a halo at least as wide as the range of the proximity function, the rows of the interior points of a tile are complete,
+    so the products with the layer matrix and its diagonal are assembled from the interior rows of the tiles.
+    The diagonal and the number of entries are recorded from the tile matrices built for the solve (see record_tile_rows),
+    so that the statistics of the layer do not build them again. Only the products with the layer matrix need the tiles to be built again.
+
+    Attributes:
+        get_tile_matrix (callable): Function building the matrix of the points with the given sorted indices.
+        shape (tuple): Shape of the layer matrix.
+        tiles (list of tuples): Interior and extended indices of the tiles (see get_layer_tiles).
+        n_jobs (int): Number of threads building the tile matrices.
+    """
+
+    def __init__(self, get_tile_matrix, n_points, tiles, n_jobs=1):
+        self.get_tile_matrix = get_tile_matrix
+        self.shape = (n_points, n_points)
+        self.tiles = tiles
+        self.n_jobs = n_jobs
+        self._diagonal = np.zeros(n_points)
+        # number of the entries in each row, -1 until the row is recorded
+        self._row_nnz = np.full(n_points, -1, dtype=np.int64)
+
+    def submatrix(self, index):
+        """Gets the submatrix of the rows and columns of the index, which must be sorted."""
+        return self.get_tile_matrix(index)
+
+    def map_tiles(self, fun):
+        """Calls fun(tile_matrix, rows, interior, extended) for each tile, where rows are the interior rows of the tile matrix.
+
+        Returns:
+            list: Results for each tile.
+        """
+
+        def tile_task(interior, extended):
+            return fun(
+                self.get_tile_matrix(extended),
+                np.searchsorted(extended, interior),
+                interior,
+                extended,
+            )
+
+        return Parallel(n_jobs=self.n_jobs, backend="threading")(
+            delayed(tile_task)(interior, extended) for interior, extended in self.tiles
+        )
+
+    def record_tile_rows(self, tile_matrix, rows, interior, _extended=None):
+        """Records the diagonal and the number of entries of the interior rows of a tile matrix. The tiles can be recorded from parallel threads."""
+        tile_matrix = tile_matrix.tocsr()
+        self._diagonal[interior] = tile_matrix.diagonal()[rows]
+        self._row_nnz[interior] = np.diff(tile_matrix.indptr)[rows]
+
+    def _record_rows(self):
+        # builds the tiles only if the rows were not recorded by a solve
+        if np.any(self._row_nnz < 0):
+            self.map_tiles(self.record_tile_rows)
+
+    @property
+    def nnz(self):
+        """Number of the non-zero entries of the layer matrix."""
+        self._record_rows()
+        return int(self._row_nnz.sum())
+
+    def diagonal(self):
+        self._record_rows()
+        return self._diagonal
+
+    def __matmul__(self, x):
+        x = np.asarray(x, dtype=np.float64)
+
+        def tile_product(tile_matrix, rows, _interior, extended):
+            return (tile_matrix @ x[extended])[rows]
+
+        results = self.map_tiles(tile_product)
+        y = np.zeros(self.shape[0])
+        for (interior, _), tile_y in zip(self.tiles, results):
+            y[interior] = tile_y
+        return y
+
+    def dot(self, x):
+        return self @ x
+
+
+def get_tiled_proximity_matrix(model, slice_layer, layer_arguments, tiles, n_jobs=1):
+    """Gets the proximity matrix of a slice as a TiledProximityMatrix, whose tile matrices are built by the model from the points of the tiles.
+
+    Args:
+        model (Model): Model of the deposit.
+        slice_layer (SliceLayer): Record of the slice.
+        layer_arguments (tuple): Extra arguments of get_slice_proximity_matrix for the slice. The arrays with a value for each point are
+            restricted to the points of the tiles.
+        tiles (list of tuples): Interior and extended indices of the tiles (see get_layer_tiles).
+        n_jobs (int, optional): Number of threads building the tile matrices. Defaults to 1.
+
+    Returns:
+        TiledProximityMatrix: proximity_matrix
+    """
+    n_points = slice_layer.points.shape[0]
+
+    def get_tile_matrix(index):
+        # the tiles have no layer index, so their distance matrices are not cached in place of the layer
+        tile_layer = slice_layer._replace(
+            index=None,
+            points=slice_layer.points[index],
+            branches=None,
+            branch_lengths=None,
+            branch_connections=None,
+        )
+        tile_arguments = [
+            (
+                argument[index]
+                if np.ndim(argument) > 0 and len(argument) == n_points
+                else argument
+            )
+            for argument in layer_arguments
+        ]
+        return model.get_slice_proximity_matrix(tile_layer, *tile_arguments)
+
+    return TiledProximityMatrix(get_tile_matrix, n_points, tiles, n_jobs=n_jobs)
+
+
 class DwellSolver:
     """Class which solves the proximity problem for dwell times.
 
     Attributes:
         model (Model): Model which to solve.
         dwell_times_slices (list of arrays): Solutionto the proximity problem.
+        method (str): Method for solving the layers: "lsq_linear" (scipy's trust region reflective), "lbfgsb" (scipy's L-BFGS-B)
+            or "coordinate_descent" (compiled, see bounded_lsq_cd).
+        backend (str): Parallel backend: "serial", "threads", "processes" or "loky". None uses threads for the methods that release the GIL and loky otherwise.
+        n_jobs (int): Number of parallel jobs. None uses all the available cores.
+        chunk_points (int): Consecutive layers are batched into chunks of at least this many points (see get_layer_chunks).
+        warm_start (bool): If true, each layer is solved iteratively starting from the solution of the layer below (see solve_layers).
+        split_components (bool): If true, the independent parts of each layer are solved separately (see solve_layer).
+            None splits only for the methods where it pays off (coordinate_descent).
+        tile_size (float): Layers larger than a tile are solved tile by tile (see solve_layer_tiled). None solves the layers whole.
+        tile_halo (float): Width of the halo around the tiles, at least the neighbour threshold of the model (3 sigma). None uses the threshold.
+        schwarz_passes (int): Number of refinement passes of the tiled solution.
+        tile_residual (bool): If true, the residual of the tiled layers is calculated for layer_stats, which builds the matrices of their tiles
+            once more. Otherwise it is nan.
+        solution_cache (SolutionCache): Cache of the solved layers. solve_dwells only solves the layers whose points, model parameters
+            and solver options are not in the cache.
+        compact_matrices (str): Data type of the compact proximity matrices, "float64" or "float32" (see Model.compact_matrices).
+            They are CSR matrices with int32 indices, storing only the upper triangle for the symmetric models (except for FULL_ROW_METHODS). None uses the COO matrices.
+        checkpoint (SolveCheckpoint): Checkpoint to which solve_dwells saves the layers as they are solved, so that an interrupted run can be resumed.
+            None if no checkpoint directory is given.
+        callback (callable): Function called with the statistics record of each layer (see layer_stats) as the layers are solved.
+        layer_stats (structured array): Statistics of each layer from the last solve_dwells with the fields (LAYER_STATS_DTYPE):
+            layer, n_points, nnz (of the full proximity matrix, also when only its upper triangle is stored), search_time (of the neighbours), proximity_time (of building the matrix besides the search),
+            solve_time, n_iter, converged, residual (root mean square of the height error relative to the layer height),
+            at_lower and at_upper (fraction of the points at the bounds), cached (the layer was taken from the solution cache or the checkpoint).
+            The matrices of the tiled layers are built tile by tile during the solve, so their build time is part of solve_time.
+            Their nnz and bounds are recorded from the tiles of the solve, and their residual is nan unless tile_residual is set.
     """
 
-    def __init__(self, model):
+    def __init__(
+        self,
+        model,
+        method="lsq_linear",
+        backend=None,
+        n_jobs=None,
+        chunk_points=2000,
+        warm_start=False,
+        split_components=None,
+        tile_size=None,
+        tile_halo=None,
+        schwarz_passes=1,
+        tile_residual=False,
+        cache_max_size=2**28,
+        cache_dir=None,
+        compact_matrices=None,
+        checkpoint_dir=None,
+        callback=None,
+    ):
+        if method not in SOLVER_METHODS:
+            raise ValueError("Unknown solver method: {}".format(method))
+        if compact_matrices is not None and compact_matrices not in COMPACT_DTYPES:
+            raise ValueError("Unknown compact matrix type: {}".format(compact_matrices))
+        if backend is not None and backend not in PARALLEL_BACKENDS:
+            raise ValueError("Unknown parallel backend: {}".format(backend))
         self.model = model
+        self.method = method
+        self.backend = backend
+        self.n_jobs = n_jobs
+        self.chunk_points = chunk_points
+        self.warm_start = warm_start
+        self.split_components = (
+            method in SPLIT_METHODS if split_components is None else split_components
+        )
+        self.tile_size = tile_size
+        self.tile_halo = tile_halo
+        self.schwarz_passes = schwarz_passes
+        self.tile_residual = tile_residual
+        self.solution_cache = SolutionCache(cache_max_size, cache_dir)
+        self.compact_matrices = compact_matrices
+        self.checkpoint = (
+            SolveCheckpoint(checkpoint_dir) if checkpoint_dir is not None else None
+        )
+        self.callback = callback
         self.dwell_times_slices = None
+        self.layer_stats = None
 
-    def solve_dwells(self, n_jobs=5):
-        """Solves the dwells for dwell times and stores the result in self.dwell_times_slices
+    def get_solve_model(self, method=None, model=None):
+        """Gets the model that builds the proximity matrices for the solve: a copy of the model with the compact matrices if they are used.
+        The symmetric matrices are stored as their upper triangle, unless the method needs the full rows (FULL_ROW_METHODS).
 
         Args:
-            tol (float, optional): Tolerance of the lsq_linear solver. Defaults to 1e-3.
+            method (str, optional): Method of the solve. Defaults to self.method.
+            model (Model, optional): Model to set up for the solve, e.g. a point of a parameter sweep. Defaults to self.model.
+
+        Returns:
+            Model
         """
+        model = self.model if model is None else model
+        if self.compact_matrices is None:
+            return model
+        method = self.method if method is None else method
+        model = copy.copy(model)
+        model.compact_matrices = self.compact_matrices
+        model.symmetric_matrices = method not in FULL_ROW_METHODS
+        return model
+
+    def get_layer_key(self, layer, dz, warm_start, solve_options):
+        """Gets the key of the solution of the layer in the solution cache (see get_solution_key).
+
+        Args:
+            layer (int): Index of the layer.
+            dz (float): Layer height.
+            warm_start (bool): Whether the layer is solved with a warm start.
+            solve_options (dict): Arguments of solve_layer.
+
+        Returns:
+            str
+        """
+        return self._get_solution_key(
+            self.model.struct.slices[layer],
+            self.model.get_layer_factors(layer),
+            dz,
+            warm_start,
+            solve_options,
+        )
+
+    def get_slice_key(
+        self, slice_layer, layer_arguments, dz, warm_start, solve_options
+    ):
+        """Gets the key of the solution of a slice record in the solution cache, equal to the get_layer_key of the same layer of the structure.
+
+        Args:
+            slice_layer (SliceLayer): Record of the slice.
+            layer_arguments (tuple): Arguments of get_slice_proximity_matrix for the slice (see Model.iter_layer_arguments).
+            dz (float): Layer height.
+            warm_start (bool): Whether the layer is solved with a warm start.
+            solve_options (dict): Arguments of solve_layer.
+
+        Returns:
+            str
+        """
+        return self._get_solution_key(
+            slice_layer.points,
+            self.model.get_slice_layer_factors(slice_layer, layer_arguments),
+            dz,
+            warm_start,
+            solve_options,
+        )
+
+    def _get_solution_key(self, points, layer_factors, dz, warm_start, solve_options):
+        options = {
+            key: value
+            for key, value in solve_options.items()
+            if key not in ("tile_jobs", "component_jobs", "tile_residual")
+        }
+        options.update(
+            dz=dz, warm_start=warm_start, compact_matrices=self.compact_matrices
+        )
+        return get_solution_key(
+            points, layer_factors, self.model.get_model_parameters(), options
+        )
+
+    def get_solve_options(self, method, layer_jobs=1, model=None):
+        """Gets the keyword arguments of solve_layer for solving the layers with the given method.
+
+        Args:
+            method (str): Method of the solve.
+            layer_jobs (int, optional): Number of threads solving the parts (tiles or components) of a layer. It should be 1 when the layers
+                are already solved in parallel, so that the cores are not oversubscribed. Defaults to 1.
+            model (Model, optional): Model whose interaction range the tile halo must cover. Defaults to self.model.
+
+        Raises:
+            ValueError: If the tile halo is smaller than the neighbour threshold of the model.
+
+        Returns:
+            dict: Also with the tile_residual option of solve_layers.
+        """
+        model = self.model if model is None else model
+        options = {"method": method, "split_components": self.split_components}
+        if self.split_components:
+            options["component_jobs"] = layer_jobs
+        if self.tile_size is not None:
+            nb_threshold = model.get_nb_threshold()
+            tile_halo = nb_threshold if self.tile_halo is None else self.tile_halo
+            # with a smaller halo, the points near the tile edges miss some of their neighbours
+            if tile_halo < nb_threshold:
+                raise ValueError(
+                    "The tile halo ({}) is smaller than the neighbour threshold of the model ({})".format(
+                        tile_halo, nb_threshold
+                    )
+                )
+            options.update(
+                tile_size=self.tile_size,
+                tile_halo=tile_halo,
+                schwarz_passes=self.schwarz_passes,
+                tile_jobs=layer_jobs,
+                tile_residual=self.tile_residual,
+            )
+        return options
+
+    def get_parallel_backend(self, method=None):
+        """Gets the joblib backend and the number of jobs for solving with the given method (defaults to self.method).
+
+        Returns:
+            tuple: backend (str), n_jobs (int)
+        """
+        method = self.method if method is None else method
+        if self.backend is not None:
+            backend = PARALLEL_BACKENDS[self.backend]
+        else:
+            backend = "threading" if method in NOGIL_METHODS else "loky"
+        n_jobs = cpu_count() if self.n_jobs is None else self.n_jobs
+        if backend == "sequential":
+            n_jobs = 1
+        return backend, n_jobs
+
+    def solve_dwells(
+        self, n_jobs=None, warm_start=None, chunk_points=None, resume=False
+    ):
+        """Solves the dwells for dwell times and stores the result in self.dwell_times_slices.
+        The layers are batched into chunks of consecutive layers (see get_layer_chunks), which are dispatched to the parallel jobs largest first
+        for a better load balance. Each job builds the proximity matrices of its chunk and solves them (see solve_layers).
+        The layers found in self.solution_cache are not solved again, and the solved layers are saved to it.
+        The statistics of the layers are stored in self.layer_stats and passed to self.callback as the chunks are solved.
+        With processes, the jobs get a copy of the model without the structure and the slices, whose arrays joblib
+        shares through memory maps, so the neighbour searches run in parallel too. With threads (or a single job) the model is shared,
+        so the distance matrices cached in the structure are used.
+        With a checkpoint, the layers of each chunk are saved to it as soon as the chunk is solved. A resumed run only solves the layers
+        that are not in the checkpoint.
+
+        Args:
+            n_jobs (int, optional): Number of parallel jobs. Defaults to self.n_jobs.
+            warm_start (bool, optional): If true, each layer is solved iteratively starting from the solution of the layer below.
+                lsq_linear cannot be started from a guess, so it is replaced by lbfgsb. Defaults to self.warm_start.
+            chunk_points (int, optional): Minimal number of points in a chunk. Defaults to self.chunk_points.
+            resume (bool, optional): If true, the layers solved by the previous run in self.checkpoint are not solved again.
+                Otherwise the checkpoint is restarted. Defaults to False.
+
+        Raises:
+            ValueError: If the run is resumed without a checkpoint, or from a checkpoint of a different model, structure or solver settings.
+        """
+        if resume and self.checkpoint is None:
+            raise ValueError("Cannot resume without a checkpoint directory")
         print("Solving for dwells...")
+        warm_start = self.warm_start if warm_start is None else warm_start
+        chunk_points = self.chunk_points if chunk_points is None else chunk_points
+        struct = self.model.struct
         # get the thickness of layers
-        dz_slices = self.model.struct.dz_slices
+        dz_slices = struct.dz_slices
         n_layers = dz_slices.size
-        # get the generator for the proximity matrix
-        prox_matrix_generator = (
-            self.model.get_proximity_matrix(lyr) for lyr in range(n_layers)
+        method = self.method
+        if warm_start and method == "lsq_linear":
+            method = "lbfgsb"
+        backend, default_n_jobs = self.get_parallel_backend(method)
+        n_jobs = default_n_jobs if n_jobs is None else n_jobs
+        shared = n_jobs == 1 or backend in ("sequential", "threading")
+        model = self.get_solve_model(method)
+        if not shared:
+            model = model.without_structure()
+        sliced_structure = struct.sliced_structure
+        solve_options = self.get_solve_options(method)
+
+        layer_keys = [
+            self.get_layer_key(i, dz_slices[i], warm_start, solve_options)
+            for i in range(n_layers)
+        ]
+        dwell_times_slices = [self.solution_cache.load(key) for key in layer_keys]
+        if self.checkpoint is not None:
+            self.checkpoint.start(layer_keys, type(self.model).__name__, resume)
+            solved_layers = set(self.checkpoint.get_solved_layers())
+            for layer in range(n_layers):
+                if layer in solved_layers:
+                    if dwell_times_slices[layer] is None:
+                        dwell_times_slices[layer] = self.checkpoint.load(layer)
+                elif dwell_times_slices[layer] is not None:
+                    # the checkpoint holds all the layers, including the cached ones
+                    self.checkpoint.save(layer, dwell_times_slices[layer])
+        missing = np.array([dwell_times is None for dwell_times in dwell_times_slices])
+
+        layer_sizes = np.diff(sliced_structure.layer_offsets)[:n_layers]
+        layer_stats = np.zeros(n_layers, dtype=LAYER_STATS_DTYPE)
+        layer_stats["layer"] = np.arange(n_layers)
+        layer_stats["n_points"] = layer_sizes
+        layer_stats[~missing] = get_cached_layer_stats(
+            np.flatnonzero(~missing), layer_sizes[~missing]
         )
-        dwell_times_slices = list()
-        # solve for each layer. Do this in parallel to speed up.
-        dwell_times_slices = Parallel(n_jobs=n_jobs)(
-            delayed(self.solve_layer)(proximity_matrix, dz)
-            for proximity_matrix, dz in zip(prox_matrix_generator, dz_slices)
+        # batch the consecutive layers that are not in the cache
+        chunks = [
+            range(run.start + chunk.start, run.start + chunk.stop)
+            for run in get_layer_runs(missing)
+            for chunk in get_layer_chunks(
+                layer_sizes[run.start : run.stop], chunk_points
+            )
+        ]
+        if len(chunks) == 1:
+            # a single chunk runs on a single job, so the tiles or components of its layers are solved in parallel instead
+            solve_options = self.get_solve_options(method, layer_jobs=n_jobs)
+        # dispatch the largest chunks first so that they do not end up last on a single job
+        chunk_order = np.argsort(
+            [-layer_sizes[chunk.start : chunk.stop].sum() for chunk in chunks],
+            kind="stable",
         )
+
+        def chunk_tasks():
+            for c in chunk_order:
+                layers = chunks[c]
+                layer_arguments = (
+                    None
+                    if shared
+                    else [self.model.get_layer_arguments(i) for i in layers]
+                )
+                yield delayed(self.solve_layers)(
+                    model,
+                    layers,
+                    dz_slices[layers.start : layers.stop],
+                    sliced_structure=None if shared else sliced_structure,
+                    layer_arguments=layer_arguments,
+                    warm_start=warm_start,
+                    return_stats=True,
+                    **solve_options,
+                )
+
+        # solve the chunks in parallel to speed up. The chunks are processed as soon as they are solved, so they are saved early
+        results = Parallel(
+            n_jobs=n_jobs,
+            backend=backend,
+            return_as=get_return_as(backend, ordered=False),
+        )(chunk_tasks())
+        for chunk_dwell_times, chunk_stats in results:
+            layers = chunk_stats["layer"]
+            layer_stats[layers] = chunk_stats
+            for layer, dwell_times in zip(layers, chunk_dwell_times):
+                dwell_times_slices[layer] = dwell_times
+                self.solution_cache.save(layer_keys[layer], dwell_times)
+                if self.checkpoint is not None:
+                    self.checkpoint.save(layer, dwell_times)
+                if self.callback is not None:
+                    self.callback(layer_stats[layer])
         self.dwell_times_slices = dwell_times_slices
+        self.layer_stats = layer_stats
         print("Solved")
 
+    def iter_solve(
+        self, slice_layers=None, n_jobs=None, warm_start=None, chunk_points=None
+    ):
+        """Solves for the dwells layer by layer while consuming the slices as they are generated, so the slicing and solving can be streamed.
+        The consecutive layers are batched into chunks as in solve_dwells (see get_layer_chunks). The layer arguments of the model are calculated
+        on the fly (see Model.iter_layer_arguments) and each job builds the proximity matrices of its chunk from the slice records and solves them
+        (see solve_layers). The chunks are dispatched and returned in order, so only a bounded number of them is in flight at any time.
+        The layers found in self.solution_cache are not solved again, and the solved layers are saved to it. The statistics of the layers are
+        passed to self.callback as the layers are returned and stored in self.layer_stats once all of them are solved.
+        The result is not stored in self.dwell_times_slices. As in solve_dwells, the topmost slice is not solved since it has no thickness.
+
+        Args:
+            slice_layers (iterable of SliceLayer, optional): Slices to solve. Defaults to the model structure iter_slices().
+            n_jobs (int, optional): Number of parallel jobs. Defaults to self.n_jobs.
+            warm_start (bool, optional): If true, each layer is solved starting from the solution of the layer below (see solve_dwells). Defaults to self.warm_start.
+            chunk_points (int, optional): Minimal number of points in a chunk. Defaults to self.chunk_points.
+
+        Raises:
+            ValueError: With a checkpoint, which needs the keys of all the layers before the run starts, or with the "processes" backend,
+                which returns the results only once all of them are solved.
+
+        Yields:
+            tuple: slice_layer (SliceLayer), dwell_times ((n,) array)
+        """
+        if self.checkpoint is not None:
+            raise ValueError("The streamed solve does not support a checkpoint")
+        warm_start = self.warm_start if warm_start is None else warm_start
+        chunk_points = self.chunk_points if chunk_points is None else chunk_points
+        method = self.method
+        if warm_start and method == "lsq_linear":
+            method = "lbfgsb"
+        backend, default_n_jobs = self.get_parallel_backend(method)
+        if backend == "multiprocessing":
+            raise ValueError(
+                "The streamed solve does not support the processes backend"
+            )
+        n_jobs = default_n_jobs if n_jobs is None else n_jobs
+        if slice_layers is None:
+            slice_layers = self.model.struct.iter_slices()
+        model = self.get_solve_model(method)
+        if not (n_jobs == 1 or backend in ("sequential", "threading")):
+            model = model.without_structure()
+        # the layers are solved in parallel, so their tiles are not
+        solve_options = self.get_solve_options(method)
+        # layers in order, each entry is a list of (slice_layer, layer_arguments, dz, key) and the dwell times of the layers if they are cached,
+        # or None for the chunks that are being solved
+        pending = deque()
+        layer_stats = []
+
+        def iter_layers():
+            # the height of a layer is only known once the slice above it is generated
+            layer_below = None
+            for slice_layer, layer_arguments in self.model.iter_layer_arguments(
+                slice_layers
+            ):
+                if layer_below is not None:
+                    yield (*layer_below, slice_layer.z - layer_below[0].z)
+                layer_below = (slice_layer, layer_arguments)
+
+        def chunk_task(chunk):
+            pending.append((chunk, None))
+            return delayed(self.solve_layers)(
+                model,
+                [slice_layer.index for slice_layer, *_ in chunk],
+                np.array([dz for *_, dz, _ in chunk]),
+                slice_layers=[slice_layer for slice_layer, *_ in chunk],
+                layer_arguments=[layer_arguments for _, layer_arguments, *_ in chunk],
+                warm_start=warm_start,
+                return_stats=True,
+                **solve_options,
+            )
+
+        def chunk_tasks():
+            chunk = []
+            n_points = 0
+            for slice_layer, layer_arguments, dz in iter_layers():
+                key = self.get_slice_key(
+                    slice_layer, layer_arguments, dz, warm_start, solve_options
+                )
+                dwell_times = self.solution_cache.load(key)
+                if dwell_times is None:
+                    chunk.append((slice_layer, layer_arguments, dz, key))
+                    n_points += slice_layer.points.shape[0]
+                    if n_points < chunk_points:
+                        continue
+                # a cached layer ends the chunk, as in solve_dwells
+                if chunk:
+                    yield chunk_task(chunk)
+                    chunk = []
+                    n_points = 0
+                if dwell_times is not None:
+                    pending.append(
+                        ([(slice_layer, layer_arguments, dz, key)], [dwell_times])
+                    )
+            if chunk:
+                yield chunk_task(chunk)
+
+        def finish_layers(chunk, dwell_times_slices, chunk_stats):
+            for (slice_layer, _, _, key), dwell_times, stats in zip(
+                chunk, dwell_times_slices, chunk_stats
+            ):
+                if not stats["cached"]:
+                    self.solution_cache.save(key, dwell_times)
+                if self.callback is not None:
+                    self.callback(stats)
+                layer_stats.append(stats)
+                yield slice_layer, dwell_times
+
+        def finish_cached():
+            # the cached layers waiting for the chunks below them
+            while pending and pending[0][1] is not None:
+                chunk, dwell_times_slices = pending.popleft()
+                yield from finish_layers(
+                    chunk,
+                    dwell_times_slices,
+                    get_cached_layer_stats(
+                        [slice_layer.index for slice_layer, *_ in chunk],
+                        [slice_layer.points.shape[0] for slice_layer, *_ in chunk],
+                    ),
+                )
+
+        results = Parallel(
+            n_jobs=n_jobs, backend=backend, return_as=get_return_as(backend)
+        )(chunk_tasks())
+        for chunk_dwell_times, chunk_stats in results:
+            yield from finish_cached()
+            chunk, _ = pending.popleft()
+            yield from finish_layers(chunk, chunk_dwell_times, chunk_stats)
+        yield from finish_cached()
+        self.layer_stats = np.array(layer_stats, dtype=LAYER_STATS_DTYPE)
+
     @staticmethod
-    def solve_layer(proximity_matrix, dz, tol=1e-3):
+    def solve_layer(
+        proximity_matrix,
+        dz,
+        tol=None,
+        method="lsq_linear",
+        x0=None,
+        split_components=False,
+        y=None,
+        points=None,
+        tile_size=None,
+        tile_halo=0.0,
+        schwarz_passes=0,
+        tile_jobs=1,
+        component_jobs=1,
+        return_info=False,
+    ):
         """Solves a layer proximity problem given a proximity matrix and the layer height.
 
         Args:
             proximity_matrix (sparse matrix): Proximity matrix
             dz (float): Layer height
-            tol (float, optional): Tolerance for the optimization. Defaults to 1e-3.
+            tol (float, optional): Tolerance for the optimization. Defaults to 1e-3 for lsq_linear, 1e-5 for lbfgsb and 1e-4 for coordinate_descent.
+            method (str, optional): Method for solving the layer (see DwellSolver.method). Defaults to "lsq_linear".
+            x0 ((n,) array, optional): Initial guess for the iterative methods. Ignored by lsq_linear.
+            split_components (bool, optional): If true, the connected components of the proximity matrix are solved as separate smaller problems
+                (see get_layer_components), and isolated points are given their upper bound directly. Components with fewer than
+                MIN_COMPONENT_POINTS points are solved together. Defaults to False.
+            y ((n,) array, optional): Height to deposit at each point. Defaults to dz everywhere.
+            points ((n,2) array, optional): Points of the layer. Needed for the tiled solve.
+            tile_size (float, optional): If given, layers that do not fit in a single tile are solved tile by tile (see solve_layer_tiled).
+            tile_halo (float, optional): Width of the halo around the tiles. Defaults to 0.
+            schwarz_passes (int, optional): Number of refinement passes of the tiled solution. Defaults to 0.
+            tile_jobs (int, optional): Number of threads solving the tiles. Defaults to 1.
+            component_jobs (int, optional): Number of threads solving the components, if at least two of them have MIN_COMPONENT_POINTS points.
+                Defaults to 1.
+            return_info (bool, optional): If true, the information about the solution is returned too. Defaults to False.
+
+        Returns:
+            dwell_times: Array of dwell times as a solution for the layer. With return_info, a tuple of the dwell times and SolveInfo.
+        """
+        tiles = None
+        if isinstance(proximity_matrix, TiledProximityMatrix):
+            tiles = proximity_matrix.tiles
+        elif tile_size is not None and points is not None:
+            tiles = get_layer_tiles(points, tile_size, tile_halo)
+        if tiles is not None and len(tiles) > 1:
+            dwell_times, info = DwellSolver.solve_layer_tiled(
+                proximity_matrix,
+                dz,
+                tiles,
+                schwarz_passes=schwarz_passes,
+                n_jobs=tile_jobs,
+                tol=tol,
+                method=method,
+                x0=x0,
+                split_components=split_components,
+                y=y,
+            )
+            return (dwell_times, info) if return_info else dwell_times
+        # get a tight upper bound for faster computation
+        upper_bound = get_upper_bound(proximity_matrix, dz)
+        y = dz * np.ones(proximity_matrix.shape[1]) if y is None else y
+        if split_components:
+            components = get_layer_components(
+                proximity_matrix, min_points=MIN_COMPONENT_POINTS
+            )
+            if len(components) > 1:
+                if not isinstance(proximity_matrix, SymmetricMatrix):
+                    proximity_matrix = proximity_matrix.tocsr()
+                # an isolated point has no proximity from the others, so its dwell time is given by its own height
+                dwell_times = np.clip(upper_bound * y / dz, 0, upper_bound)
+                infos = [SolveInfo(0, True)]
+                components = [
+                    component for component in components if component.size > 1
+                ]
+
+                def solve_component(component):
+                    return DwellSolver.solve_layer(
+                        get_submatrix(proximity_matrix, component),
+                        dz,
+                        tol=tol,
+                        method=method,
+                        x0=None if x0 is None else x0[component],
+                        y=y[component],
+                        return_info=True,
+                    )
+
+                n_large = sum(
+                    component.size >= MIN_COMPONENT_POINTS for component in components
+                )
+                if component_jobs != 1 and n_large > 1:
+                    results = Parallel(n_jobs=component_jobs, backend="threading")(
+                        delayed(solve_component)(component) for component in components
+                    )
+                else:
+                    results = map(solve_component, components)
+                for component, (component_dwell_times, component_info) in zip(
+                    components, results
+                ):
+                    dwell_times[component] = component_dwell_times
+                    infos.append(component_info)
+                info = SolveInfo(
+                    max(info.n_iter for info in infos),
+                    all(info.converged for info in infos),
+                )
+                return (dwell_times, info) if return_info else dwell_times
+        if method == "lbfgsb":
+            return DwellSolver.solve_layer_iterative(
+                proximity_matrix, dz, x0=x0, tol=tol, y=y, return_info=return_info
+            )
+        if method == "coordinate_descent":
+            result = bounded_lsq_cd(
+                proximity_matrix,
+                y,
+                upper_bound,
+                x0=x0,
+                tol=1e-4 if tol is None else tol,
+            )
+            info = SolveInfo(result.n_iter, result.converged)
+        elif method == "lsq_linear":
+            # solve the optimization problem
+            if isinstance(proximity_matrix, SymmetricMatrix):
+                proximity_matrix = proximity_matrix.aslinearoperator()
+            result = lsq_linear(
+                proximity_matrix,
+                y,
+                bounds=(0, upper_bound),
+                tol=1e-3 if tol is None else tol,
+            )
+            # status 0 means that the maximum number of iterations was reached and -1 that the algorithm failed
+            info = SolveInfo(result.nit, result.status > 0)
+        else:
+            raise ValueError("Unknown solver method: {}".format(method))
+        return (result.x, info) if return_info else result.x
+
+    @staticmethod
+    def solve_layer_tiled(
+        proximity_matrix,
+        dz,
+        tiles,
+        schwarz_passes=0,
+        n_jobs=1,
+        y=None,
+        x0=None,
+        **kwargs,
+    ):
+        """Solves a large layer by domain decomposition. Each tile is solved together with its halo and only the values at its interior
+        points are kept, so the cost of the solve scales with the size of the tiles rather than the layer. With a halo at least as wide
+        as the range of the proximity function, the interior points are only affected by the truncation through the halo points.
+        The refinement passes (restricted additive Schwarz) solve each tile again with the dwell times outside of it fixed to the last solution,
+        which removes the truncation error. The tiles are solved in parallel threads.
+        The memory scales with the tiles too only for a TiledProximityMatrix, which builds the matrices of the tiles (again for each pass
+        and for the deposits of the refinement) instead of keeping the matrix of the layer (see solve_layers). Its diagonal and number of entries
+        are recorded from the tile matrices of the first pass.
+
+        Args:
+            proximity_matrix (sparse matrix or TiledProximityMatrix): Proximity matrix
+            dz (float): Layer height
+            tiles (list of tuples): Interior and extended indices of the tiles (see get_layer_tiles).
+            schwarz_passes (int, optional): Number of refinement passes. Defaults to 0.
+            n_jobs (int, optional): Number of threads. Defaults to 1.
+            y ((n,) array, optional): Height to deposit at each point. Defaults to dz everywhere.
+            x0 ((n,) array, optional): Initial guess for the iterative methods.
+            **kwargs: Other arguments of solve_layer for solving the tiles.
+
+        Returns:
+            tuple: dwell_times (array of dwell times as a solution for the layer), info (SolveInfo of the tiles of all the passes)
+        """
+        if not isinstance(proximity_matrix, (SymmetricMatrix, TiledProximityMatrix)):
+            proximity_matrix = proximity_matrix.tocsr()
+        y = dz * np.ones(proximity_matrix.shape[0]) if y is None else y
+        dwell_times = np.zeros(proximity_matrix.shape[1])
+        infos = []
+        deposit = None
+
+        tiled = isinstance(proximity_matrix, TiledProximityMatrix)
+
+        def solve_tile(interior, extended, n_pass):
+            # the tile matrices are extracted (or built) in the tasks, so that only the tiles being solved are in memory
+            if tiled:
+                tile_matrix = proximity_matrix.submatrix(extended)
+            else:
+                tile_matrix = get_submatrix(proximity_matrix, extended)
+            rows = np.searchsorted(extended, interior)
+            if tiled and n_pass == 0:
+                # the rows are recorded from the tile matrices, which are not kept
+                proximity_matrix.record_tile_rows(tile_matrix, rows, interior)
+            tile_y = y[extended]
+            tile_x0 = None if x0 is None else x0[extended]
+            if n_pass > 0:
+                # subtract the deposit from the points outside of the tile
+                tile_x0 = dwell_times[extended]
+                tile_y = tile_y - deposit[extended] + tile_matrix @ tile_x0
+            tile_dwell_times, info = DwellSolver.solve_layer(
+                tile_matrix, dz, y=tile_y, x0=tile_x0, return_info=True, **kwargs
+            )
+            return tile_dwell_times[rows], info
+
+        for n_pass in range(schwarz_passes + 1):
+            if n_pass > 0:
+                deposit = proximity_matrix @ dwell_times
+            results = Parallel(n_jobs=n_jobs, backend="threading")(
+                delayed(solve_tile)(interior, extended, n_pass)
+                for interior, extended in tiles
+            )
+            # the tiles are solved from the same previous solution, so the interiors are updated at the end of the pass
+            for (interior, _), (interior_dwell_times, info) in zip(tiles, results):
+                dwell_times[interior] = interior_dwell_times
+                infos.append(info)
+        info = SolveInfo(
+            max(info.n_iter for info in infos), all(info.converged for info in infos)
+        )
+        return dwell_times, info
+
+    @staticmethod
+    def solve_layer_iterative(
+        proximity_matrix, dz, x0=None, tol=None, y=None, return_info=False
+    ):
+        """Solves a layer proximity problem with a bounded quasi-Newton method (L-BFGS-B), which can start from an initial guess.
+
+        Args:
+            proximity_matrix (sparse matrix): Proximity matrix
+            dz (float): Layer height
+            x0 ((n,) array, optional): Initial guess of the dwell times. Defaults to the upper bound.
+            tol (float, optional): Tolerance on the projected gradient relative to the layer height. Defaults to 1e-5.
+            y ((n,) array, optional): Height to deposit at each point. Defaults to dz everywhere.
+            return_info (bool, optional): If true, the information about the solution is returned too. Defaults to False.
 
         Returns:
-            dwell_times: Array of dwell times as a solution for the layer.
+            dwell_times: Array of dwell times as a solution for the layer. With return_info, a tuple of the dwell times and SolveInfo.
         """
-        # get a tight upper bound for faster computation. We can never have larger dwell times than if there was no proximity (proximity matrix was diagonal)
-        upper_bound = dz / proximity_matrix.diagonal()
-        # solve the optimization problem
-        y = dz * np.ones(proximity_matrix.shape[1])
-        result = lsq_linear(proximity_matrix, y, bounds=(0, upper_bound), tol=tol)
+        tol = 1e-5 if tol is None else tol
+        if isinstance(proximity_matrix, SymmetricMatrix):
+            proximity_matrix_t = proximity_matrix
+        else:
+            proximity_matrix = proximity_matrix.tocsr()
+            proximity_matrix_t = proximity_matrix.T.tocsr()
+        upper_bound = get_upper_bound(proximity_matrix, dz)
+        y = dz * np.ones(proximity_matrix.shape[1]) if y is None else y
+        x0 = upper_bound if x0 is None else np.clip(x0, 0, upper_bound)
+
+        def cost(x):
+            residual = proximity_matrix @ x - y
+            return 0.5 * residual @ residual, proximity_matrix_t @ residual
+
+        result = minimize(
+            cost,
+            x0,
+            jac=True,
+            method="L-BFGS-B",
+            bounds=np.column_stack((np.zeros_like(upper_bound), upper_bound)),
+            options={"ftol": 1e-12, "gtol": tol * dz, "maxiter": 10000},
+        )
+        if return_info:
+            return result.x, SolveInfo(result.nit, result.success)
         return result.x
 
+    @classmethod
+    def solve_layers(
+        cls,
+        model,
+        layers,
+        dz_slices,
+        sliced_structure=None,
+        layer_arguments=None,
+        warm_start=False,
+        return_stats=False,
+        slice_layers=None,
+        tile_residual=False,
+        **solve_options,
+    ):
+        """Builds the proximity matrices of consecutive layers of the structure and solves them. Runs in the parallel jobs.
+        With the tiling, the matrices of the layers larger than a tile are never built as a whole (see TiledProximityMatrix).
+
+        Args:
+            model (Model): Model of the deposit.
+            layers (range or list): Indices of the consecutive layers.
+            dz_slices (array): Layer heights.
+            sliced_structure (SlicedStructure, optional): If given, the proximity matrices are built from its slices with
+                model.get_slice_proximity_matrix, so the model does not need its structure. Otherwise model.get_proximity_matrix is used.
+            layer_arguments (list of tuples, optional): Extra arguments of get_slice_proximity_matrix for each layer (see Model.get_layer_arguments).
+            warm_start (bool, optional): If true, each layer starts from the solution of the layer below mapped onto its points by the
+                nearest neighbour. On smooth structures the neighbouring layers have nearly the same solutions, so the iterative methods
+                converge in a few iterations. Defaults to False.
+            return_stats (bool, optional): If true, the statistics of the layers are returned too (see DwellSolver.layer_stats). Defaults to False.
+            slice_layers (list of SliceLayer, optional): Records of the slices of the layers, e.g. generated by Structure.iter_slices.
+                If given, the proximity matrices are built from them as from sliced_structure.
+            tile_residual (bool, optional): If true, the residual of the tiled layers is calculated for their statistics, which builds the
+                matrices of their tiles once more. Otherwise it is nan. Defaults to False.
+            **solve_options: Arguments of solve_layer (method, tol, split_components and the tiling).
+
+        Returns:
+            list of arrays: Dwell times of each layer. With return_stats, a tuple of the dwell times and the statistics of the layers.
+        """
+        dwell_times_slices = []
+        layer_stats = np.zeros(len(layers), dtype=LAYER_STATS_DTYPE)
+        points_below = None
+        for i, (layer, dz) in enumerate(zip(layers, dz_slices)):
+            start = time.perf_counter()
+            search_time = get_search_time()
+            shared = sliced_structure is None and slice_layers is None
+            if shared:
+                points = model.struct.slices[layer]
+            else:
+                slice_layer = (
+                    sliced_structure.layer(layer)
+                    if slice_layers is None
+                    else slice_layers[i]
+                )
+                points = slice_layer.points
+            tiles = None
+            if solve_options.get("tile_size") is not None:
+                tiles = get_layer_tiles(
+                    points,
+                    solve_options["tile_size"],
+                    solve_options.get("tile_halo", 0.0),
+                )
+            if tiles is not None and len(tiles) > 1:
+                # the matrix of a layer larger than a tile is never built as a whole
+                if shared:
+                    slice_layer = model.struct.sliced_structure.layer(layer)
+                    arguments = model.get_layer_arguments(layer)
+                else:
+                    arguments = layer_arguments[i]
+                proximity_matrix = get_tiled_proximity_matrix(
+                    model,
+                    slice_layer,
+                    arguments,
+                    tiles,
+                    n_jobs=solve_options.get("tile_jobs", 1),
+                )
+            elif shared:
+                proximity_matrix = model.get_proximity_matrix(layer)
+            else:
+                proximity_matrix = model.get_slice_proximity_matrix(
+                    slice_layer, *layer_arguments[i]
+                )
+            search_time = get_search_time() - search_time
+            proximity_time = time.perf_counter() - start - search_time
+            x0 = None
+            if warm_start and points_below is not None:
+                x0 = map_solution(points_below, dwell_times_slices[-1], points)
+            start = time.perf_counter()
+            dwell_times, info = cls.solve_layer(
+                proximity_matrix,
+                dz,
+                x0=x0,
+                points=points,
+                return_info=True,
+                **solve_options,
+            )
+            solve_time = time.perf_counter() - start
+            dwell_times_slices.append(dwell_times)
+            points_below = points
+            if return_stats:
+                layer_stats[i] = (
+                    layer,
+                    points.shape[0],
+                    get_matrix_nnz(proximity_matrix),
+                    search_time,
+                    proximity_time,
+                    solve_time,
+                    info.n_iter,
+                    info.converged,
+                    *get_solution_quality(
+                        proximity_matrix,
+                        dz,
+                        dwell_times,
+                        with_residual=tile_residual
+                        or not isinstance(proximity_matrix, TiledProximityMatrix),
+                    ),
+                    False,
+                )
+        if return_stats:
+            return dwell_times_slices, layer_stats
+        return dwell_times_slices
+
     def get_dwells_slices(self):
         """Returns the dwells for point as a per-slice list"""
         if self.dwell_times_slices is None:
@@ -124,3 +1305,19 @@ class DwellSolver:
             print("Total stream time: ", t)
         else:
             print("Dwell times not calculated yet!")
+
+    def print_layer_stats(self, sort_by="solve_time", n_layers=10):
+        """Prints a table of the statistics of the layers with the largest values of a field (see layer_stats), e.g. to find the slowest layers.
+
+        Args:
+            sort_by (str, optional): Field by which to sort the layers. Defaults to "solve_time".
+            n_layers (int, optional): Number of layers to print. Defaults to 10.
+        """
+        if self.layer_stats is None:
+            print("Dwell times not calculated yet!")
+            return
+        order = np.argsort(-self.layer_stats[sort_by].astype(float), kind="stable")
+        names = LAYER_STATS_DTYPE.names
+        print(" ".join("{:>14}".format(name) for name in names))
+        for record in self.layer_stats[order[:n_layers]]:
+            print(" ".join("{:>14.4g}".format(record[name]) for name in names))
@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import trimesh
+from trimesh.constants import tol
+
+# layout of a triangle record in a binary stl file
+STL_TRIANGLE_DTYPE = np.dtype(
+    [("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attributes", "<u2")]
+)
+STL_HEADER_SIZE = 84
+
+
+def is_binary_stl(file_path):
+    """Checks whether the file is a binary stl, i.e. whether its size matches the triangle count in the header.
+
+    Args:
+        file_path (str): Path to the stl file.
+
+    Returns:
+        bool
+    """
+    file_size = os.path.getsize(file_path)
+    if file_size < STL_HEADER_SIZE:
+        return False
+    with open(file_path, "rb") as f:
+        f.seek(STL_HEADER_SIZE - 4)
+        n_triangles = int(np.frombuffer(f.read(4), dtype="<u4")[0])
+    return file_size == STL_HEADER_SIZE + n_triangles * STL_TRIANGLE_DTYPE.itemsize
+
+
+def read_binary_stl(file_path, chunk_size=2**20):
+    """Reads a binary stl file through a memory map. The vertices are merged chunk by chunk from the mapped records,
+    so only the merged vertices and the faces are ever held in memory as floats.
+
+    Args:
+        file_path (str): Path to the binary stl file.
+        chunk_size (int, optional): Number of triangles converted at once. Defaults to 2**20.
+
+    Returns:
+        tuple: (m,3) array of vertices, (n,3) array of faces
+    """
+    if os.path.getsize(file_path) == STL_HEADER_SIZE:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    records = np.memmap(
+        file_path, dtype=STL_TRIANGLE_DTYPE, mode="r", offset=STL_HEADER_SIZE
+    )
+    triangles = records["vertices"]
+    # drop the triangles with infinite or nan vertices
+    finite = np.concatenate(
+        [
+            np.isfinite(triangles[i : i + chunk_size]).all(axis=(1, 2))
+            for i in range(0, triangles.shape[0], chunk_size)
+        ]
+    )
+    triangle_index = None if finite.all() else np.flatnonzero(finite)
+    n_triangles = finite.sum()
+
+    digits = trimesh.util.decimal_to_digits(tol.merge)
+    keys = np.empty((n_triangles, 3, 3), dtype=np.int64)
+    for i in range(0, n_triangles, chunk_size):
+        chunk = (
+            triangles[i : i + chunk_size]
+            if triangle_index is None
+            else triangles[triangle_index[i : i + chunk_size]]
+        )
+        keys[i : i + chunk_size] = np.round(chunk.astype(np.float64) * 10**digits)
+    first_index, faces = merge_keys(keys.reshape((-1, 3)))
+    del keys
+
+    first_triangles, first_corners = np.divmod(first_index, 3)
+    if triangle_index is not None:
+        first_triangles = triangle_index[first_triangles]
+    vertices = triangles[first_triangles, first_corners].astype(np.float64)
+    del records, triangles
+    return vertices, faces
+
+
+def merge_keys(keys):
+    """Merges the rows with equal integer keys, keeping them in the order of their first occurrence
+    (as trimesh's merge_vertices).
+
+    Args:
+        keys ((n,3) int array): Rounded vertex coordinates.
+
+    Returns:
+        tuple: (m,) index of the first occurrence of each unique row, (n/3,3) array of faces indexing the unique rows
+    """
+    keys = np.ascontiguousarray(keys)
+    keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * 3))).ravel()
+    _, first_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # renumber the unique rows by their first occurrence
+    order = np.argsort(first_index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size)
+    faces = rank[inverse.reshape(-1)].reshape((-1, 3))
+    return first_index[order], faces
+
+
+def load_stl(file_path):
+    """Loads the vertices and faces of an stl file. Binary files are read directly, ASCII files are loaded with trimesh.
+
+    Args:
+        file_path (str): Path to the stl file.
+
+    Returns:
+        tuple: (m,3) array of vertices, (n,3) array of faces
+    """
+    if not is_binary_stl(file_path):
+        msh = trimesh.load_mesh(file_path, file_type="stl")
+        return msh.vertices, msh.faces
+    return read_binary_stl(file_path)
@@ -9,6 +9,10 @@ from .utils import load_settings
 
 # conversion factor from ms to 0.1us
 CONVERSION_FACTOR = 10000
+# start of the header of the stream files, followed by the number of dwells
+HEADER_START = "s16\n1\n"
+# width of the number of dwells in the header of the files written by StreamWriter
+HEADER_COUNT_WIDTH = 10
 
 
 def intertwine_dwells(dwells_list):
@@ -130,7 +134,7 @@ class Stream:
         dwells_to_write = np.round(dwells_to_write).astype(int)
 
         # gets the string ready to be written. Slightly roudabout way, but it's because of optional blanked screen lines
-        header = "s16\n1\n" + str(self.dwells.shape[0])
+        header = HEADER_START + str(self.dwells.shape[0])
         bio = io.BytesIO()
         np.savetxt(
             bio,
@@ -164,3 +168,93 @@ class Stream:
     def print_time(self):
         """Prints the total stream time."""
         print("Total time: ", str(self.get_time()))
+
+
+class StreamWriter:
+    """Writes the stream file chunk by chunk, so that the whole stream never needs to be in memory.
+    Since the number of dwells is not known until the end, the header has a space-padded placeholder of HEADER_COUNT_WIDTH characters
+    for it, which is overwritten in place when the writer is closed. Apart from the padding of the number of dwells, the file is the same as
+    written by Stream.write. The file is written to a temporary path and moved to file_path only once it is complete.
+    Use as a context manager, or call open and close.
+
+    Attributes:
+        file_path (str): Path to the .str file.
+        addressable_pixels (list of two int): Microscope addressable pixels.
+        max_dwt (float): Maximum dwell time in ms.
+        n_dwells (int): Number of dwells written so far.
+        total_time (float): Total time of the dwells written so far in ms.
+    """
+
+    def __init__(self, file_path, addressable_pixels=[65536, 56576], max_dwt=5):
+        # make sure the extension is .str
+        self.file_path = os.path.splitext(file_path)[0] + ".str"
+        self.addressable_pixels = addressable_pixels
+        self.max_dwt = max_dwt
+        self.n_dwells = 0
+        self.total_time = 0.0
+        self._file = None
+
+    @property
+    def temporary_path(self):
+        """Path to which the file is written until it is complete."""
+        return self.file_path + ".{}.tmp".format(os.getpid())
+
+    def open(self):
+        """Opens the temporary file and writes the header with a placeholder for the number of dwells."""
+        self.n_dwells = 0
+        self.total_time = 0.0
+        self._file = open(self.temporary_path, "wb")
+        self._file.write(
+            (HEADER_START + " " * HEADER_COUNT_WIDTH + "\n").encode("latin1")
+        )
+
+    def write(self, dwells):
+        """Appends the dwells to the file.
+
+        Args:
+            dwells ((n,3) array): Dwells (t, x, y) in (ms, px, px).
+        """
+        if dwells.shape[0] == 0:
+            return
+        # check that all the points are within limits
+        if not Stream(dwells, self.addressable_pixels, self.max_dwt).is_valid():
+            raise Exception("Stream not valid! One of the dimensions is out of range.")
+        dwells_to_write = np.round(dwells * [CONVERSION_FACTOR, 1, 1]).astype(int)
+        np.savetxt(self._file, dwells_to_write, delimiter=" ", fmt="%d")
+        self.n_dwells += dwells.shape[0]
+        self.total_time += np.sum(dwells[:, 0])
+
+    def close(self):
+        """Finishes the file as Stream.write, writes the number of dwells to the header and moves the file to file_path."""
+        # the last line ends with " 0" instead of the newline
+        self._file.seek(-1, os.SEEK_END)
+        self._file.write(b" 0")
+        self._file.seek(len(HEADER_START))
+        self._file.write(str(self.n_dwells).ljust(HEADER_COUNT_WIDTH).encode("latin1"))
+        self._file.close()
+        self._file = None
+        os.replace(self.temporary_path, self.file_path)
+
+    def abort(self):
+        """Closes and removes the unfinished file."""
+        self._file.close()
+        self._file = None
+        os.remove(self.temporary_path)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def get_time(self):
+        """Gets the total time of the written dwells.
+
+        Returns:
+            datetime.timedelta:
+        """
+        return timedelta(milliseconds=self.total_time)
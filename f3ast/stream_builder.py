@@ -3,7 +3,7 @@ import warnings
 import numpy as np
 
 from .solver import DwellSolver
-from .stream import Stream
+from .stream import Stream, StreamWriter
 
 
 class StreamBuilder:
@@ -39,22 +39,65 @@ class StreamBuilder:
         self.scanning_order = scanning_order
 
     @classmethod
-    def from_model(cls, model, **kwargs):
+    def from_model(cls, model, solver_settings=None, **kwargs):
         """Creates the class from the model. Internally creates the DwellSolver and solves for dwells.
         Args:
             model (Model): Class defining the growth model.
+            solver_settings (dict, optional): Settings of the DwellSolver (e.g. the "solver" section of the settings file). Defaults to None.
         Returns:
             tuple:
                 stream_builder (StreamBuilder), dwell_solver (DwellSolver)
         """
         # get the dwells
-        dwell_solver = DwellSolver(model)
+        dwell_solver = DwellSolver(model, **(solver_settings or {}))
         dwell_solver.solve_dwells()
         dwells_slices = dwell_solver.get_dwells_slices()
         # build the class
         stream_builder = cls(dwells_slices, **kwargs)
         return stream_builder, dwell_solver
 
+    @classmethod
+    def write_from_model(
+        cls,
+        file_path,
+        model,
+        solver_settings=None,
+        centre=True,
+        slice_layers=None,
+        n_jobs=None,
+        **kwargs
+    ):
+        """Solves for the dwells of the model and writes the stream file as the layers are solved, without keeping all the dwells in memory.
+        The layers are solved in parallel in chunks of consecutive layers (see DwellSolver.iter_solve) and returned in order, so only the chunks that
+        are being solved and the ones waiting for a chunk below them are held at a time. The solver settings apply as in DwellSolver.solve_dwells,
+        except for the checkpoint and the "processes" backend, which the streamed solve does not support. Each solved layer is cut, split, ordered, converted to pixels and appended to the file
+        (see write_stream). Unlike the stream of get_stream, the result is centred on the limits of the structure (see Structure.get_xy_limits),
+        since the limits of the dwells are not known until all the layers are solved.
+        Args:
+            file_path (str): Path to the .str file to which to write.
+            model (Model): Class defining the growth model.
+            solver_settings (dict, optional): Settings of the DwellSolver (e.g. the "solver" section of the settings file). checkpoint_dir must not be set. Defaults to None.
+            centre (bool, optional): Whether to centre the stream on the screen. Defaults to True.
+            slice_layers (iterable of SliceLayer, optional): Slices to solve. Defaults to the model structure iter_slices(), which slices the structure as it goes if it is not sliced yet.
+            n_jobs (int, optional): Number of parallel jobs. Defaults to the solver settings.
+            **kwargs: Arguments of the StreamBuilder (e.g. the "stream_builder" section of the settings file).
+        Returns:
+            StreamWriter: Writer of the file, with the number of dwells and the total time.
+        """
+        print("Solving for dwells and writing the stream...")
+        dwell_solver = DwellSolver(model, **(solver_settings or {}))
+        stream_builder = cls(None, **kwargs)
+        limits = model.struct.get_xy_limits() if centre else None
+        dwells_slices = (
+            np.column_stack((dwell_times, slice_layer.points))
+            for slice_layer, dwell_times in dwell_solver.iter_solve(
+                slice_layers, n_jobs=n_jobs
+            )
+        )
+        stream_writer = stream_builder.write_stream(file_path, dwells_slices, limits)
+        print("Written {} dwells".format(stream_writer.n_dwells))
+        return stream_writer
+
     @property
     def ppn(self):
         """Pixels per nanometer"""
@@ -88,32 +131,60 @@ class StreamBuilder:
         Returns:
             (n,3) array: Array of dwells.
         """
-        # remove the dwells that are below the cutoff time
-        dwells_slices = [ds[ds[:, 0] > self.cutoff_time] for ds in self.dwells_slices]
-        # split the dwells
-        split_dwells_slices = [
-            self.split_dwells(ds, self.max_dwt) for ds in dwells_slices
-        ]
-        del dwells_slices
-
-        # connect the split slices in a list, reverse the order of every other one if the serpentine order is used
-        if self.scanning_order == "serial":
-            full_dwells_list = [dwls for sds in split_dwells_slices for dwls in sds]
-        else:
-            full_dwells_list = []
-            i = 0
-            for sds in split_dwells_slices:
-                for dwls in sds:
-                    if i % 2 == 1:
-                        full_dwells_list.append(np.flipud(dwls))
-                    else:
-                        full_dwells_list.append(dwls)
-        # concatenate the list
-        stream_dwells = np.vstack(full_dwells_list)
+        # concatenate the split slices
+        stream_dwells = np.vstack(list(self.iter_stream_dwells()))
         # convert nm to px
         stream_dwells[:, 1:] *= self.ppn
         return stream_dwells
 
+    def iter_stream_dwells(self, dwells_slices=None):
+        """Generates the stream dwells one pass at a time: removes the small dwells, splits the dwells of each slice into passes and orders them.
+        Only one slice is processed at a time, so dwells_slices can be a generator.
+        Args:
+            dwells_slices (iterable of (n,3) arrays, optional): Per layer dwells (t, x, y) in nm. Defaults to self.dwells_slices.
+        Yields:
+            (n,3) array: Dwells of the pass in nm.
+        """
+        if dwells_slices is None:
+            dwells_slices = self.dwells_slices
+        i = 0
+        for ds in dwells_slices:
+            # remove the dwells that are below the cutoff time
+            ds = ds[ds[:, 0] > self.cutoff_time]
+            if ds.shape[0] == 0:
+                continue
+            # split the dwells, reverse the order of every other one if the serpentine order is used
+            for dwls in self.split_dwells(ds, self.max_dwt):
+                if self.scanning_order == "serpentine" and i % 2 == 1:
+                    yield np.flipud(dwls)
+                else:
+                    yield dwls
+                i += 1
+
+    def write_stream(self, file_path, dwells_slices=None, limits=None):
+        """Writes the stream file one pass at a time, without building the whole stream in memory (see StreamWriter).
+        Args:
+            file_path (str): Path to the .str file to which to write.
+            dwells_slices (iterable of (n,3) arrays, optional): Per layer dwells (t, x, y) in nm, e.g. a generator. Defaults to self.dwells_slices.
+            limits ((2,2) array, optional): Limits of the stream in x and y in nm (as Stream.limits), which are centred on the screen.
+                If None, the stream is not centred. Defaults to None.
+        Returns:
+            StreamWriter: Writer of the file, with the number of dwells and the total time.
+        """
+        translation = np.zeros(2)
+        if limits is not None:
+            stream_centre = self.ppn * (limits[:, 1] + limits[:, 0]) / 2
+            translation = np.array(self.addressable_pixels) / 2 - stream_centre
+        with StreamWriter(
+            file_path, addressable_pixels=self.addressable_pixels, max_dwt=self.max_dwt
+        ) as stream_writer:
+            for dwls in self.iter_stream_dwells(dwells_slices):
+                # convert nm to px
+                dwls = dwls[:, :3] * [1, self.ppn, self.ppn]
+                dwls[:, 1:] += translation
+                stream_writer.write(dwls)
+        return stream_writer
+
     @staticmethod
     def split_dwells(dwells, max_dwt):
         """Takes a matrix of dwells and splits them so that none of them
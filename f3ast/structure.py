@@ -1,12 +1,23 @@
+from pathlib import Path
+
 import numpy as np
 import trimesh
+from joblib import Parallel, delayed
 from mpl_toolkits import mplot3d
 from scipy.spatial.transform import Rotation
-from trimesh.intersections import mesh_multiplane
 
 from .branches import get_branch_connections, split_intersection
+from .distance_cache import DistanceMatrixCache, get_points_distance_matrix
 from .plotting import create_3d_axes, points3d, set_axes_equal
-from .slicing import split_eqd
+from .sliced_structure import SlicedStructure
+from .slicing import (
+    SliceLayer,
+    get_adaptive_z_levels,
+    get_mesh_intersection_lines,
+    split_eqd,
+)
+from .slicing_cache import SlicingCache, get_slicing_key
+from .stl import load_stl
 
 
 class Structure(trimesh.Trimesh):
@@ -17,14 +28,42 @@ class Structure(trimesh.Trimesh):
         file_path (str): Path to the STL file.
         pitch (float): Pitch for the slicing
         fill (bool): If true attempts to fill in the STL file (not implemented yet)
+        n_jobs (int): Number of processes used for slicing. -1 uses all the cores.
+        adaptive_layers (bool): If true, the layer thickness adapts to the slope of the mesh (see get_z_levels).
+        store_dir (str): If given, the slice points are written to a memory-mapped on-disk store in a subdirectory of store_dir
+            while slicing (see SlicedStructure.open), so that structures larger than memory can be sliced.
+        slicing_cache (SlicingCache): On-disk cache of the slicing in cache_dir (at most cache_max_size bytes). None if cache_dir is not given.
+        distance_cache (DistanceMatrixCache): In-memory cache of the distance matrices of the slices (at most distance_cache_max_size bytes).
     """
 
-    def __init__(self, *args, file_path=None, pitch=3, fill=False, **kwargs) -> None:
+    def __init__(
+        self,
+        *args,
+        file_path=None,
+        pitch=3,
+        fill=False,
+        n_jobs=1,
+        adaptive_layers=False,
+        store_dir=None,
+        cache_dir=None,
+        cache_max_size=2**31,
+        distance_cache_max_size=2**28,
+        **kwargs
+    ) -> None:
         if not "face_colors" in kwargs:
             kwargs["face_colors"] = (17, 103, 177)
         super().__init__(*args, **kwargs)
         self.pitch = pitch
         self.fill = fill
+        self.n_jobs = n_jobs
+        self.adaptive_layers = adaptive_layers
+        self.store_dir = store_dir
+        self.slicing_cache = (
+            SlicingCache(cache_dir, max_size=cache_max_size)
+            if cache_dir is not None
+            else None
+        )
+        self.distance_cache = DistanceMatrixCache(max_size=distance_cache_max_size)
 
         self.file_path = file_path
         self.clear_slicing()
@@ -40,47 +79,45 @@ class Structure(trimesh.Trimesh):
         Returns:
             Structure
         """
-        msh = trimesh.load_mesh(file_path, file_type="stl")
-        # create the structure and add file path
-        struct = cls(
-            vertices=msh.vertices, faces=msh.faces, file_path=file_path, **kwargs
-        )
+        vertices, faces = load_stl(file_path)
+        # create the structure and add file path. The vertices are already merged so trimesh does not need to process them.
+        kwargs.setdefault("process", False)
+        struct = cls(vertices=vertices, faces=faces, file_path=file_path, **kwargs)
         return struct
 
+    @property
+    def sliced_structure(self):
+        """SlicedStructure holding all the slicing data. The slicing properties below are views into it."""
+        if self._sliced_structure is None:
+            self.generate_slices()
+        return self._sliced_structure
+
     @property
     def slices(self):
         """List of arrays of (n,2) points in each slice"""
-        if self._slices is None:
-            self.generate_slices()
-        return self._slices
+        return self.sliced_structure.get_slices()
 
     @property
     def branches(self):
         """List of arrays signifying to which branch does each point in slice correspond to."""
-        if self._branches is None:
-            self.generate_slices()
-        return self._branches
+        return self.sliced_structure.get_branches()
 
     @property
     def branch_lengths(self):
-        """Branch lengths."""
-        if self._branch_lengths is None:
-            self.generate_slices()
-        return self._branch_lengths
+        """Branch lengths. List of arrays of lengths of branches in each slice."""
+        return self.sliced_structure.get_branch_lengths()
 
     @property
     def branch_connections(self):
         """Branch connection. List of lists. branch_connections[i][j] is the list of indices of which branches in the slice i-1 is the branch j in slice i connected."""
-        if self._branch_connections is None:
+        if self._sliced_structure is None or not self._sliced_structure.has_connections:
             self.generate_slices(branch_connectivity=True)
-        return self._branch_connections
+        return self._sliced_structure.get_branch_connections()
 
     @property
     def z_levels(self):
         """Array of z values where the slices are."""
-        if self._z_levels is None:
-            self.generate_slices()
-        return self._z_levels
+        return self.sliced_structure.z_levels
 
     @property
     def dz_slices(self):
@@ -94,15 +131,14 @@ class Structure(trimesh.Trimesh):
         Returns:
             bool
         """
-        if self.slices is None:
+        if self._sliced_structure is None:
             return False
         return True
 
     def centre(self):
         """Centres the structure to (0, 0)"""
         self.rezero()
-        transf = np.zeros((4, 4)).astype(float)
-        transf[:3, :3] = np.eye(3)
+        transf = np.eye(4)
         transf[0, -1] = -self.centroid[0]
         transf[1, -1] = -self.centroid[1]
         self.apply_transform(transf)
@@ -113,7 +149,6 @@ class Structure(trimesh.Trimesh):
         transf[3, 3] = 0
         transf *= scale
         self.apply_transform(transf)
-        self.clear_slicing()
 
     def rotate(self, rotation_axis, rotation_angle):
         """
@@ -129,7 +164,6 @@ class Structure(trimesh.Trimesh):
         transf_matrix = np.eye(4)
         transf_matrix[:3, :3] = r.as_matrix()
         self.apply_transform(transf_matrix)
-        self.clear_slicing()
 
     def mirror(self, normal=(1, 0, 0)):
         """
@@ -146,15 +180,50 @@ class Structure(trimesh.Trimesh):
         transf_matrix = np.eye(4)
         transf_matrix[:3, :3] -= 2 * np.outer(unit_normal, unit_normal)
         self.apply_transform(transf_matrix)
-        self.clear_slicing()
+
+    def apply_transform(self, matrix):
+        """Transforms the mesh by the homogeneous transformation matrix.
+        If the transform keeps the layers (an isometry in xy plus a translation in z), the slicing is transformed with the mesh,
+        otherwise it is cleared and the structure is resliced when needed.
+
+        Args:
+            matrix ((4,4) array): Homogeneous transformation matrix.
+
+        Returns:
+            Structure: self
+        """
+        super().apply_transform(matrix)
+        # the slicing is not set up yet during the construction of the mesh
+        if getattr(self, "_sliced_structure", None) is None:
+            return self
+        if preserves_layers(matrix):
+            # branches, their lengths and connectivity do not change
+            self._sliced_structure.apply_layer_transform(matrix)
+        else:
+            self.clear_slicing()
+        return self
 
     def clear_slicing(self):
         """Clears the slicing of the structure."""
-        self._slices = None
-        self._branches = None
-        self._branch_lengths = None
-        self._branch_connections = None
-        self._z_levels = None
+        self._sliced_structure = None
+        self.distance_cache.clear()
+
+    def get_distance_matrix(self, layer, threshold):
+        """Gets the sparse matrix of distances between the points of the slice that are within the threshold.
+        The matrices are kept in distance_cache, so that solving again with different model parameters does not repeat the neighbour search.
+
+        Args:
+            layer (int): Index of the layer.
+            threshold (float): Maximal distance which to consider.
+
+        Returns:
+            coo_matrix: Sparse distance matrix.
+        """
+        distance_matrix = self.distance_cache.load(layer, threshold)
+        if distance_matrix is None:
+            distance_matrix = get_points_distance_matrix(self.slices[layer], threshold)
+            self.distance_cache.save(layer, threshold, distance_matrix)
+        return distance_matrix
 
     def plot_mpl(self, ax=None):
         """Plots the mesh vertices in matplotlib window.
@@ -180,10 +249,8 @@ class Structure(trimesh.Trimesh):
         Returns:
             slices (list of (n,3) arrays)
         """
-        return [
-            np.hstack([sl, z * np.ones((sl.shape[0], 1))])
-            for sl, z in zip(self.slices, self.z_levels)
-        ]
+        points = self.get_sliced_points()
+        return np.split(points, self.sliced_structure.layer_offsets[1:-1])
 
     def get_sliced_points(self):
         """Gets the sliced points in a matrix form.
@@ -191,9 +258,20 @@ class Structure(trimesh.Trimesh):
         Returns:
             points ((n, 3) array)
         """
-        points = np.vstack(self.get_3dslices())
+        points = self.sliced_structure.get_points3d()
         return points
 
+    def get_xy_limits(self):
+        """Gets the limits of the structure in x and y: of the sliced points if the structure is sliced, otherwise of the mesh.
+
+        Returns:
+            (2, 2) array: Minimum and maximum (columns) of x and y (rows).
+        """
+        if self.is_sliced:
+            points = self.sliced_structure.points
+            return np.column_stack((points.min(axis=0), points.max(axis=0)))
+        return self.bounds[:, :2].T.copy()
+
     def plot_slices(self, *args, **kwargs):
         """Plots the slices in matplotlib.
 
@@ -213,7 +291,7 @@ class Structure(trimesh.Trimesh):
         scene.set_camera(angles=np.deg2rad([45, 0, 0]))
         return scene.show()
 
-    def generate_slices(self, branch_connectivity=True):
+    def generate_slices(self, branch_connectivity=True, n_jobs=None):
         """Gets the silces and all the corresponding information.
 
         Args:
@@ -221,37 +299,129 @@ class Structure(trimesh.Trimesh):
             the connectivity of branches required for resistance calculations.
             This can be useful to save time if resistance is not going to be calculated.
             Defaults to True.
+            n_jobs (int, optional): Number of processes over which the z bands are sliced. Defaults to self.n_jobs.
         """
+        if self.slicing_cache is not None:
+            slicing_key = self.get_slicing_key()
+            sliced_structure = self.slicing_cache.load(slicing_key)
+            if sliced_structure is not None and (
+                not branch_connectivity or sliced_structure.has_connections
+            ):
+                if self.store_dir is not None:
+                    # the cached slicing is written to the store, so that the points are memory-mapped
+                    sliced_structure = SlicedStructure.from_layers(
+                        sliced_structure.iter_layers(),
+                        store_dir=Path(self.store_dir) / slicing_key,
+                    )
+                self._sliced_structure = sliced_structure
+                return
+
         print("Slicing...")
-        intersection_lines, self._z_levels = self.get_intersection_lines()
-
-        # split into connected components (branches)
-        branch_intersections_slices = [
-            split_intersection(inter) for inter in intersection_lines
-        ]
-
-        # get branch connectivity. This is the slowest part and might not be necessary if not doing the resistance.
-        # t0 = time.time()
-        if branch_connectivity:
-            connection_distance = self.pitch + 0.01
-            self._branch_connections = get_branch_connections(
-                branch_intersections_slices, connection_distance
-            )
-        # print(time.time() - t0)
+        store_dir = None
+        if self.store_dir is not None:
+            store_dir = Path(self.store_dir) / self.get_slicing_key()
+        self._sliced_structure = SlicedStructure.from_layers(
+            self._slice_layers(branch_connectivity=branch_connectivity, n_jobs=n_jobs),
+            store_dir=store_dir,
+        )
+        if self.slicing_cache is not None:
+            self.slicing_cache.save(slicing_key, self._sliced_structure)
+        print("Sliced")
 
-        # get equally separated points and branch indices
-        self._slices, self._branches, self._branch_lengths = split_eqd(
-            branch_intersections_slices, self.pitch
+    def get_slicing_key(self):
+        """Gets the key under which the slicing of the structure is cached.
+
+        Returns:
+            str: Hash of the mesh, pitch and f3ast version.
+        """
+        return get_slicing_key(
+            self.vertices,
+            self.faces,
+            self.pitch,
+            adaptive_layers=self.adaptive_layers,
         )
 
-        print("Sliced")
+    def iter_slices(self, chunk_size=64, branch_connectivity=True, n_jobs=None):
+        """Generates the slices one layer at a time. If the structure is already sliced, the stored slices are used.
+        Otherwise, the structure is sliced in chunks of chunk_size z levels and only a bounded number of chunks is kept in memory at a time.
+        The generated slices are not stored in the structure.
 
-    def get_intersection_lines(self):
-        """Gets the intersections and z_levels.
+        Args:
+            chunk_size (int, optional): Number of z levels to slice at once. Defaults to 64.
+            branch_connectivity (bool, optional): If false, does not calculate the connectivity of branches. Defaults to True.
+            n_jobs (int, optional): Number of processes over which the chunks are sliced. Defaults to self.n_jobs.
+
+        Yields:
+            SliceLayer: Record of a single slice.
+        """
+        if self._sliced_structure is not None and (
+            not branch_connectivity or self._sliced_structure.has_connections
+        ):
+            yield from self._sliced_structure.iter_layers()
+            return
+        yield from self._slice_layers(chunk_size, branch_connectivity, n_jobs)
+
+    def _slice_layers(self, chunk_size=64, branch_connectivity=True, n_jobs=None):
+        """Slices the structure in z bands of chunk_size levels and yields the slice records in order.
+        Each band is sliced (in parallel if n_jobs != 1) using only the triangles that overlap it,
+        the connectivity between the bands is calculated when stitching them together.
+        """
+        if n_jobs is None:
+            n_jobs = self.n_jobs
+        z_levels = self.get_z_levels()
+        triangles_z = self.triangles[:, :, 2]
+        faces_minz, faces_maxz = triangles_z.min(axis=1), triangles_z.max(axis=1)
+        # the bands are sliced in parallel processes, so only a single band uses threads for its branch connections
+        connection_jobs = n_jobs if z_levels.size <= chunk_size else 1
+
+        def band_tasks():
+            for chunk_start in range(0, z_levels.size, chunk_size):
+                band_z_levels = z_levels[chunk_start : chunk_start + chunk_size]
+                in_band = (faces_maxz >= band_z_levels[0]) & (
+                    faces_minz <= band_z_levels[-1]
+                )
+                if not np.any(in_band):
+                    continue
+                # send only the vertices and faces of the band to the worker
+                band_vertices, band_faces = np.unique(
+                    self.faces[in_band], return_inverse=True
+                )
+                yield delayed(slice_band)(
+                    self.vertices[band_vertices],
+                    band_faces.reshape(-1, 3),
+                    band_z_levels,
+                    self.pitch,
+                    branch_connectivity,
+                    connection_jobs,
+                )
+
+        connection_distance = self.pitch + 0.01
+        index = 0
+        # last slice of the previous band for getting the branch connections between the bands
+        branch_intersections_below = None
+        for band in Parallel(n_jobs=n_jobs, return_as="generator")(band_tasks()):
+            if band is None:
+                continue
+            band_layers_data, branch_intersections_ends = band
+            if branch_connectivity and branch_intersections_below is not None:
+                # stitch the band to the one below
+                connections = get_branch_connections(
+                    [branch_intersections_below, branch_intersections_ends[0]],
+                    connection_distance,
+                )[1]
+                band_layers_data[0] = band_layers_data[0][:-1] + (connections,)
+            branch_intersections_below = branch_intersections_ends[1]
+            for layer_data in band_layers_data:
+                yield SliceLayer(index, *layer_data)
+                index += 1
+
+    def get_z_levels(self):
+        """Gets the z levels at which the structure is sliced. Some of them can have empty intersections.
+        The layers are pitch/2 thick, unless adaptive_layers is set. In that case, the layer thickness is between pitch/5
+        and 2*pitch, chosen so that the cross-section moves by at most pitch (the resolution of the slice points) between the layers.
 
         Returns:
-            intersection_lines (list of arrays): A list of (n,2,2) arrays representing the intersection lines as start_node-end_node
-            z_levels (array): Array of z levels corresponding to the intersections.
+            array: Array of z levels.
         """
         mindz = self.pitch / 5
         maxdz = 2 * self.pitch
@@ -262,19 +432,96 @@ class Structure(trimesh.Trimesh):
         # move a bit to avoid artifacts
         minz += 1e-3
         maxz -= 1e-3
-        z_levels = np.arange(minz, maxz, slice_height)
+        if self.adaptive_layers:
+            return get_adaptive_z_levels(
+                self.triangles,
+                self.face_normals,
+                mindz,
+                maxdz,
+                self.pitch,
+                minz=minz,
+                maxz=maxz,
+            )
+        return np.arange(minz, maxz, slice_height)
 
-        # define the slicing plane
-        plane_normal = np.array((0.0, 0.0, 1.0))
-        plane_orig = np.zeros(3).astype(float)
+    def get_intersection_lines(self, z_levels=None):
+        """Gets the intersections and z_levels.
 
-        intersection_lines, _, _ = mesh_multiplane(
-            self, plane_orig, plane_normal, z_levels
-        )
-        # drop the empty intersections
-        nonempty = np.array(len(inter) != 0 for inter in intersection_lines).astype(
-            bool
+        Args:
+            z_levels (array, optional): z levels at which to intersect. Defaults to the full range of z levels given by get_z_levels.
+
+        Returns:
+            intersection_lines (list of arrays): A list of (n,2,2) arrays representing the intersection lines as start_node-end_node
+            z_levels (array): Array of z levels corresponding to the intersections.
+        """
+        if z_levels is None:
+            z_levels = self.get_z_levels()
+        return get_mesh_intersection_lines(self, z_levels)
+
+
+def preserves_layers(matrix, atol=1e-12):
+    """Checks if the transform keeps the slicing layers, i.e. it is an isometry in the xy plane
+    combined with a translation in z. Rotations about z axis, mirroring through vertical planes and translations are such transforms.
+
+    Args:
+        matrix ((4,4) array): Homogeneous transformation matrix.
+        atol (float, optional): Absolute tolerance for the checks. Defaults to 1e-12.
+
+    Returns:
+        bool:
+    """
+    matrix = np.asanyarray(matrix, dtype=float)
+    xy_transform = matrix[:2, :2]
+    return (
+        np.allclose(matrix[2, :3], [0, 0, 1], atol=atol)
+        and np.allclose(matrix[:2, 2], 0, atol=atol)
+        and np.allclose(matrix[3], [0, 0, 0, 1], atol=atol)
+        and np.allclose(xy_transform @ xy_transform.T, np.eye(2), atol=atol)
+    )
+
+
+def slice_band(vertices, faces, z_levels, pitch, branch_connectivity=True, n_jobs=1):
+    """Slices a band of the mesh given by the vertices and faces at the given z levels.
+    The first slice of the band has no branch connections. This is used as a worker for parallel slicing.
+
+    Args:
+        vertices ((n,3) array): Vertices of the band.
+        faces ((m,3) array): Faces of the band.
+        z_levels (array): z levels at which to slice.
+        pitch (float): Pitch for the slicing.
+        branch_connectivity (bool, optional): If false, does not calculate the connectivity of branches. Defaults to True.
+        n_jobs (int, optional): Number of threads over which the branch connections are calculated (see get_branch_connections). Defaults to 1.
+
+    Returns:
+        tuple: list of (z, points, branches, branch_lengths, branch_connections) tuples for each nonempty slice and
+        the branch intersections of the first and last slice. None if there are no intersections in the band.
+    """
+    band_mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+    intersection_lines, z_levels = get_mesh_intersection_lines(band_mesh, z_levels)
+    if len(intersection_lines) == 0:
+        return None
+
+    # split into connected components (branches)
+    branch_intersections_slices = [
+        split_intersection(inter) for inter in intersection_lines
+    ]
+
+    # get branch connectivity. This is the slowest part and might not be necessary if not doing the resistance.
+    if branch_connectivity:
+        connection_distance = pitch + 0.01
+        branch_connections = get_branch_connections(
+            branch_intersections_slices, connection_distance, n_jobs=n_jobs
         )
-        z_levels = z_levels[nonempty].flatten()
-        intersection_lines = [inter for inter in intersection_lines if len(inter) != 0]
-        return intersection_lines, z_levels
+    else:
+        branch_connections = [None] * len(branch_intersections_slices)
+
+    # get equally separated points and branch indices
+    slices, branches, branch_lengths = split_eqd(branch_intersections_slices, pitch)
+    band_layers_data = list(
+        zip(z_levels, slices, branches, branch_lengths, branch_connections)
+    )
+    branch_intersections_ends = (
+        branch_intersections_slices[0],
+        branch_intersections_slices[-1],
+    )
+    return band_layers_data, branch_intersections_ends
@@ -0,0 +1,257 @@
+import copy
+import itertools
+
+import numpy as np
+from joblib import Parallel, delayed
+
+from .distance_cache import DistanceMatrixCache
+from .solver import DwellSolver, get_layer_chunks
+from .stream_builder import StreamBuilder
+
+# solver settings that the sweep does not support, since it solves the points without the solution cache, checkpoint and callback
+UNSUPPORTED_SETTINGS = ("cache_dir", "checkpoint_dir", "callback")
+
+
+def get_parameter_points(parameter_grid):
+    """Gets all the combinations of the parameter values.
+
+    Args:
+        parameter_grid (dict): Values of each parameter, e.g. {"sigma": [3, 4, 5], "gr": [0.1, 0.2]}.
+
+    Returns:
+        list of dicts: Parameters of each point of the sweep, with the last parameter varying fastest.
+    """
+    names = list(parameter_grid)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*(parameter_grid[name] for name in names))
+    ]
+
+
+def solve_sweep_layers(
+    models, layers, dz_slices, sliced_structure=None, layer_arguments=None, **kwargs
+):
+    """Solves consecutive layers of the structure for each of the models. Runs in the parallel jobs.
+    When the proximity matrices are built from the slice records, the models share a distance cache, so the neighbours of each layer are
+    only searched for the first model (the one with the largest neighbour threshold).
+
+    Args:
+        models (list of Model): Models of the sweep, sorted by decreasing neighbour threshold.
+        layers (range): Indices of the consecutive layers.
+        dz_slices (array): Layer heights.
+        sliced_structure (SlicedStructure, optional): Slices of the structure (see DwellSolver.solve_layers).
+        layer_arguments (list, optional): For each model, the extra arguments of get_slice_proximity_matrix for each layer (see DwellSolver.solve_layers).
+        **kwargs: Other arguments of DwellSolver.solve_layers.
+
+    Returns:
+        list: Dwell times of each layer for each model.
+    """
+    if sliced_structure is not None:
+        distance_cache = DistanceMatrixCache()
+        for model in models:
+            model.distance_cache = distance_cache
+    if layer_arguments is None:
+        layer_arguments = [None] * len(models)
+    return [
+        DwellSolver.solve_layers(
+            model,
+            layers,
+            dz_slices,
+            sliced_structure=sliced_structure,
+            layer_arguments=model_layer_arguments,
+            **kwargs,
+        )
+        for model, model_layer_arguments in zip(models, layer_arguments)
+    ]
+
+
+class ParameterSweep:
+    """Solves the dwell times of a structure for a grid of model parameters.
+    Rather than solving each point of the grid on its own, the sweep:
+        - solves only once for the parameters by which the proximity matrices are linear (Model.LINEAR_PARAMETERS, e.g. gr), and scales the dwell times,
+        - solves the remaining points together, so that the neighbour searches of each layer are shared by all the points,
+        - dispatches all the layers of all the points to a single pool of jobs.
+
+    Attributes:
+        model (Model): Model with the structure. The swept parameters are its attributes, which are set on copies of the model.
+            The per-layer parameters of the model (e.g. resistance) are shared by all the points, except for the points of the parameters
+            they depend on (Model.LAYER_PARAMETERS, e.g. single_pixel_width), which recalculate them.
+        parameter_points (list of dicts): Parameters of each point of the sweep.
+        solver_settings (dict): Settings of the DwellSolver (e.g. the "solver" section of the settings file). The settings in UNSUPPORTED_SETTINGS must not be set.
+        dwell_times_points (list): Solution for each point of the sweep, as DwellSolver.dwell_times_slices.
+    """
+
+    def __init__(self, model, parameter_grid, solver_settings=None):
+        self.model = model
+        self.parameter_points = get_parameter_points(parameter_grid)
+        for name in parameter_grid:
+            if not hasattr(model, name):
+                raise ValueError("Unknown model parameter: {}".format(name))
+            # the dwell times of the linear parameters are scaled by the ratio of the values
+            if name in model.LINEAR_PARAMETERS and (
+                getattr(model, name) == 0 or 0 in parameter_grid[name]
+            ):
+                raise ValueError(
+                    "The linear model parameter cannot be zero: {}".format(name)
+                )
+        self.solver_settings = solver_settings or {}
+        for name in UNSUPPORTED_SETTINGS:
+            if self.solver_settings.get(name) is not None:
+                raise ValueError(
+                    "The parameter sweep does not support the solver setting: {}".format(
+                        name
+                    )
+                )
+        self.dwell_times_points = None
+
+    def get_point_model(self, parameters):
+        """Gets a copy of the model with the parameters of the point. The copy shares the per-layer parameters of the model,
+        unless the point changes the parameters they depend on (see Model.LAYER_PARAMETERS).
+
+        Args:
+            parameters (dict): Parameters of the point.
+
+        Returns:
+            Model
+        """
+        model = copy.copy(self.model)
+        for name, value in parameters.items():
+            setattr(model, name, value)
+        if any(name in model.LAYER_PARAMETERS for name in parameters):
+            model.get_layer_parameters()
+        return model
+
+    def get_solve_points(self):
+        """Splits the parameters of each point into the ones that need a solve and the linear ones.
+
+        Returns:
+            tuple: parameters of the points to solve (list of dicts), for each point of the sweep the index of the point to solve (list)
+                and the scale of its dwell times (list)
+        """
+        solve_points = []
+        point_indices = []
+        point_scales = []
+        for parameters in self.parameter_points:
+            scale = 1.0
+            solve_parameters = {}
+            for name, value in parameters.items():
+                if name in self.model.LINEAR_PARAMETERS:
+                    # the point is solved with the value of the model
+                    scale *= getattr(self.model, name) / value
+                else:
+                    solve_parameters[name] = value
+            if solve_parameters not in solve_points:
+                solve_points.append(solve_parameters)
+            point_indices.append(solve_points.index(solve_parameters))
+            point_scales.append(scale)
+        return solve_points, point_indices, point_scales
+
+    def solve_dwells(self, n_jobs=None):
+        """Solves for the dwell times of each point of the sweep and stores them in self.dwell_times_points.
+        The layers are batched into chunks as in DwellSolver.solve_dwells, and each job solves its chunk for all the points.
+        The chunks are dispatched largest first, so that they do not end up last on a single job.
+
+        Args:
+            n_jobs (int, optional): Number of parallel jobs. Defaults to the solver settings.
+        """
+        print("Solving the parameter sweep...")
+        solver = DwellSolver(self.model, **self.solver_settings)
+        method = solver.method
+        if solver.warm_start and method == "lsq_linear":
+            method = "lbfgsb"
+        backend, default_n_jobs = solver.get_parallel_backend(method)
+        n_jobs = default_n_jobs if n_jobs is None else n_jobs
+        shared = n_jobs == 1 or backend in ("sequential", "threading")
+
+        solve_points, point_indices, point_scales = self.get_solve_points()
+        models = [
+            solver.get_solve_model(method, self.get_point_model(parameters))
+            for parameters in solve_points
+        ]
+        # the largest neighbour threshold first, so that the distance matrices of the others are filtered from it
+        model_order = np.argsort(
+            [-model.get_nb_threshold() for model in models], kind="stable"
+        )
+        models = [models[i] for i in model_order]
+        # the options are shared by the points, so the tile halo must cover the largest interaction range
+        solve_options = solver.get_solve_options(method, model=models[0])
+        structure_models = models
+        if not shared:
+            models = [model.without_structure() for model in models]
+
+        struct = self.model.struct
+        dz_slices = struct.dz_slices
+        n_layers = dz_slices.size
+        sliced_structure = struct.sliced_structure
+        layer_sizes = np.diff(sliced_structure.layer_offsets)[:n_layers]
+        chunks = get_layer_chunks(layer_sizes, solver.chunk_points)
+        if len(chunks) == 1:
+            # a single chunk runs on a single job, so the tiles or components of its layers are solved in parallel instead
+            solve_options = solver.get_solve_options(
+                method, layer_jobs=n_jobs, model=structure_models[0]
+            )
+        chunk_order = np.argsort(
+            [-layer_sizes[chunk.start : chunk.stop].sum() for chunk in chunks],
+            kind="stable",
+        )
+        tasks = (
+            delayed(solve_sweep_layers)(
+                models,
+                chunks[c],
+                dz_slices[chunks[c].start : chunks[c].stop],
+                sliced_structure=None if shared else sliced_structure,
+                layer_arguments=(
+                    None
+                    if shared
+                    else [
+                        [model.get_layer_arguments(i) for i in chunks[c]]
+                        for model in structure_models
+                    ]
+                ),
+                warm_start=solver.warm_start,
+                **solve_options,
+            )
+            for c in chunk_order
+        )
+        results = Parallel(n_jobs=n_jobs, backend=backend)(tasks)
+        chunk_results = [None] * len(chunks)
+        for c, chunk_dwell_times in zip(chunk_order, results):
+            chunk_results[c] = chunk_dwell_times
+
+        dwell_times_solved = [[] for _ in models]
+        for chunk_dwell_times in chunk_results:
+            for i, dwell_times_slices in zip(model_order, chunk_dwell_times):
+                dwell_times_solved[i].extend(dwell_times_slices)
+        self.dwell_times_points = [
+            [scale * dwell_times for dwell_times in dwell_times_solved[i]]
+            for i, scale in zip(point_indices, point_scales)
+        ]
+        print("Solved")
+
+    def get_dwells_slices(self, point):
+        """Returns the dwells of the point of the sweep as a per-slice list (see DwellSolver.get_dwells_slices).
+
+        Args:
+            point (int): Index of the point of the sweep.
+        """
+        if self.dwell_times_points is None:
+            self.solve_dwells()
+        slices3d = self.model.struct.get_3dslices()
+        return [
+            np.hstack([dwt[:, np.newaxis], sl3d])
+            for dwt, sl3d in zip(self.dwell_times_points[point], slices3d)
+        ]
+
+    def get_streams(self, **kwargs):
+        """Builds the streams of all the points of the sweep.
+
+        Args:
+            **kwargs: Arguments of the StreamBuilder (e.g. the "stream_builder" section of the settings file).
+
+        Returns:
+            list of Stream: Stream of each point of the sweep.
+        """
+        return [
+            StreamBuilder(self.get_dwells_slices(i), **kwargs).get_stream()
+            for i in range(len(self.parameter_points))
+        ]
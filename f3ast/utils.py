@@ -10,6 +10,28 @@ import hjson
 # TODO: remove os and just use pathlib
 
 
+def set_numba_threading_layer():
+    """Sets the threading layer of numba, unless it is set by the user (numba.config.THREADING_LAYER or the NUMBA_THREADING_LAYER
+    environment variable). OpenMP is preferred over TBB, since a process that has started the TBB workers hangs at exit after using
+    a multiprocessing pool. If OpenMP is not available, any threadsafe layer is used. The layer is a setting of the whole process,
+    which numba reads when it first runs a parallel function.
+    """
+    # imported here, so that they are not exported by the star import of the package
+    import importlib
+
+    from numba import config
+
+    if "NUMBA_THREADING_LAYER" in os.environ or config.THREADING_LAYER != "default":
+        return
+    # the OpenMP layer is an extension module of numba, which fails to load without the OpenMP runtime
+    try:
+        importlib.import_module("numba.np.ufunc.omppool")
+    except (ImportError, OSError):
+        config.THREADING_LAYER = "threadsafe"
+    else:
+        config.THREADING_LAYER = "omp"
+
+
 def load_settings(file_path="settings.hjson"):
     """Loads the settings from the given path.
 
@@ -0,0 +1,33 @@
+import pytest
+
+from f3ast import RRLModel, Structure, load_settings
+
+
+@pytest.fixture
+def settings():
+    return load_settings()
+
+
+@pytest.fixture
+def structure_file():
+    return "tests/simple_ramp.stl"
+
+
+@pytest.fixture
+def structure(structure_file, settings):
+    return Structure.from_file(structure_file, **settings["structure"])
+
+
+@pytest.fixture
+def model_parameters():
+    return {
+        "gr": 0.15,
+        "k": 1,
+        "sigma": 4.4,
+        "doubling_length": 200,
+    }
+
+
+@pytest.fixture
+def rrl_model(structure, model_parameters):
+    return RRLModel(structure, model_parameters["gr"], model_parameters["sigma"])
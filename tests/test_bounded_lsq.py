@@ -0,0 +1,23 @@
+import numpy as np
+from scipy.optimize import lsq_linear
+from scipy.sparse import identity
+from scipy.sparse import random as sparse_random
+
+from f3ast.bounded_lsq import bounded_lsq_cd
+
+
+def test_bounded_lsq_cd_matches_lsq_linear():
+    rng = np.random.default_rng(0)
+    n = 200
+    # diagonally dominant matrix with a few active bounds
+    matrix = sparse_random(n, n, density=0.05, random_state=1, format="csr")
+    matrix = (matrix + 4 * identity(n)).tocsr()
+    y = rng.uniform(-1, 3, n)
+    upper_bound = np.full(n, 0.5)
+    result = bounded_lsq_cd(matrix, y, upper_bound, tol=1e-10)
+    reference = lsq_linear(matrix, y, bounds=(0, upper_bound), tol=1e-12)
+    np.testing.assert_allclose(result.x, reference.x, atol=1e-8)
+    assert np.isclose(result.residual_norm, np.linalg.norm(matrix @ result.x - y))
+    assert 0 < result.n_iter < 10000
+    assert result.converged
+    assert (result.x >= 0).all() and (result.x <= upper_bound).all()
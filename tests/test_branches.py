@@ -0,0 +1,125 @@
+import time
+
+import numpy as np
+import pytest
+from scipy.spatial import KDTree
+from trimesh.graph import connected_component_labels
+from trimesh.grouping import group_rows
+
+from f3ast import Structure
+from f3ast.branches import get_branch_connections, split_intersection
+
+
+def reference_split_intersection(intersection):
+    """The original implementation with one mask pass per component."""
+    grouped_rows = group_rows(intersection.reshape(-1, 2))
+    grouped_indices = np.array(
+        [[l, i] for i, ls in enumerate(grouped_rows) for l in ls]
+    )
+    node_indices = grouped_indices[np.argsort(grouped_indices[:, 0]), 1]
+    edges = node_indices.reshape(-1, 2)
+    conn_labels = connected_component_labels(edges, node_count=len(grouped_rows))
+    edge_labels = conn_labels[edges[:, 0]]
+    return [intersection[edge_labels == lbl, :, :] for lbl in np.unique(conn_labels)]
+
+
+def get_lattice_slice(n_loops):
+    """Slice of a lattice: a grid of n_loops x n_loops separate square loops, shuffled."""
+    rng = np.random.default_rng(0)
+    square = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=float)
+    loops = []
+    for x in range(n_loops):
+        for y in range(n_loops):
+            corners = square * 2 + np.array([3 * x, 3 * y])
+            loops.append(np.stack([corners, np.roll(corners, -1, axis=0)], axis=1))
+    intersection = np.concatenate(loops)
+    return intersection[rng.permutation(len(intersection))]
+
+
+@pytest.fixture
+def many_branch_slice():
+    return get_lattice_slice(30)
+
+
+def test_split_intersection_matches_reference(many_branch_slice):
+    split = split_intersection(many_branch_slice)
+    expected = reference_split_intersection(many_branch_slice)
+    assert len(split) == len(expected) == 900
+    for branch, expected_branch in zip(split, expected):
+        np.testing.assert_array_equal(branch, expected_branch)
+
+
+def test_split_intersection_benchmark():
+    def best_time(intersection):
+        times = []
+        for _ in range(5):
+            t0 = time.perf_counter()
+            split_intersection(intersection)
+            times.append(time.perf_counter() - t0)
+        return min(times)
+
+    # 16 times more loops: the sort-based split grows about linearly, while a pass per component, as in the reference,
+    # grows quadratically. The ratio of the times does not depend on the speed of the machine
+    small_time = best_time(get_lattice_slice(20))
+    large_time = best_time(get_lattice_slice(80))
+    assert large_time / small_time < 32
+
+
+def reference_slice_branch_connections(
+    separated_pts, separated_pts_below, connection_distance
+):
+    """The original pairwise KDTree implementation of the branch connections, counting coincident points as neighbours."""
+
+    def is_branch_nb(tree, branch_pts):
+        distance_matrix = tree.sparse_distance_matrix(
+            KDTree(branch_pts.reshape(-1, 2)), connection_distance, p=np.inf
+        )
+        if distance_matrix.nnz > 0:
+            return True, np.min(list(distance_matrix.values()))
+        return False, np.inf
+
+    this_slice_connections = []
+    for br_pts in separated_pts:
+        tree = KDTree(br_pts.reshape(-1, 2))
+        this_branch_connections, branch_min_distances = [], []
+        for k, branch_pts_below in enumerate(separated_pts_below):
+            nb, dist = is_branch_nb(tree, branch_pts_below)
+            if nb:
+                branch_min_distances.append(dist)
+                this_branch_connections.append(k)
+        this_branch_connections = np.array(this_branch_connections, dtype=int)
+        n_conn = len(this_branch_connections)
+        if n_conn > 1:
+            count = sum(is_branch_nb(tree, br_pts2)[0] for br_pts2 in separated_pts)
+            if count > 1 and count <= n_conn:
+                keep_indx = np.argsort(branch_min_distances, kind="stable")
+                this_branch_connections = this_branch_connections[
+                    keep_indx[: n_conn - count + 1]
+                ]
+        this_slice_connections.append(this_branch_connections)
+    return this_slice_connections
+
+
+@pytest.mark.parametrize(
+    "structure_file", ["tests/simple_ramp.stl", "tests/FunktyBall.stl"]
+)
+def test_branch_connections_match_reference(structure_file):
+    structure = Structure.from_file(structure_file, pitch=3)
+    intersection_lines, _ = structure.get_intersection_lines()
+    branch_intersections_slices = [
+        split_intersection(inter) for inter in intersection_lines
+    ]
+    connection_distance = structure.pitch + 0.01
+    branch_connections = get_branch_connections(
+        branch_intersections_slices, connection_distance, n_jobs=2
+    )
+    assert branch_connections[0] == []
+    for i in range(1, len(branch_intersections_slices)):
+        expected = reference_slice_branch_connections(
+            branch_intersections_slices[i],
+            branch_intersections_slices[i - 1],
+            connection_distance,
+        )
+        assert len(branch_connections[i]) == len(expected)
+        for conn, expected_conn in zip(branch_connections[i], expected):
+            np.testing.assert_array_equal(conn, expected_conn)
@@ -1,29 +1,27 @@
+import numpy as np
+import numpy.linalg as la
 import pytest
+import scipy.sparse as sp
 
 from f3ast import (
     DDModel,
+    DwellSolver,
     HeightCorrectionModel,
+    PhiAngleCorrectionModel,
     RRLModel,
     Stream,
     StreamBuilder,
     Structure,
-    load_settings,
 )
-
-
-@pytest.fixture
-def settings():
-    return load_settings()
-
-
-@pytest.fixture
-def structure_file():
-    return "tests/simple_ramp.stl"
-
-
-@pytest.fixture
-def structure(structure_file, settings):
-    return Structure.from_file(structure_file, **settings["structure"])
+from f3ast.compact_matrix import SymmetricMatrix
+from f3ast.solver import (
+    get_distance_matrix,
+    get_layer_chunks,
+    get_layer_components,
+    get_layer_tiles,
+    get_tiled_proximity_matrix,
+)
+from f3ast.stream import HEADER_COUNT_WIDTH, StreamWriter
 
 
 def test_structure_slicing(structure):
@@ -31,16 +29,6 @@ def test_structure_slicing(structure):
     assert structure.is_sliced
 
 
-@pytest.fixture
-def model_parameters():
-    return {
-        "gr": 0.15,
-        "k": 1,
-        "sigma": 4.4,
-        "doubling_length": 200,
-    }
-
-
 @pytest.fixture
 def dd_model(structure, settings, model_parameters):
     return DDModel(
@@ -52,17 +40,52 @@ def dd_model(structure, settings, model_parameters):
     )
 
 
-@pytest.fixture
-def rrl_model(structure, settings, model_parameters):
-    return RRLModel(structure, model_parameters["gr"], model_parameters["sigma"])
-
-
 def test_stream(dd_model, settings):
     stream_builder, _ = StreamBuilder.from_model(dd_model, **settings["stream_builder"])
     strm = stream_builder.get_stream()
     assert isinstance(strm, Stream)
 
 
+def get_line_dwells(n_slices, dwell_time=1.0):
+    # slices of three dwells along x at the height of the slice index
+    return [
+        np.column_stack((np.full(3, dwell_time), np.arange(3.0), np.full(3, float(i))))
+        for i in range(n_slices)
+    ]
+
+
+def test_serpentine_order():
+    stream_builder = StreamBuilder(get_line_dwells(4), max_dwt=5, cutoff_time=0)
+    passes = list(stream_builder.iter_stream_dwells())
+    assert len(passes) == 4
+    # every other pass is scanned in the opposite direction
+    for i, dwls in enumerate(passes):
+        expected_x = [0, 1, 2] if i % 2 == 0 else [2, 1, 0]
+        np.testing.assert_array_equal(dwls[:, 1], expected_x)
+    stream_builder = StreamBuilder(
+        get_line_dwells(4), max_dwt=5, cutoff_time=0, scanning_order="serial"
+    )
+    for dwls in stream_builder.iter_stream_dwells():
+        np.testing.assert_array_equal(dwls[:, 1], [0, 1, 2])
+    # the passes of a split slice alternate too
+    stream_builder = StreamBuilder(get_line_dwells(1, 8.0), max_dwt=5, cutoff_time=0)
+    first, second = stream_builder.iter_stream_dwells()
+    np.testing.assert_array_equal(first[:, 1], [0, 1, 2])
+    np.testing.assert_array_equal(second[:, 1], [2, 1, 0])
+
+
+def test_stream_cutoff_empty_slice():
+    dwells_slices = get_line_dwells(3)
+    # all the dwells of the middle slice are below the cutoff time
+    dwells_slices[1][:, 0] = 0.001
+    stream_builder = StreamBuilder(dwells_slices, max_dwt=5, cutoff_time=0.01)
+    stream = stream_builder.get_stream()
+    assert stream.dwells.shape[0] == 6
+    np.testing.assert_array_equal(
+        stream.dwells[:, 2] / stream_builder.ppn, [0, 0, 0, 2, 2, 2]
+    )
+
+
 @pytest.fixture
 def height_correction_model(structure, settings, model_parameters):
     return HeightCorrectionModel(
@@ -73,6 +96,73 @@ def height_correction_model(structure, settings, model_parameters):
     )
 
 
+def read_stream_file(file_path):
+    """Reads the stream file with the padding of the number of dwells in the header removed."""
+    lines = file_path.read_bytes().split(b"\n")
+    lines[2] = b" ".join(lines[2].split())
+    return b"\n".join(lines)
+
+
+def test_write_stream(rrl_model, settings, tmp_path):
+    stream_builder, _ = StreamBuilder.from_model(
+        rrl_model, **settings["stream_builder"]
+    )
+    stream = stream_builder.get_stream()
+    stream.write(tmp_path / "expected.str")
+    stream_writer = StreamBuilder.write_from_model(
+        tmp_path / "streamed.str", rrl_model, **settings["stream_builder"]
+    )
+    assert stream_writer.file_path == str(tmp_path / "streamed.str")
+    assert stream_writer.n_dwells == stream.dwells.shape[0]
+    assert stream_writer.get_time().total_seconds() == pytest.approx(
+        stream.get_time().total_seconds()
+    )
+    assert read_stream_file(tmp_path / "streamed.str") == read_stream_file(
+        tmp_path / "expected.str"
+    )
+    # the temporary file is moved to the output
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "expected.str",
+        "streamed.str",
+    ]
+
+
+def test_stream_writer(rrl_model, settings, tmp_path):
+    stream_builder, _ = StreamBuilder.from_model(
+        rrl_model, **settings["stream_builder"]
+    )
+    stream = stream_builder.get_stream(centre=True)
+    stream.write(tmp_path / "expected.str", centre=False)
+    with StreamWriter(tmp_path / "streamed.str") as stream_writer:
+        for dwells in np.array_split(stream.dwells, 7):
+            stream_writer.write(dwells)
+    # the number of dwells is padded to the width of its placeholder
+    assert (
+        (tmp_path / "streamed.str")
+        .read_bytes()
+        .startswith(
+            b"s16\n1\n" + str(stream.dwells.shape[0]).ljust(HEADER_COUNT_WIDTH).encode()
+        )
+    )
+    assert read_stream_file(tmp_path / "streamed.str") == read_stream_file(
+        tmp_path / "expected.str"
+    )
+    # the padded header is read as the one of Stream.write
+    np.testing.assert_array_equal(
+        Stream.from_file(tmp_path / "streamed.str").dwells,
+        Stream.from_file(tmp_path / "expected.str").dwells,
+    )
+    # an empty stream has the header and the end of the file of Stream.write
+    with StreamWriter(tmp_path / "empty.str") as stream_writer:
+        stream_writer.write(np.zeros((0, 3)))
+    assert read_stream_file(tmp_path / "empty.str") == b"s16\n1\n0 0"
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "empty.str",
+        "expected.str",
+        "streamed.str",
+    ]
+
+
 def test_height_correction_model(height_correction_model, rrl_model, settings):
     stream_builder, _ = StreamBuilder.from_model(
         height_correction_model, **settings["stream_builder"]
@@ -84,3 +174,482 @@ def test_height_correction_model(height_correction_model, rrl_model, settings):
     rrl_strm = rrl_stream_builder.get_stream()
     assert isinstance(strm, Stream)
     assert rrl_strm.get_time() < strm.get_time()
+
+
+def test_dd_model_slices_once(structure, settings, model_parameters, capsys):
+    dd_model = DDModel(
+        structure,
+        model_parameters["gr"],
+        model_parameters["k"],
+        model_parameters["sigma"],
+        **settings["dd_model"]
+    )
+    # the resistance is calculated from the stored slicing, which the solver reuses
+    assert structure.is_sliced
+    DwellSolver(dd_model, n_jobs=1).solve_dwells()
+    assert capsys.readouterr().out.count("Slicing...") == 1
+
+
+def test_iter_solve(structure, settings, model_parameters, dd_model):
+    streamed_model = DDModel(
+        Structure.from_file(structure.file_path, **settings["structure"]),
+        model_parameters["gr"],
+        model_parameters["k"],
+        model_parameters["sigma"],
+        get_parameters=False,
+        **settings["dd_model"]
+    )
+    streamed = list(
+        DwellSolver(streamed_model).iter_solve(
+            streamed_model.struct.iter_slices(chunk_size=10)
+        )
+    )
+    assert not streamed_model.struct.is_sliced
+
+    dwell_solver = DwellSolver(dd_model)
+    dwell_solver.solve_dwells()
+    assert len(streamed) == len(dwell_solver.dwell_times_slices)
+    for (slice_layer, dwells), expected in zip(
+        streamed, dwell_solver.dwell_times_slices
+    ):
+        np.testing.assert_allclose(dwells, expected)
+
+
+def test_iter_solve_settings(rrl_model, tmp_path):
+    solver_settings = dict(
+        method="coordinate_descent", warm_start=True, chunk_points=500, n_jobs=2
+    )
+    reference = DwellSolver(rrl_model, **solver_settings)
+    reference.solve_dwells()
+    recorded = []
+    dwell_solver = DwellSolver(
+        rrl_model, cache_dir=tmp_path, callback=recorded.append, **solver_settings
+    )
+    streamed = list(dwell_solver.iter_solve())
+    # the chunks and warm starts are the same as in solve_dwells
+    assert len(streamed) == len(reference.dwell_times_slices)
+    for (slice_layer, dwells), expected in zip(streamed, reference.dwell_times_slices):
+        np.testing.assert_allclose(dwells, expected)
+    n_layers = len(streamed)
+    assert len(recorded) == dwell_solver.layer_stats.size == n_layers
+    np.testing.assert_array_equal(
+        dwell_solver.layer_stats["layer"], np.arange(n_layers)
+    )
+    assert not np.any(dwell_solver.layer_stats["cached"])
+    # the layers are saved to the solution cache, which a solve_dwells of the same settings reads
+    cached_solver = DwellSolver(rrl_model, cache_dir=tmp_path, **solver_settings)
+    cached_solver.solve_dwells()
+    assert np.all(cached_solver.layer_stats["cached"])
+    # a partially cached run returns the layers in order
+    dwell_solver.solution_cache.clear()
+    for path in sorted(tmp_path.iterdir())[::2]:
+        path.unlink()
+    streamed = list(dwell_solver.iter_solve())
+    assert [slice_layer.index for slice_layer, _ in streamed] == list(range(n_layers))
+    assert 0 < np.count_nonzero(dwell_solver.layer_stats["cached"]) < n_layers
+    for (slice_layer, dwells), expected in zip(streamed, reference.dwell_times_slices):
+        assert dwells.shape == expected.shape
+
+    with pytest.raises(ValueError):
+        next(DwellSolver(rrl_model, checkpoint_dir=tmp_path / "run").iter_solve())
+    with pytest.raises(ValueError):
+        next(DwellSolver(rrl_model, backend="processes").iter_solve())
+
+
+def test_adaptive_layers(rrl_model, structure_file, settings, model_parameters):
+    settings["structure"]["adaptive_layers"] = True
+    adaptive_structure = Structure.from_file(structure_file, **settings["structure"])
+    adaptive_model = RRLModel(
+        adaptive_structure, model_parameters["gr"], model_parameters["sigma"]
+    )
+    uniform_solver = DwellSolver(rrl_model)
+    uniform_solver.solve_dwells()
+    adaptive_solver = DwellSolver(adaptive_model)
+    adaptive_solver.solve_dwells()
+    # fewer layers that deposit the same height
+    assert len(adaptive_structure.z_levels) < len(rrl_model.struct.z_levels)
+    assert np.isclose(
+        adaptive_solver.get_total_time().total_seconds(),
+        uniform_solver.get_total_time().total_seconds(),
+        rtol=0.05,
+    )
+
+
+def test_warm_start(rrl_model):
+    dwell_solver = DwellSolver(rrl_model)
+    dwell_solver.solve_dwells()
+    warm_solver = DwellSolver(rrl_model)
+    warm_solver.solve_dwells(n_jobs=2, warm_start=True, chunk_points=2000)
+    assert len(warm_solver.dwell_times_slices) == len(dwell_solver.dwell_times_slices)
+    assert np.isclose(
+        warm_solver.get_total_time().total_seconds(),
+        dwell_solver.get_total_time().total_seconds(),
+        rtol=0.01,
+    )
+    # the warm started solution fits the layers at least as well
+    for layer, (warm, cold) in enumerate(
+        zip(warm_solver.dwell_times_slices, dwell_solver.dwell_times_slices)
+    ):
+        proximity_matrix = rrl_model.get_proximity_matrix(layer)
+        dz = rrl_model.struct.dz_slices[layer]
+        assert la.norm(proximity_matrix @ warm - dz) <= 1.01 * la.norm(
+            proximity_matrix @ cold - dz
+        )
+
+
+@pytest.mark.parametrize("model_fixture", ["rrl_model", "dd_model"])
+def test_coordinate_descent(model_fixture, request):
+    model = request.getfixturevalue(model_fixture)
+    reference = DwellSolver(model)
+    reference.solve_dwells()
+    dwell_solver = DwellSolver(model, method="coordinate_descent")
+    dwell_solver.solve_dwells(n_jobs=2)
+    assert np.isclose(
+        dwell_solver.get_total_time().total_seconds(),
+        reference.get_total_time().total_seconds(),
+        rtol=0.01,
+    )
+    # fits the layers at least as well as lsq_linear overall
+    residuals, reference_residuals = [], []
+    for layer, (dwells, expected) in enumerate(
+        zip(dwell_solver.dwell_times_slices, reference.dwell_times_slices)
+    ):
+        proximity_matrix = model.get_proximity_matrix(layer)
+        dz = model.struct.dz_slices[layer]
+        residuals.append(la.norm(proximity_matrix @ dwells - dz))
+        reference_residuals.append(la.norm(proximity_matrix @ expected - dz))
+    assert la.norm(residuals) <= la.norm(reference_residuals)
+
+
+@pytest.mark.parametrize("model_fixture", ["rrl_model", "dd_model"])
+@pytest.mark.parametrize("method", ["lsq_linear", "coordinate_descent"])
+def test_compact_matrices(model_fixture, method, request):
+    model = request.getfixturevalue(model_fixture)
+    reference = DwellSolver(model, method=method, n_jobs=1)
+    reference.solve_dwells()
+    solver = DwellSolver(model, method=method, n_jobs=1, compact_matrices="float64")
+    solver.solve_dwells()
+    for dwell_times, reference_dwell_times in zip(
+        solver.dwell_times_slices, reference.dwell_times_slices
+    ):
+        assert np.allclose(dwell_times, reference_dwell_times, rtol=1e-6, atol=1e-9)
+    assert model.compact_matrices is None
+    # the statistics are the same as for the full matrices
+    np.testing.assert_array_equal(
+        solver.layer_stats["nnz"], reference.layer_stats["nnz"]
+    )
+    assert np.all(solver.layer_stats["search_time"] > 0)
+    # solving again reuses the neighbour searches of the compact matrices
+    solver = DwellSolver(model, method=method, n_jobs=1, compact_matrices="float64")
+    solver.solve_dwells()
+    assert np.all(solver.layer_stats["search_time"] == 0)
+    compact_solver = DwellSolver(
+        model, method=method, n_jobs=1, compact_matrices="float32"
+    )
+    compact_solver.solve_dwells()
+    assert compact_solver.get_total_time().total_seconds() == pytest.approx(
+        reference.get_total_time().total_seconds(), rel=0.01
+    )
+
+
+def test_compact_matrices_full_rows(rrl_model):
+    solver = DwellSolver(
+        rrl_model, method="coordinate_descent", compact_matrices="float32"
+    )
+    # coordinate descent gets the full compact matrices rather than their upper triangle
+    model = solver.get_solve_model()
+    assert isinstance(model.get_proximity_matrix(0), sp.csr_matrix)
+    assert not model.symmetric_matrices
+    assert isinstance(
+        solver.get_solve_model("lsq_linear").get_proximity_matrix(0), SymmetricMatrix
+    )
+
+
+def test_workers_build_proximity_matrices(structure, model_parameters, settings):
+    models = [
+        DDModel(
+            structure,
+            model_parameters["gr"],
+            model_parameters["k"],
+            model_parameters["sigma"],
+            **settings["dd_model"]
+        ),
+        HeightCorrectionModel(
+            structure,
+            model_parameters["gr"],
+            model_parameters["sigma"],
+            model_parameters["doubling_length"],
+        ),
+        PhiAngleCorrectionModel(
+            RRLModel(structure, model_parameters["gr"], model_parameters["sigma"]),
+            np.pi / 4,
+            0.1,
+        ),
+    ]
+    for model in models:
+        # the model copy sent to the workers builds the same proximity matrices from the slices
+        worker_model = model.without_structure()
+        assert worker_model.struct is None
+        for layer in [0, len(structure.slices) // 2]:
+            expected = model.get_proximity_matrix(layer).tocsr()
+            proximity_matrix = worker_model.get_slice_proximity_matrix(
+                structure.sliced_structure.layer(layer),
+                *model.get_layer_arguments(layer)
+            ).tocsr()
+            np.testing.assert_array_equal(proximity_matrix.indices, expected.indices)
+            np.testing.assert_allclose(proximity_matrix.data, expected.data)
+
+    in_process = DwellSolver(models[0])
+    in_process.solve_dwells(n_jobs=1, chunk_points=3000)
+    in_workers = DwellSolver(models[0])
+    in_workers.solve_dwells(n_jobs=2, chunk_points=3000)
+    for dwells, expected in zip(
+        in_workers.dwell_times_slices, in_process.dwell_times_slices
+    ):
+        np.testing.assert_allclose(dwells, expected)
+
+
+def test_layer_stats(rrl_model):
+    recorded = []
+    solver = DwellSolver(rrl_model, n_jobs=1, callback=recorded.append)
+    solver.solve_dwells()
+    layer_stats = solver.layer_stats
+    n_layers = len(solver.dwell_times_slices)
+    assert len(recorded) == layer_stats.size == n_layers
+    np.testing.assert_array_equal(layer_stats["layer"], np.arange(n_layers))
+    np.testing.assert_array_equal(
+        layer_stats["n_points"], [dwt.size for dwt in solver.dwell_times_slices]
+    )
+    assert np.all(layer_stats["nnz"] >= layer_stats["n_points"])
+    assert np.all(layer_stats["solve_time"] > 0)
+    assert np.all(layer_stats["n_iter"] > 0)
+    assert np.all(layer_stats["converged"])
+    assert np.all(layer_stats["residual"] < 0.1)
+    assert not np.any(layer_stats["cached"])
+    # the second solve takes all the layers from the cache
+    solver.solve_dwells()
+    assert np.all(solver.layer_stats["cached"])
+    assert np.all(np.isnan(solver.layer_stats["solve_time"]))
+
+
+def test_layer_chunks():
+    layer_sizes = np.array([5, 5, 20, 1, 1, 1, 30, 2])
+    chunks = get_layer_chunks(layer_sizes, 10)
+    assert chunks == [range(0, 2), range(2, 3), range(3, 7), range(7, 8)]
+
+
+def test_layer_components():
+    # two blocks of 40 points, two isolated points and a pair
+    blocks = [np.ones((40, 40)), np.ones((1, 1)), np.ones((40, 40))]
+    blocks += [np.ones((1, 1)), np.ones((2, 2))]
+    proximity_matrix = sp.block_diag(blocks, format="csr")
+    components = get_layer_components(proximity_matrix)
+    assert [c.size for c in components] == [40, 1, 40, 1, 2]
+    components = get_layer_components(proximity_matrix, min_points=32)
+    assert [c.size for c in components] == [40, 40, 4]
+    assert np.array_equal(np.sort(np.concatenate(components)), np.arange(84))
+
+    dz = 1.0
+    solution = DwellSolver.solve_layer(
+        proximity_matrix, dz, method="coordinate_descent", tol=1e-8
+    )
+    split_solution = DwellSolver.solve_layer(
+        proximity_matrix,
+        dz,
+        method="coordinate_descent",
+        tol=1e-8,
+        split_components=True,
+    )
+    assert np.allclose(solution, split_solution)
+    # the two blocks are solved in threads
+    parallel_solution = DwellSolver.solve_layer(
+        proximity_matrix,
+        dz,
+        method="coordinate_descent",
+        tol=1e-8,
+        split_components=True,
+        component_jobs=2,
+    )
+    np.testing.assert_array_equal(parallel_solution, split_solution)
+    solver = DwellSolver(None, method="coordinate_descent", n_jobs=2)
+    # the layers are solved in parallel, so their components are not
+    assert solver.get_solve_options(solver.method)["component_jobs"] == 1
+    assert solver.get_solve_options(solver.method, layer_jobs=2)["component_jobs"] == 2
+
+
+def test_tiled_build(rrl_model):
+    solver = DwellSolver(rrl_model, tile_size=20, n_jobs=1)
+    solver.solve_dwells()
+    reference = DwellSolver(rrl_model, n_jobs=1)
+    reference.solve_dwells()
+    for dwell_times, reference_dwell_times in zip(
+        solver.dwell_times_slices, reference.dwell_times_slices
+    ):
+        assert dwell_times.shape == reference_dwell_times.shape
+    total_time = solver.get_total_time().total_seconds()
+    reference_time = reference.get_total_time().total_seconds()
+    assert total_time == pytest.approx(reference_time, rel=0.05)
+
+
+def test_tile_options(rrl_model):
+    solver = DwellSolver(rrl_model, tile_size=20, tile_halo=rrl_model.sigma)
+    # the halo does not cover the interaction range of the model
+    with pytest.raises(ValueError):
+        solver.solve_dwells()
+    solver = DwellSolver(rrl_model, tile_size=20, n_jobs=2)
+    solve_options = solver.get_solve_options(solver.method)
+    assert solve_options["tile_halo"] == rrl_model.get_nb_threshold()
+    # the layers are solved in parallel, so their tiles are not
+    assert solve_options["tile_jobs"] == 1
+
+
+def test_tiled_solve(model_parameters):
+    sigma = model_parameters["sigma"]
+    x, y = np.meshgrid(np.arange(0, 150, 6.0), np.arange(0, 150, 6.0))
+    points = np.column_stack((x.ravel(), y.ravel()))
+    halo = 3 * sigma
+    tiles = get_layer_tiles(points, 50, halo)
+    assert len(tiles) == 9
+    interiors = np.concatenate([interior for interior, _ in tiles])
+    assert np.array_equal(np.sort(interiors), np.arange(points.shape[0]))
+    for interior, extended in tiles:
+        assert np.all(np.isin(interior, extended))
+
+    distance_matrix = get_distance_matrix(points, halo)
+    proximity_matrix = sp.csr_matrix(
+        (
+            model_parameters["gr"]
+            * np.exp(-(distance_matrix.data**2) / (2 * sigma**2)),
+            (distance_matrix.row, distance_matrix.col),
+        ),
+        shape=distance_matrix.shape,
+    )
+    solution = DwellSolver.solve_layer(
+        proximity_matrix, 1.0, method="coordinate_descent", tol=1e-8
+    )
+    errors = []
+    for schwarz_passes in range(3):
+        tiled_solution = DwellSolver.solve_layer(
+            proximity_matrix,
+            1.0,
+            method="coordinate_descent",
+            tol=1e-8,
+            points=points,
+            tile_size=50,
+            tile_halo=halo,
+            schwarz_passes=schwarz_passes,
+        )
+        errors.append(la.norm(tiled_solution - solution) / la.norm(solution))
+    assert errors[0] < 0.1
+    assert errors[2] < errors[1] < errors[0]
+    assert errors[2] < 1e-3
+
+
+def test_layer_tiles_grid():
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 200, size=(2000, 2))
+    halo = 13.2
+    for tile_size in (10, 50):
+        for interior, extended in get_layer_tiles(points, tile_size, halo):
+            # the halo points found in the neighbouring cells are the ones found by checking all the points
+            lower = points[interior].min(axis=0) - halo
+            upper = points[interior].max(axis=0) + halo
+            expected = np.flatnonzero(
+                np.all((points >= lower) & (points <= upper), axis=1)
+            )
+            assert np.array_equal(extended, expected)
+
+
+def test_tiled_proximity_matrix(rrl_model):
+    layer = int(np.argmax([points.shape[0] for points in rrl_model.struct.slices]))
+    slice_layer = rrl_model.struct.sliced_structure.layer(layer)
+    tiles = get_layer_tiles(slice_layer.points, 20, rrl_model.get_nb_threshold())
+    assert len(tiles) > 1
+    proximity_matrix = get_tiled_proximity_matrix(
+        rrl_model, slice_layer, rrl_model.get_layer_arguments(layer), tiles, n_jobs=2
+    )
+    reference = rrl_model.get_proximity_matrix(layer).tocsr()
+    x = np.random.default_rng(0).uniform(size=reference.shape[0])
+    assert np.allclose(proximity_matrix @ x, reference @ x)
+    assert np.allclose(proximity_matrix.diagonal(), reference.diagonal())
+    assert proximity_matrix.nnz == reference.nnz
+    # the solve records the rows from the tiles it builds
+    proximity_matrix = get_tiled_proximity_matrix(
+        rrl_model, slice_layer, rrl_model.get_layer_arguments(layer), tiles
+    )
+    built_tiles = []
+    get_tile_matrix = proximity_matrix.get_tile_matrix
+
+    def record_tile_matrix(index):
+        built_tiles.append(index)
+        return get_tile_matrix(index)
+
+    proximity_matrix.get_tile_matrix = record_tile_matrix
+    DwellSolver.solve_layer(proximity_matrix, 1.0, method="coordinate_descent")
+    assert len(built_tiles) == len(tiles)
+    assert np.allclose(proximity_matrix.diagonal(), reference.diagonal())
+    assert proximity_matrix.nnz == reference.nnz
+    assert len(built_tiles) == len(tiles)
+
+
+def test_tiled_build_matrix_size(rrl_model, monkeypatch):
+    layer_matrices = []
+    tile_matrices = []
+    get_proximity_matrix = rrl_model.get_proximity_matrix
+    get_slice_proximity_matrix = rrl_model.get_slice_proximity_matrix
+
+    def get_layer_proximity_matrix(layer, *args):
+        layer_matrices.append(layer)
+        return get_proximity_matrix(layer, *args)
+
+    def get_tile_proximity_matrix(slice_layer, *args):
+        tile_matrices.append(slice_layer)
+        return get_slice_proximity_matrix(slice_layer, *args)
+
+    monkeypatch.setattr(rrl_model, "get_proximity_matrix", get_layer_proximity_matrix)
+    monkeypatch.setattr(
+        rrl_model, "get_slice_proximity_matrix", get_tile_proximity_matrix
+    )
+    solver = DwellSolver(rrl_model, tile_size=20, n_jobs=1)
+    solver.solve_dwells()
+    threshold = rrl_model.get_nb_threshold()
+    tiled_layers = [
+        layer
+        for layer, points in enumerate(rrl_model.struct.slices[:-1])
+        if len(get_layer_tiles(points, 20, threshold)) > 1
+    ]
+    assert tiled_layers
+    # the matrices of the tiled layers are only built for their tiles
+    assert not set(tiled_layers) & set(layer_matrices)
+    assert len(layer_matrices) + len(tiled_layers) == len(solver.dwell_times_slices)
+    assert all(slice_layer.index is None for slice_layer in tile_matrices)
+    # each tile is built for the first solve and for the deposit and the solve of the refinement pass, but not for the statistics
+    n_tiles = sum(
+        len(get_layer_tiles(rrl_model.struct.slices[layer], 20, threshold))
+        for layer in tiled_layers
+    )
+    assert solver.schwarz_passes == 1
+    assert len(tile_matrices) == 3 * n_tiles
+    assert np.all(solver.layer_stats["nnz"] > 0)
+    assert np.all(np.isnan(solver.layer_stats["residual"][tiled_layers]))
+    # the residual of the tiled layers builds the tiles once more
+    tile_matrices.clear()
+    solver = DwellSolver(rrl_model, tile_size=20, n_jobs=1, tile_residual=True)
+    solver.solve_dwells()
+    assert len(tile_matrices) == 4 * n_tiles
+    assert np.all(np.isfinite(solver.layer_stats["residual"]))
+
+
+@pytest.mark.parametrize("backend", ["serial", "threads", "processes", "loky"])
+def test_solver_backends(rrl_model, settings, backend):
+    solver_settings = dict(settings["solver"], method="coordinate_descent")
+    reference = DwellSolver(rrl_model, **solver_settings)
+    reference.solve_dwells(n_jobs=1)
+    solver_settings.update(backend=backend, n_jobs=2, chunk_points=500)
+    dwell_solver = DwellSolver(rrl_model, **solver_settings)
+    dwell_solver.solve_dwells()
+    assert len(dwell_solver.dwell_times_slices) == len(reference.dwell_times_slices)
+    for dwells, expected in zip(
+        dwell_solver.dwell_times_slices, reference.dwell_times_slices
+    ):
+        np.testing.assert_allclose(dwells, expected)
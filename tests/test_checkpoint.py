@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from f3ast import DwellSolver
+from f3ast.checkpoint import SolveCheckpoint
+
+
+class Interrupt(Exception):
+    pass
+
+
+def test_resume(rrl_model, tmp_path, monkeypatch):
+    reference = DwellSolver(rrl_model, n_jobs=1)
+    reference.solve_dwells()
+    n_layers = len(reference.dwell_times_slices)
+
+    # interrupt the run after some layers are solved
+    def interrupt(stats):
+        if stats["layer"] >= n_layers // 2:
+            raise Interrupt
+
+    solver = DwellSolver(
+        rrl_model, n_jobs=1, checkpoint_dir=str(tmp_path), callback=interrupt
+    )
+    with pytest.raises(Interrupt):
+        solver.solve_dwells()
+    solved_layers = SolveCheckpoint(str(tmp_path)).get_solved_layers()
+    assert 0 < len(solved_layers) < n_layers
+
+    # a new run (e.g. on another node) only solves the remaining layers
+    resolved_layers = []
+    solve_layers = DwellSolver.solve_layers
+
+    def record(self, model, layers, *args, **kwargs):
+        resolved_layers.extend(layers)
+        return solve_layers(model, layers, *args, **kwargs)
+
+    monkeypatch.setattr(DwellSolver, "solve_layers", record)
+    solver = DwellSolver(rrl_model, n_jobs=1, checkpoint_dir=str(tmp_path))
+    solver.solve_dwells(resume=True)
+    assert not set(resolved_layers) & set(solved_layers)
+    assert np.all(solver.layer_stats["cached"][solved_layers])
+    for dwell_times, expected in zip(
+        solver.dwell_times_slices, reference.dwell_times_slices
+    ):
+        np.testing.assert_allclose(dwell_times, expected)
+    assert SolveCheckpoint(str(tmp_path)).get_solved_layers() == list(range(n_layers))
+
+
+def test_resume_different_run(rrl_model, tmp_path):
+    DwellSolver(rrl_model, n_jobs=1, checkpoint_dir=str(tmp_path)).solve_dwells()
+    rrl_model.gr = 0.2
+    solver = DwellSolver(rrl_model, n_jobs=1, checkpoint_dir=str(tmp_path))
+    with pytest.raises(ValueError):
+        solver.solve_dwells(resume=True)
+    # without resuming, the checkpoint is restarted
+    solver.solve_dwells()
+    assert not np.any(solver.layer_stats["cached"])
+    with pytest.raises(ValueError):
+        DwellSolver(rrl_model, n_jobs=1).solve_dwells(resume=True)
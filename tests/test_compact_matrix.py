@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from f3ast.compact_matrix import (
+    SymmetricMatrix,
+    get_compact_distance_matrix,
+    get_matrix_rows,
+    get_submatrix,
+)
+from f3ast.distance_cache import DistanceMatrixCache, get_points_distance_matrix
+
+
+@pytest.fixture
+def points():
+    return np.random.default_rng(0).uniform(0, 50, (300, 2))
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_compact_distance_matrix(points, dtype):
+    expected = get_points_distance_matrix(points, 6).toarray()
+    distance_matrix = get_compact_distance_matrix(points, 6, dtype=dtype)
+    assert distance_matrix.dtype == dtype
+    assert distance_matrix.indices.dtype == np.int32
+    assert distance_matrix.has_sorted_indices
+    assert distance_matrix.nnz == np.count_nonzero(expected) + points.shape[0]
+    assert np.allclose(distance_matrix.toarray(), expected)
+    assert np.array_equal(get_matrix_rows(distance_matrix), distance_matrix.tocoo().row)
+
+
+def test_symmetric_matrix(points):
+    full = get_compact_distance_matrix(points, 6)
+    symmetric = get_compact_distance_matrix(points, 6, symmetric=True)
+    assert isinstance(symmetric, SymmetricMatrix)
+    assert symmetric.nnz == (full.nnz + points.shape[0]) // 2
+    assert np.array_equal(symmetric.tocsr().toarray(), full.toarray())
+    x = np.random.default_rng(1).uniform(size=points.shape[0])
+    assert np.allclose(symmetric @ x, full @ x)
+    assert np.allclose(symmetric.aslinearoperator().rmatvec(x), full.T @ x)
+    index = np.arange(0, points.shape[0], 3)
+    assert np.array_equal(
+        get_submatrix(symmetric, index).tocsr().toarray(),
+        get_submatrix(full, index).toarray(),
+    )
+    symmetric *= 2
+    assert np.allclose(symmetric @ x, 2 * (full @ x))
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_compact_distance_matrix_cache(points, symmetric):
+    distance_cache = DistanceMatrixCache()
+    matrix_format = ("float32", symmetric)
+    distance_matrix = get_compact_distance_matrix(
+        points, 6, symmetric=symmetric, dtype="float32"
+    )
+    distance_cache.save(0, 6, distance_matrix, matrix_format)
+    # the compact matrices are kept apart from the coo matrices
+    assert distance_cache.load(0, 6) is None
+    cached = distance_cache.load(0, 6, matrix_format)
+    assert type(cached) is type(distance_matrix)
+    assert np.array_equal(cached.data, distance_matrix.data)
+    # a smaller threshold is served by filtering the cached matrix
+    expected = get_compact_distance_matrix(
+        points, 4, symmetric=symmetric, dtype="float32"
+    )
+    filtered = distance_cache.load(0, 4, matrix_format)
+    if symmetric:
+        filtered, expected = filtered.upper, expected.upper
+    assert filtered.indices.dtype == np.int32
+    assert np.array_equal(filtered.indptr, expected.indptr)
+    assert np.array_equal(filtered.indices, expected.indices)
+    assert np.array_equal(filtered.data, expected.data)
@@ -2,6 +2,7 @@ import numpy as np
 import pytest
 
 import f3ast
+from f3ast.distance_cache import get_points_distance_matrix
 
 
 @pytest.fixture
@@ -32,3 +33,30 @@ def test_phi_angle_correction_model(base_model):
     )
     angle_fun = angle_correction_model.angle_correction_function
     assert angle_fun(phi0) > angle_fun(phi0 + np.pi)
+
+
+def test_distance_matrix_cache(base_model):
+    struct = base_model.struct
+    layer = len(struct.slices) // 2
+    threshold = base_model.get_nb_threshold()
+    distance_matrix = base_model.get_distance_matrix(layer)
+    assert len(struct.distance_cache) == 1
+
+    # a smaller threshold is served by filtering the cached matrix
+    reference = get_points_distance_matrix(struct.slices[layer], threshold / 2)
+    cached = struct.get_distance_matrix(layer, threshold / 2)
+    for name in ["row", "col", "data"]:
+        np.testing.assert_array_equal(getattr(cached, name), getattr(reference, name))
+    # the cached matrix is not modified through the returned copies
+    distance_matrix.data[:] = -1
+    assert (struct.get_distance_matrix(layer, threshold).data >= 0).all()
+
+    # the cache stays within its size
+    struct.distance_cache.max_size = 3 * struct.distance_cache.size
+    for lyr in range(len(struct.slices)):
+        struct.get_distance_matrix(lyr, threshold)
+    assert struct.distance_cache.size <= struct.distance_cache.max_size
+    assert 0 < len(struct.distance_cache) < len(struct.slices)
+
+    struct.rescale(2)
+    assert len(struct.distance_cache) == 0
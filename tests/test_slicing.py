@@ -0,0 +1,370 @@
+import copy
+import gc
+import pickle
+import shutil
+
+import numpy as np
+import numpy.linalg as la
+import pytest
+from numba import config
+from trimesh.creation import box
+from trimesh.intersections import mesh_multiplane
+
+from f3ast import Structure, load_settings, set_numba_threading_layer
+from f3ast.branches import split_intersection
+from f3ast.resistance import get_resistance
+from f3ast.sliced_structure import SlicedStructure
+from f3ast.slicing import (
+    get_line_eqd_pts,
+    get_multiplane_intersections,
+    get_path_length,
+    split_eqd,
+)
+
+
+def reference_line_eqd_pts(lines, pitch):
+    """The original per-branch implementation of the equidistant points."""
+    start_nodes = lines[:, 0, :]
+    conn_vecs = lines[:, 1, :] - start_nodes
+    n_steps = np.ceil(la.norm(conn_vecs, axis=1) / pitch).astype(np.int32)
+    pts = np.vstack(
+        [
+            start_nodes[i, :].reshape(1, -1)
+            + conn_vecs[i, :].reshape(1, -1) * np.arange(n).reshape(-1, 1) / n
+            for i, n in enumerate(n_steps)
+        ]
+    )
+    return np.unique(np.round(pts / pitch) * pitch, axis=0)
+
+
+@pytest.fixture
+def settings():
+    return load_settings()
+
+
+@pytest.fixture
+def structure(settings):
+    return Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+
+
+@pytest.fixture
+def branch_intersections_slices(structure):
+    intersection_lines, _ = structure.get_intersection_lines()
+    return [split_intersection(inter) for inter in intersection_lines]
+
+
+def test_line_eqd_pts_matches_reference(branch_intersections_slices, settings):
+    pitch = settings["structure"]["pitch"]
+    for branch_intersections in branch_intersections_slices:
+        for lines in branch_intersections:
+            np.testing.assert_array_equal(
+                get_line_eqd_pts(lines, pitch), reference_line_eqd_pts(lines, pitch)
+            )
+
+
+def test_split_eqd_matches_reference(branch_intersections_slices, settings):
+    pitch = settings["structure"]["pitch"]
+    slices, branches, branch_lengths = split_eqd(branch_intersections_slices, pitch)
+    for sl, br, brlens, branch_intersections in zip(
+        slices, branches, branch_lengths, branch_intersections_slices
+    ):
+        branches_pts = [
+            reference_line_eqd_pts(lines, pitch) for lines in branch_intersections
+        ]
+        np.testing.assert_array_equal(sl, np.vstack(branches_pts))
+        for i, pts in enumerate(branches_pts):
+            assert np.count_nonzero(br == i) == pts.shape[0]
+        np.testing.assert_allclose(
+            brlens, [get_path_length(pts) for pts in branches_pts]
+        )
+
+
+def test_multiplane_intersections_match_trimesh(structure):
+    # include levels exactly through the vertices to hit the on-plane cases
+    z_levels = np.concatenate(
+        (structure.get_z_levels(), np.unique(structure.vertices[:, 2])[::50])
+    )
+    reference, _, _ = mesh_multiplane(
+        structure, np.zeros(3), np.array([0.0, 0.0, 1.0]), z_levels
+    )
+    intersections = get_multiplane_intersections(
+        structure.vertices, structure.faces, z_levels
+    )
+    assert len(intersections) == len(reference)
+    for lines, reference_lines in zip(intersections, reference):
+        np.testing.assert_allclose(lines, reference_lines, atol=1e-9)
+
+
+def test_iter_slices_matches_generate_slices(settings):
+    streamed = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    layers = list(streamed.iter_slices(chunk_size=7))
+    assert not streamed.is_sliced
+
+    structure = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    structure.generate_slices()
+    assert len(layers) == len(structure.slices)
+    np.testing.assert_array_equal([lyr.z for lyr in layers], structure.z_levels)
+    for lyr, sl, br, conn in zip(
+        layers, structure.slices, structure.branches, structure.branch_connections
+    ):
+        np.testing.assert_array_equal(lyr.points, sl)
+        np.testing.assert_array_equal(lyr.branches, br)
+        assert len(lyr.branch_connections) == len(conn)
+        for c1, c2 in zip(lyr.branch_connections, conn):
+            np.testing.assert_array_equal(c1, c2)
+
+
+# a single band calculates its branch connections in parallel threads
+@pytest.mark.parametrize("chunk_size", [5, 10000])
+def test_parallel_slicing_matches_serial(settings, chunk_size):
+    structure = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    structure.generate_slices()
+    layers = list(structure._slice_layers(chunk_size=chunk_size, n_jobs=2))
+    assert len(layers) == len(structure.slices)
+    for lyr, sl, br, conn in zip(
+        layers, structure.slices, structure.branches, structure.branch_connections
+    ):
+        np.testing.assert_array_equal(lyr.points, sl)
+        np.testing.assert_array_equal(lyr.branches, br)
+        assert len(lyr.branch_connections) == len(conn)
+        for c1, c2 in zip(lyr.branch_connections, conn):
+            np.testing.assert_array_equal(c1, c2)
+
+
+def test_slicing_cache(settings, tmp_path, capsys):
+    cache_dir = tmp_path / "cache"
+    settings["structure"]["cache_dir"] = cache_dir
+    structure = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    structure.generate_slices()
+    assert "Slicing..." in capsys.readouterr().out
+    assert len(list(cache_dir.glob("*.npz"))) == 1
+
+    cached = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    assert len(cached.slices) == len(structure.slices)
+    assert "Slicing..." not in capsys.readouterr().out
+    np.testing.assert_array_equal(cached.z_levels, structure.z_levels)
+    for sl1, sl2 in zip(cached.slices, structure.slices):
+        np.testing.assert_array_equal(sl1, sl2)
+    for conn1, conn2 in zip(cached.branch_connections, structure.branch_connections):
+        assert len(conn1) == len(conn2)
+        for c1, c2 in zip(conn1, conn2):
+            np.testing.assert_array_equal(c1, c2)
+    for brlens1, brlens2 in zip(cached.branch_lengths, structure.branch_lengths):
+        np.testing.assert_array_equal(brlens1, brlens2)
+
+    # a different pitch is a different entry, and the least recently used one is evicted
+    cached.pitch = 4
+    cached.slicing_cache.max_size = 1
+    cached.clear_slicing()
+    cached.generate_slices()
+    entries = list(cache_dir.glob("*.npz"))
+    assert len(entries) == 1
+    assert entries[0].stem == cached.get_slicing_key()
+
+
+def test_slicing_cache_store(settings, tmp_path, capsys):
+    settings["structure"]["cache_dir"] = tmp_path / "cache"
+    settings["structure"]["store_dir"] = tmp_path / "store"
+    structure = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    structure.generate_slices()
+    points = np.array(structure.sliced_structure.points)
+    structure.clear_slicing()
+    shutil.rmtree(tmp_path / "store")
+    capsys.readouterr()
+
+    # the slicing loaded from the cache is written to the store
+    cached = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    cached.generate_slices()
+    assert "Slicing..." not in capsys.readouterr().out
+    sliced_structure = cached.sliced_structure
+    assert sliced_structure.store_dir == tmp_path / "store" / cached.get_slicing_key()
+    assert isinstance(sliced_structure.points, np.memmap)
+    assert sliced_structure.has_connections
+    np.testing.assert_array_equal(sliced_structure.points, points)
+
+
+def test_transform_keeps_slicing(structure, capsys):
+    structure.generate_slices()
+    slices = [sl.copy() for sl in structure.slices]
+    z_levels = structure.z_levels.copy()
+    capsys.readouterr()
+
+    structure.rotate([0, 0, 1], 90)
+    structure.mirror((0, 1, 0))
+    structure.centre()
+    assert structure.is_sliced
+    assert "Slicing..." not in capsys.readouterr().out
+    dz = structure.bounds[0, 2] + 1e-3 - z_levels[0]
+    np.testing.assert_allclose(structure.z_levels, z_levels + dz)
+    # rotation by 90 degrees followed by mirroring in y maps (x, y) to (-y, -x)
+    for sl, sl0 in zip(structure.slices, slices):
+        np.testing.assert_allclose(
+            sl - sl.mean(axis=0), -(sl0[:, ::-1] - sl0[:, ::-1].mean(axis=0)), atol=1e-9
+        )
+
+    structure.rotate([1, 0, 0], 90)
+    assert not structure.is_sliced
+
+
+def test_adaptive_layers(settings):
+    settings["structure"]["adaptive_layers"] = True
+    structure = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    uniform_z_levels = Structure.from_file(
+        "tests/FunktyBall.stl", pitch=structure.pitch
+    ).get_z_levels()
+    dz = structure.dz_slices
+    assert len(structure.z_levels) < len(uniform_z_levels)
+    assert np.all(dz >= structure.pitch / 5 - 1e-9)
+    assert np.all(dz <= 2 * structure.pitch + 1e-9)
+
+    # vertical walls get the thickest layers
+    pillar = Structure(
+        vertices=box((20, 20, 60)).vertices, faces=box((20, 20, 60)).faces, pitch=3
+    )
+    pillar.adaptive_layers = True
+    np.testing.assert_allclose(np.diff(pillar.get_z_levels())[:-1], 2 * pillar.pitch)
+
+
+def test_sliced_structure(structure):
+    sliced_structure = structure.sliced_structure
+    assert sliced_structure.branch_ids.dtype == np.int32
+    assert sliced_structure.connections.dtype == np.int32
+    # the slices are views into the contiguous points
+    assert all(np.shares_memory(sl, sliced_structure.points) for sl in structure.slices)
+    for i, (sl, br) in enumerate(zip(structure.slices, structure.branches)):
+        centroids = sliced_structure.layer_branch_centroids(i)
+        for j in range(len(structure.branch_lengths[i])):
+            np.testing.assert_allclose(centroids[j], sl[br == j].mean(axis=0))
+
+    unpickled = pickle.loads(pickle.dumps(sliced_structure))
+    for name, array in sliced_structure.to_arrays().items():
+        np.testing.assert_array_equal(getattr(unpickled, name), array)
+    for conn1, conn2 in zip(
+        unpickled.get_branch_connections(), structure.branch_connections
+    ):
+        assert len(conn1) == len(conn2)
+        for c1, c2 in zip(conn1, conn2):
+            np.testing.assert_array_equal(c1, c2)
+
+
+def test_sliced_structure_store(structure, settings, tmp_path):
+    settings["structure"]["store_dir"] = tmp_path
+    stored = Structure.from_file("tests/FunktyBall.stl", **settings["structure"])
+    sliced_structure = stored.sliced_structure
+    assert isinstance(sliced_structure.points, np.memmap)
+    assert all(np.shares_memory(sl, sliced_structure.points) for sl in stored.slices)
+    for name, array in structure.sliced_structure.to_arrays().items():
+        np.testing.assert_allclose(getattr(sliced_structure, name), array)
+    np.testing.assert_allclose(
+        np.concatenate(get_resistance(stored)),
+        np.concatenate(get_resistance(structure)),
+    )
+
+    # pickling refers to the store instead of copying the points
+    pickled = pickle.dumps(sliced_structure)
+    assert len(pickled) < sliced_structure.points.nbytes
+    np.testing.assert_array_equal(pickle.loads(pickled).points, sliced_structure.points)
+
+    stored.rotate([0, 0, 1], 30)
+    structure.rotate([0, 0, 1], 30)
+    assert stored.is_sliced
+    np.testing.assert_allclose(
+        SlicedStructure.open(sliced_structure.store_dir).points,
+        structure.sliced_structure.points,
+    )
+
+
+def test_transformed_store_is_not_shared(settings, tmp_path):
+    settings["structure"]["store_dir"] = tmp_path
+    a = Structure.from_file("tests/simple_ramp.stl", **settings["structure"])
+    b = Structure.from_file("tests/simple_ramp.stl", **settings["structure"])
+    a.generate_slices()
+    b.generate_slices()
+    original_points = np.array(b.sliced_structure.points)
+    a.rotate([0, 0, 1], 90)
+    assert a.sliced_structure.store_dir != b.sliced_structure.store_dir
+    # reslicing b into the shared store does not change the transformed slicing of a
+    b.clear_slicing()
+    b.generate_slices()
+    np.testing.assert_array_equal(b.sliced_structure.points, original_points)
+    unpickled = pickle.loads(pickle.dumps(a.sliced_structure))
+    np.testing.assert_array_equal(unpickled.points, a.sliced_structure.points)
+    np.testing.assert_array_equal(unpickled.z_levels, a.sliced_structure.z_levels)
+    assert not np.allclose(a.sliced_structure.points, original_points)
+
+
+def test_transformed_stores_are_removed(settings, tmp_path):
+    reference = Structure.from_file("tests/simple_ramp.stl", **settings["structure"])
+    settings["structure"]["store_dir"] = tmp_path
+    structure = Structure.from_file("tests/simple_ramp.stl", **settings["structure"])
+    structure.generate_slices()
+    original_store = structure.sliced_structure.store_dir
+    reference.generate_slices()
+    # rezero and translate, the store of the first transform is superseded by the second
+    structure.centre()
+    reference.centre()
+    assert sorted(tmp_path.iterdir()) == sorted(
+        [original_store, structure.sliced_structure.store_dir]
+    )
+    np.testing.assert_allclose(
+        structure.sliced_structure.points, reference.sliced_structure.points
+    )
+    structure.clear_slicing()
+    gc.collect()
+    assert list(tmp_path.iterdir()) == [original_store]
+
+
+def test_transformed_store_is_kept_by_copies(settings, tmp_path):
+    settings["structure"]["store_dir"] = tmp_path
+    structure = Structure.from_file("tests/simple_ramp.stl", **settings["structure"])
+    structure.generate_slices()
+    structure.rotate([0, 0, 1], 90)
+    store_dir = structure.sliced_structure.store_dir
+    points = np.array(structure.sliced_structure.points)
+    copied = copy.deepcopy(structure.sliced_structure)
+    pickled = pickle.dumps(structure.sliced_structure)
+    structure.clear_slicing()
+    gc.collect()
+    # the copy in this process keeps the store
+    assert store_dir.exists()
+    np.testing.assert_array_equal(copied.points, points)
+    # a pickled copy reopens the store, but does not remove it
+    unpickled = pickle.loads(pickled)
+    np.testing.assert_array_equal(unpickled.points, points)
+    del unpickled
+    gc.collect()
+    assert store_dir.exists()
+    del copied
+    gc.collect()
+    assert not store_dir.exists()
+    # pickled copies must not outlive the containers of this process
+    with pytest.raises(FileNotFoundError):
+        pickle.loads(pickled)
+
+
+@pytest.mark.parametrize("store", [False, True])
+def test_sliced_structure_without_layers(tmp_path, store):
+    sliced_structure = SlicedStructure.from_layers(
+        [], store_dir=tmp_path if store else None
+    )
+    assert sliced_structure.n_layers == 0
+    assert sliced_structure.points.shape == (0, 2)
+    assert sliced_structure.branch_centroids.shape == (0, 2)
+    assert sliced_structure.get_slices() == []
+    np.testing.assert_array_equal(sliced_structure.connection_offsets, [0])
+    assert sliced_structure.connections.size == 0
+
+
+def test_numba_threading_layer(monkeypatch):
+    monkeypatch.delenv("NUMBA_THREADING_LAYER", raising=False)
+    monkeypatch.setattr(config, "THREADING_LAYER", "default")
+    set_numba_threading_layer()
+    assert config.THREADING_LAYER in ("omp", "threadsafe")
+    # the layer chosen by the user is kept
+    monkeypatch.setattr(config, "THREADING_LAYER", "workqueue")
+    set_numba_threading_layer()
+    assert config.THREADING_LAYER == "workqueue"
+    monkeypatch.setattr(config, "THREADING_LAYER", "default")
+    monkeypatch.setenv("NUMBA_THREADING_LAYER", "workqueue")
+    set_numba_threading_layer()
+    assert config.THREADING_LAYER == "default"
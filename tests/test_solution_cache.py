@@ -0,0 +1,82 @@
+import numpy as np
+
+from f3ast import DwellSolver
+from f3ast.solution_cache import SolutionCache, get_solution_key
+
+
+def test_solution_key():
+    points = np.arange(10.0).reshape((5, 2))
+    key = get_solution_key(points, (), {"gr": 0.1}, {"dz": 1.0})
+    assert key == get_solution_key(points.copy(), (), {"gr": 0.1}, {"dz": 1.0})
+    assert key != get_solution_key(points + 1e-9, (), {"gr": 0.1}, {"dz": 1.0})
+    assert key != get_solution_key(points, (np.ones(5),), {"gr": 0.1}, {"dz": 1.0})
+    assert key != get_solution_key(points, (), {"gr": 0.2}, {"dz": 1.0})
+    assert key != get_solution_key(points, (), {"gr": 0.1}, {"dz": 2.0})
+
+
+def test_solution_cache_eviction():
+    cache = SolutionCache(max_size=3 * 80)
+    for i in range(4):
+        cache.save(str(i), np.full(10, i))
+    assert len(cache) == 3
+    assert cache.load("0") is None
+    # loading refreshes the entry, so the next one is evicted instead
+    assert np.all(cache.load("1") == 1)
+    cache.save("4", np.zeros(10))
+    assert cache.load("2") is None
+    assert cache.load("1") is not None
+
+
+def test_solution_cache_directory(tmp_path):
+    cache = SolutionCache(max_size=0, directory=str(tmp_path))
+    cache.save("key", np.arange(5.0))
+    assert len(cache) == 0
+    new_cache = SolutionCache(directory=str(tmp_path))
+    np.testing.assert_array_equal(new_cache.load("key"), np.arange(5.0))
+    assert len(new_cache) == 1
+
+
+def test_solver_reuses_layers(rrl_model, monkeypatch):
+    solver = DwellSolver(rrl_model, n_jobs=1)
+    solver.solve_dwells()
+    dwell_times_slices = solver.dwell_times_slices
+    solve_options = solver.get_solve_options(solver.method)
+    layer_keys = [
+        solver.get_layer_key(layer, dz, False, solve_options)
+        for layer, dz in enumerate(rrl_model.struct.dz_slices)
+    ]
+    # identical layers have the same key
+    assert len(solver.solution_cache) == len(set(layer_keys))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached layers solved again")
+
+    monkeypatch.setattr(DwellSolver, "solve_layers", fail)
+    solver.solve_dwells()
+    for dwell_times, cached_dwell_times in zip(
+        dwell_times_slices, solver.dwell_times_slices
+    ):
+        np.testing.assert_array_equal(dwell_times, cached_dwell_times)
+    monkeypatch.undo()
+
+    # only the layers that are not cached are solved
+    solved_layers = []
+    solve_layers = DwellSolver.solve_layers
+
+    def record(self, model, layers, *args, **kwargs):
+        solved_layers.extend(layers)
+        return solve_layers(model, layers, *args, **kwargs)
+
+    monkeypatch.setattr(DwellSolver, "solve_layers", record)
+    evicted = layer_keys[len(layer_keys) // 2]
+    del solver.solution_cache._entries[evicted]
+    solver.solve_dwells()
+    assert solved_layers == [
+        layer for layer, key in enumerate(layer_keys) if key == evicted
+    ]
+
+    # a change of the model parameters misses the cache
+    rrl_model.sigma = 5.0
+    solved_layers.clear()
+    solver.solve_dwells()
+    assert len(solved_layers) == len(dwell_times_slices)
@@ -0,0 +1,38 @@
+import numpy as np
+import trimesh
+
+from f3ast import Structure
+from f3ast.stl import is_binary_stl, load_stl
+
+
+def test_binary_stl_matches_trimesh():
+    file_path = "tests/FunktyBall.stl"
+    assert is_binary_stl(file_path)
+    struct = Structure.from_file(file_path)
+    msh = trimesh.load_mesh(file_path, file_type="stl")
+    np.testing.assert_array_equal(struct.vertices, msh.vertices)
+    np.testing.assert_array_equal(struct.faces, msh.faces)
+
+
+def test_ascii_stl_fallback():
+    file_path = "tests/simple_ramp.stl"
+    assert not is_binary_stl(file_path)
+    vertices, faces = load_stl(file_path)
+    msh = trimesh.load_mesh(file_path, file_type="stl")
+    np.testing.assert_array_equal(vertices, msh.vertices)
+    np.testing.assert_array_equal(faces, msh.faces)
+
+
+def test_binary_stl_drops_nonfinite_triangles(tmp_path):
+    msh = trimesh.creation.icosphere(subdivisions=2)
+    triangles = msh.triangles.copy()
+    triangles[5, 1, 0] = np.nan
+    file_path = tmp_path / "nan.stl"
+    trimesh.Trimesh(**trimesh.triangles.to_kwargs(triangles), process=False).export(
+        file_path
+    )
+    vertices, faces = load_stl(file_path)
+    assert faces.shape[0] == triangles.shape[0] - 1
+    np.testing.assert_array_equal(
+        vertices[faces], np.delete(triangles, 5, axis=0).astype(np.float32)
+    )
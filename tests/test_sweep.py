@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+import f3ast.deposit_model
+from f3ast import DDModel, DwellSolver, RRLModel
+from f3ast.sweep import ParameterSweep, get_parameter_points
+
+
+def test_parameter_points(rrl_model):
+    parameter_grid = {"sigma": [4.0, 5.0], "gr": [0.1, 0.15, 0.3]}
+    points = get_parameter_points(parameter_grid)
+    assert len(points) == 6
+    assert points[1] == {"sigma": 4.0, "gr": 0.15}
+    sweep = ParameterSweep(rrl_model, parameter_grid)
+    solve_points, point_indices, point_scales = sweep.get_solve_points()
+    # gr is linear, so only the sigma values are solved
+    assert solve_points == [{"sigma": 4.0}, {"sigma": 5.0}]
+    assert point_indices == [0, 0, 0, 1, 1, 1]
+    np.testing.assert_allclose(point_scales, [1.5, 1, 0.5, 1.5, 1, 0.5])
+    with pytest.raises(ValueError):
+        ParameterSweep(rrl_model, {"sgima": [1.0]})
+    # the dwell times cannot be scaled from or to a zero linear parameter
+    with pytest.raises(ValueError, match="gr"):
+        ParameterSweep(rrl_model, {"gr": [0.0, 0.1]})
+    rrl_model.gr = 0
+    with pytest.raises(ValueError, match="gr"):
+        ParameterSweep(rrl_model, {"gr": [0.1]})
+
+
+@pytest.mark.parametrize("backend", ["serial", "loky"])
+def test_sweep_matches_solver(rrl_model, backend):
+    solver_settings = {
+        "method": "coordinate_descent",
+        "backend": backend,
+        "n_jobs": 2,
+        "cache_max_size": 0,
+    }
+    parameter_grid = {"sigma": [3.0, 4.4], "gr": [0.15, 0.3]}
+    sweep = ParameterSweep(rrl_model, parameter_grid, solver_settings=solver_settings)
+    sweep.solve_dwells()
+    for parameters, dwell_times_slices in zip(
+        sweep.parameter_points, sweep.dwell_times_points
+    ):
+        model = RRLModel(rrl_model.struct, **parameters)
+        solver = DwellSolver(model, **solver_settings)
+        solver.solve_dwells()
+        for dwell_times, reference in zip(
+            dwell_times_slices, solver.dwell_times_slices
+        ):
+            np.testing.assert_allclose(dwell_times, reference, rtol=1e-3, atol=1e-3)
+    assert rrl_model.sigma == 4.4
+
+
+@pytest.mark.parametrize("backend", ["serial", "loky"])
+def test_sweep_layer_parameters(rrl_model, backend):
+    dd_model = DDModel(rrl_model.struct, 0.15, 1.0, 4.4, single_pixel_width=50.0)
+    solver_settings = {"backend": backend, "n_jobs": 2, "cache_max_size": 0}
+    sweep = ParameterSweep(
+        dd_model, {"single_pixel_width": [30.0, 80.0]}, solver_settings
+    )
+    sweep.solve_dwells()
+    # the resistance of each point is calculated for its pixel width
+    for parameters, dwell_times_slices in zip(
+        sweep.parameter_points, sweep.dwell_times_points
+    ):
+        model = DDModel(rrl_model.struct, 0.15, 1.0, 4.4, **parameters)
+        solver = DwellSolver(model, **solver_settings)
+        solver.solve_dwells()
+        for dwell_times, reference in zip(
+            dwell_times_slices, solver.dwell_times_slices
+        ):
+            np.testing.assert_allclose(dwell_times, reference, rtol=1e-3, atol=1e-3)
+    assert dd_model.single_pixel_width == 50.0
+    assert sweep.get_point_model({"k": 2.0}).resistance is dd_model.resistance
+
+
+def test_sweep_streams(rrl_model, settings):
+    sweep = ParameterSweep(rrl_model, {"gr": [0.15, 0.3]})
+    streams = sweep.get_streams(**settings["stream_builder"])
+    assert len(streams) == 2
+    assert streams[1].get_time() == pytest.approx(streams[0].get_time() / 2, rel=0.05)
+
+
+def test_sweep_solver_settings(rrl_model, monkeypatch):
+    compact_calls = []
+    get_compact_distance_matrix = f3ast.deposit_model.get_compact_distance_matrix
+
+    def record(*args, **kwargs):
+        compact_calls.append(kwargs)
+        return get_compact_distance_matrix(*args, **kwargs)
+
+    monkeypatch.setattr(f3ast.deposit_model, "get_compact_distance_matrix", record)
+    solver_settings = {"backend": "serial", "compact_matrices": "float32"}
+    sweep = ParameterSweep(rrl_model, {"sigma": [3.0, 4.4]}, solver_settings)
+    sweep.solve_dwells()
+    # the points are solved with the compact matrices of the settings
+    assert compact_calls
+    assert all(kwargs["dtype"] == "float32" for kwargs in compact_calls)
+    assert rrl_model.compact_matrices is None
+
+    for name in ("cache_dir", "checkpoint_dir"):
+        with pytest.raises(ValueError):
+            ParameterSweep(rrl_model, {"sigma": [3.0]}, {name: "sweep_dir"})